@@ -22,4 +22,5 @@ urlpatterns = [
     path('admin/', admin.site.urls),
     path('', views.index, name='home'),
     path('api/', include('search.urls')),
+    path('metrics', views.metrics, name='metrics'),
 ]
\ No newline at end of file
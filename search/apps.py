@@ -1,5 +1,12 @@
+import os
 from django.apps import AppConfig
 
 
 class SearchConfig(AppConfig):
     name = 'search'
+
+    def ready(self):
+        # Optionally load models and the vector DB at startup instead of on the first request
+        if os.getenv("RAG_PRELOAD", "false").lower() == "true":
+            from .services.engine import get_engine
+            get_engine().warm()
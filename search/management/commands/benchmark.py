@@ -0,0 +1,387 @@
+import os
+import sys
+import json
+import time
+import logging
+import threading
+import contextlib
+import multiprocessing
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import Client
+from django.test.utils import override_settings
+from rich.console import Console
+from rich.table import Table
+from langchain_ollama import OllamaEmbeddings
+from search.services import tracing
+from search.services.cache import get_semantic_cache
+from search.services.engine import DB_PATH, MODEL_NAME, get_engine
+from search.services.evaluation import load_questions
+from search.services.fake_ollama import FakeOllamaServer
+from search.services.rag import answer_question
+from search.services.shards import store_paths
+from search.services.store import FAISS_INDEX_FILE, load_vector_store
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+console = Console()
+
+DEFAULT_QUESTIONS = [
+    "How do I define a User model in SQLAlchemy 2.0?",
+    "What is the difference between session.execute() and session.query()?",
+    "How do I create an async engine with aiosqlite?",
+    "Explain how to use mapped_column with type hints.",
+    "What happened to the old declarative_base() in the new version?",
+    "How do I configure a one-to-many relationship?",
+    "How do I run a bulk insert?",
+    "How do I use select() with joins?",
+]
+
+PERCENTILES = (50, 95, 99)
+# Metrics where a lower value is a regression; every other metric is a latency or size
+HIGHER_IS_BETTER = {"qps", "tokens_per_sec.mean"}
+
+
+def index_dim(db_path):
+    """Dimension of the vector index, which the fake embedder has to match."""
+    path = store_paths(db_path)[0]
+    if not os.path.exists(os.path.join(path, FAISS_INDEX_FILE)):
+        return None
+    # Loading does not call the embedder
+    return load_vector_store(path, OllamaEmbeddings(model=MODEL_NAME)).index.d
+
+
+def rss_mb():
+    """Current resident set size (Linux), otherwise the peak."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1e6
+    except (OSError, ValueError):
+        return peak_rss_mb()
+
+
+def peak_rss_mb():
+    if resource is None:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, KiB on Linux
+    return peak / 1e6 if sys.platform == 'darwin' else peak * 1024 / 1e6
+
+
+def percentiles(values):
+    if not values:
+        return {f"p{p}": 0.0 for p in PERCENTILES}
+    return {f"p{p}": float(np.percentile(values, p)) for p in PERCENTILES}
+
+
+def run_worker(worker, params, questions):
+    """
+    Runs `params['users']` concurrent users in this process (one RagEngine, like
+    one server worker). Each user sends `params['requests']` questions in turn.
+    Returns latencies, traces, errors and memory figures.
+    """
+    local = threading.local()
+    traces = []
+    traces_lock = threading.Lock()
+
+    def collect(trace):
+        # Called in the thread that finished the request
+        local.trace = trace
+        with traces_lock:
+            traces.append(trace)
+
+    tracing.listeners.append(collect)
+    # Traces are aggregated below instead of being logged one by one
+    logging.getLogger('search.trace').disabled = True
+
+    def send(client, question, history):
+        if client is not None:
+            client.post('/api/chat/', {'message': question})
+        else:
+            result = answer_question(question, history[-3:], engine=engine)
+            history.append((question, result['answer']))
+
+    def user(user_no, latencies, errors):
+        client = Client() if params['target'] == 'view' else None
+        history = []
+        for i in range(params['requests']):
+            question = questions[(worker * params['users'] + user_no + i) % len(questions)]
+            local.trace = None
+            start = time.perf_counter()
+            try:
+                send(client, question, history)
+            except Exception:
+                pass
+            # The views turn pipeline errors into an error message: no trace means a failure
+            if local.trace is None:
+                errors.append(question)
+            else:
+                latencies.append((time.perf_counter() - start) * 1000)
+
+    latencies, errors = [], []
+    # Sessions in the local-memory cache keep SQLite writes out of the measurement
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), override_settings(
+            ALLOWED_HOSTS=['testserver'], SESSION_ENGINE='django.contrib.sessions.backends.cache'):
+        engine = get_engine()
+        if params['no_cache']:
+            engine.answer_cache = get_semantic_cache('none')
+        engine.warm()
+        rss_start = rss_mb()
+
+        for question in questions[:params['warmup']]:
+            send(Client() if params['target'] == 'view' else None, question, [])
+        with traces_lock:
+            traces.clear()
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=user, args=(n, latencies, errors))
+                   for n in range(params['users'])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall = time.perf_counter() - started
+
+    tracing.listeners.remove(collect)
+    return {
+        'worker': worker,
+        'latencies': latencies,
+        'traces': traces,
+        'errors': len(errors),
+        'wall_s': wall,
+        'rss_start_mb': rss_start,
+        'rss_end_mb': rss_mb(),
+        'rss_peak_mb': peak_rss_mb(),
+    }
+
+
+def summarize(results, params):
+    latencies = [ms for result in results for ms in result['latencies']]
+    traces = [trace for result in results for trace in result['traces']]
+    wall = max(result['wall_s'] for result in results)
+
+    stage_ms = defaultdict(list)
+    for trace in traces:
+        # A stage can run more than once per request (e.g. vector search for HyDE)
+        totals = defaultdict(float)
+        for span in trace['spans']:
+            totals[span['name']] += span['duration_ms']
+        for name, ms in totals.items():
+            stage_ms[name].append(ms)
+
+    ttft = [trace['ttft_ms'] for trace in traces if 'ttft_ms' in trace]
+    rates = [trace['tokens_per_sec'] for trace in traces if 'tokens_per_sec' in trace]
+    prompt_tokens = [trace['prompt_tokens'] for trace in traces if trace.get('prompt_tokens')]
+
+    return {
+        'config': params,
+        'requests': len(latencies),
+        'errors': sum(result['errors'] for result in results),
+        'wall_s': wall,
+        'qps': len(latencies) / wall if wall else 0.0,
+        'latency_ms': percentiles(latencies),
+        'ttft_ms': percentiles(ttft),
+        'tokens_per_sec': {'mean': float(np.mean(rates)) if rates else 0.0},
+        'prompt_tokens': {'mean': float(np.mean(prompt_tokens)) if prompt_tokens else 0.0},
+        'stages_ms': {
+            name: {'count': len(values), **percentiles(values)}
+            for name, values in sorted(stage_ms.items())
+        },
+        'memory_mb': {
+            'workers': [
+                {key: result[key] for key in ('worker', 'rss_start_mb', 'rss_end_mb', 'rss_peak_mb')}
+                for result in results
+            ],
+            'max_peak': max(result['rss_peak_mb'] for result in results),
+        },
+    }
+
+
+def comparable(summary):
+    """Flat {metric: value} view of a summary, used to compare runs."""
+    metrics = {'qps': summary['qps'], 'tokens_per_sec.mean': summary['tokens_per_sec']['mean'],
+               'memory_mb.max_peak': summary['memory_mb']['max_peak']}
+    for key in ('latency_ms', 'ttft_ms'):
+        for name, value in summary[key].items():
+            metrics[f"{key}.{name}"] = value
+    for stage, values in summary['stages_ms'].items():
+        for name in (f"p{p}" for p in PERCENTILES):
+            metrics[f"stages_ms.{stage}.{name}"] = values[name]
+    return metrics
+
+
+def compare(baseline, summary, tolerance, min_ms):
+    """Returns [(metric, baseline, current, relative change, regressed)]."""
+    rows = []
+    current = comparable(summary)
+    for metric, before in comparable(baseline).items():
+        if metric not in current:
+            continue
+        after = current[metric]
+        latency = '_ms.' in metric
+        # Sub-millisecond stages are mostly noise
+        if latency and before < min_ms and after < min_ms:
+            continue
+        change = (after - before) / before if before else 0.0
+        if metric in HIGHER_IS_BETTER:
+            regressed = change < -tolerance
+        else:
+            regressed = change > tolerance and (not latency or after - before >= min_ms)
+        rows.append((metric, before, after, change, regressed))
+    return rows
+
+
+class Command(BaseCommand):
+    help = 'Load-tests the RAG pipeline (or the chat view) with concurrent users and reports per-stage latency'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target', choices=['pipeline', 'view'], default='pipeline',
+                            help='"pipeline" calls answer_question, "view" posts to /api/chat/')
+        parser.add_argument('--users', type=int, default=4,
+                            help='Concurrent users per worker process')
+        parser.add_argument('--processes', type=int, default=1,
+                            help='Worker processes, each with its own engine (like server workers)')
+        parser.add_argument('--requests', type=int, default=10,
+                            help='Questions sent by each user')
+        parser.add_argument('--warmup', type=int, default=1,
+                            help='Unmeasured requests per worker before the run')
+        parser.add_argument('--questions', default=None,
+                            help='Question file: one per line, or JSONL with a "question" field')
+        parser.add_argument('--no-cache', action='store_true',
+                            help='Disable the semantic answer cache')
+        parser.add_argument('--save', default=None,
+                            help='Write the results as JSON (usable as a baseline)')
+        parser.add_argument('--baseline', default=None,
+                            help='Compare against a saved run and fail on regressions')
+        parser.add_argument('--tolerance', type=float, default=0.10,
+                            help='Relative change counted as a regression')
+        parser.add_argument('--min-ms', type=float, default=1.0,
+                            help='Latency changes smaller than this (ms) are never regressions')
+        # Fake Ollama server
+        parser.add_argument('--fake-ollama', action='store_true',
+                            help='Serve embeddings and generations from a local stub instead of Ollama')
+        parser.add_argument('--embed-ms', type=float, default=5.0)
+        parser.add_argument('--ttft-ms', type=float, default=50.0)
+        parser.add_argument('--prefill-ms-per-1k', type=float, default=20.0)
+        parser.add_argument('--token-ms', type=float, default=10.0)
+        parser.add_argument('--tokens', type=int, default=64)
+
+    def handle(self, *args, **options):
+        console.rule("[bold purple]RAG Load Benchmark[/bold purple]")
+
+        # 1. Workload
+        questions = load_questions(options['questions']) if options['questions'] else DEFAULT_QUESTIONS
+        if not questions:
+            raise CommandError("No questions to send.")
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+
+        dim = index_dim(DB_PATH)
+        if dim is None:
+            raise CommandError(f"Vector DB not found at {DB_PATH}. Run 'ingest' first.")
+
+        # 2. Fake Ollama: started before any engine so every client points at it
+        server = None
+        if options['fake_ollama']:
+            server = FakeOllamaServer(
+                dim=dim, embed_ms=options['embed_ms'], ttft_ms=options['ttft_ms'],
+                prefill_ms_per_1k=options['prefill_ms_per_1k'], token_ms=options['token_ms'],
+                tokens=options['tokens']).start()
+            os.environ['OLLAMA_HOST'] = server.url
+            console.print(f"[cyan]Fake Ollama on {server.url} ({dim}-d embeddings)[/cyan]")
+
+        params = {key: options[key] for key in (
+            'target', 'users', 'processes', 'requests', 'warmup', 'no_cache', 'fake_ollama',
+            'embed_ms', 'ttft_ms', 'prefill_ms_per_1k', 'token_ms', 'tokens')}
+        total = options['users'] * options['processes'] * options['requests']
+        console.print(
+            f"[cyan]Sending {total} requests to the {options['target']} "
+            f"({options['processes']} x {options['users']} users)...[/cyan]")
+
+        # 3. Run
+        try:
+            if options['processes'] == 1:
+                results = [run_worker(0, params, questions)]
+            else:
+                if 'fork' not in multiprocessing.get_all_start_methods():
+                    raise CommandError("--processes needs the 'fork' start method (Linux / macOS).")
+                # Forked workers must not share the parent's database connections
+                connections.close_all()
+                with ProcessPoolExecutor(max_workers=options['processes'],
+                                         mp_context=multiprocessing.get_context('fork')) as pool:
+                    results = list(pool.map(
+                        run_worker, range(options['processes']),
+                        [params] * options['processes'], [questions] * options['processes']))
+        finally:
+            if server is not None:
+                server.stop()
+
+        summary = summarize(results, params)
+        self.report(summary)
+
+        if options['save']:
+            with open(options['save'], 'w') as f:
+                json.dump(summary, f, indent=2)
+            console.print(f"[green]✔ Results saved to {options['save']}[/green]")
+
+        # 4. Regression check
+        if baseline is not None:
+            rows = compare(baseline, summary, options['tolerance'], options['min_ms'])
+            self.report_comparison(rows, options['baseline'])
+            regressed = [metric for metric, _, _, _, bad in rows if bad]
+            if regressed:
+                raise CommandError(
+                    f"{len(regressed)} metrics regressed by more than {options['tolerance']:.0%}: "
+                    f"{', '.join(regressed)}")
+
+    def report(self, summary):
+        table = Table(title=f"{summary['requests']} requests, {summary['errors']} errors "
+                            f"in {summary['wall_s']:.1f}s")
+        table.add_column("Metric", style="cyan")
+        table.add_column("Value", justify="right", style="magenta")
+        table.add_row("Queries/s", f"{summary['qps']:.2f}")
+        for name, value in summary['latency_ms'].items():
+            table.add_row(f"Latency {name} (ms)", f"{value:.1f}")
+        for name, value in summary['ttft_ms'].items():
+            table.add_row(f"TTFT {name} (ms)", f"{value:.1f}")
+        table.add_row("Tokens/s (mean)", f"{summary['tokens_per_sec']['mean']:.1f}")
+        table.add_row("Prompt tokens (mean)", f"{summary['prompt_tokens']['mean']:.0f}")
+        console.print(table)
+
+        stages = Table(title="Per-stage latency (ms, summed per request)")
+        stages.add_column("Stage", style="cyan")
+        stages.add_column("Count", justify="right")
+        for p in PERCENTILES:
+            stages.add_column(f"p{p}", justify="right", style="magenta")
+        for name, values in summary['stages_ms'].items():
+            stages.add_row(name, str(values['count']), *(f"{values[f'p{p}']:.1f}" for p in PERCENTILES))
+        console.print(stages)
+
+        memory = Table(title="Memory per worker (MB)")
+        memory.add_column("Worker", style="cyan")
+        memory.add_column("RSS start", justify="right")
+        memory.add_column("RSS end", justify="right")
+        memory.add_column("Peak RSS", justify="right", style="magenta")
+        for worker in summary['memory_mb']['workers']:
+            memory.add_row(str(worker['worker']), f"{worker['rss_start_mb']:.0f}",
+                           f"{worker['rss_end_mb']:.0f}", f"{worker['rss_peak_mb']:.0f}")
+        console.print(memory)
+
+    def report_comparison(self, rows, path):
+        table = Table(title=f"Comparison with {path}")
+        table.add_column("Metric", style="cyan")
+        table.add_column("Baseline", justify="right")
+        table.add_column("Current", justify="right")
+        table.add_column("Change", justify="right")
+        for metric, before, after, change, regressed in rows:
+            style = "red" if regressed else "green"
+            table.add_row(metric, f"{before:.2f}", f"{after:.2f}", f"[{style}]{change:+.1%}[/{style}]")
+        console.print(table)
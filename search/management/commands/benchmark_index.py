@@ -0,0 +1,119 @@
+import os
+import time
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from rich.console import Console
+from rich.table import Table
+from langchain_ollama import OllamaEmbeddings
+from search.services.ann import INDEX_TYPES, FAISS_TRAIN_SIZE, configure_search, create_index
+from search.services.embeddings import EmbeddingStore, content_key
+from search.services.engine import DB_PATH, MODEL_NAME
+from search.services.store import load_vector_store
+from search.services.shards import store_paths
+
+console = Console()
+
+NPROBE_SWEEP = (1, 4, 16, 64)
+EF_SEARCH_SWEEP = (16, 64, 256)
+
+
+def load_cached_vectors(vector_dbs, store):
+    """Vectors of the indexed chunks, read from the embedding cache (no embedder calls)."""
+    keys = [content_key(MODEL_NAME, vector_db.docstore.search(doc_id).page_content)
+            for vector_db in vector_dbs
+            for doc_id in vector_db.index_to_docstore_id.values()]
+    cached = store.get_many(set(keys))
+    vectors = [cached[key] for key in keys if key in cached]
+    return np.array(vectors, dtype=np.float32), len(keys) - len(vectors)
+
+
+def measure(index, queries, truth, k):
+    """Recall@k against exact search and per-query latency (one query per call, as served)."""
+    hits = 0
+    latencies = []
+    for query, expected in zip(queries, truth):
+        start = time.perf_counter()
+        _, found = index.search(query[None, :], k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        hits += len(set(found[0]) & set(expected))
+    return hits / truth.size, np.percentile(latencies, 50), np.percentile(latencies, 95)
+
+
+class Command(BaseCommand):
+    help = 'Reports recall vs latency of the FAISS index types against the flat baseline'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--types', nargs='+', choices=INDEX_TYPES, default=list(INDEX_TYPES),
+                            help='Index types to compare')
+        parser.add_argument('--queries', type=int, default=200,
+                            help='Indexed chunks reused as queries')
+        parser.add_argument('--k', type=int, default=10,
+                            help='Neighbours compared against exact search')
+        parser.add_argument('--train-size', type=int, default=FAISS_TRAIN_SIZE,
+                            help='Vectors sampled to train IVF / PQ / SQ indexes')
+
+    def handle(self, *args, **options):
+        import faiss
+
+        console.rule("[bold purple]FAISS Index Benchmark[/bold purple]")
+
+        # 1. Corpus vectors from the current index (all shards) and the ingest embedding cache
+        try:
+            embeddings = OllamaEmbeddings(model=MODEL_NAME)
+            vector_dbs = [load_vector_store(path, embeddings) for path in store_paths(DB_PATH)]
+        except Exception as e:
+            console.print(f"[red]❌ Could not load the index: {e}[/red]")
+            return
+
+        cache_path = os.path.join(
+            settings.BASE_DIR, os.getenv("DATA_DIR_NAME", "data"),
+            os.getenv("EMBEDDING_CACHE_NAME", "embedding_cache.sqlite3"))
+        vectors, missing = load_cached_vectors(vector_dbs, EmbeddingStore(cache_path))
+        if missing:
+            console.print(f"[yellow]⚠️ {missing} chunks are not in the embedding cache and are skipped.[/yellow]")
+        if not len(vectors):
+            console.print("[yellow]⚠️ No cached vectors found. Run 'ingest' first.[/yellow]")
+            return
+
+        n, dim = vectors.shape
+        k = min(options['k'], n)
+        rng = np.random.default_rng(0)
+        queries = vectors[rng.choice(n, min(options['queries'], n), replace=False)]
+        train = vectors[rng.choice(n, min(options['train_size'], n), replace=False)]
+
+        # 2. Ground truth from exact search
+        flat = faiss.IndexFlatL2(dim)
+        flat.add(vectors)
+        _, truth = flat.search(queries, k)
+
+        table = Table(title=f"Recall@{k} vs latency ({n} vectors, {dim}-d, {len(queries)} queries)")
+        table.add_column("Index", style="cyan")
+        table.add_column("Factory")
+        table.add_column("Setting")
+        table.add_column(f"Recall@{k}", justify="right", style="green")
+        table.add_column("p50 (ms)", justify="right", style="magenta")
+        table.add_column("p95 (ms)", justify="right", style="magenta")
+        table.add_column("Size (MB)", justify="right")
+
+        # 3. Build each type on the same training sample and sweep its search knob
+        for index_type in options['types']:
+            console.print(f"[cyan]Building {index_type}...[/cyan]")
+            index, effective_type, factory = create_index(index_type, train, n)
+            index.add(vectors)
+            size_mb = faiss.serialize_index(index).nbytes / 1e6
+
+            if effective_type.startswith("ivf"):
+                settings_sweep = [(f"nprobe={v}", {"nprobe": v}) for v in NPROBE_SWEEP]
+            elif effective_type == "hnsw":
+                settings_sweep = [(f"efSearch={v}", {"ef_search": v}) for v in EF_SEARCH_SWEEP]
+            else:
+                settings_sweep = [("exact", {})]
+
+            for label, knobs in settings_sweep:
+                configure_search(index, **knobs)
+                recall, p50, p95 = measure(index, queries, truth, k)
+                table.add_row(effective_type, factory, label,
+                              f"{recall:.3f}", f"{p50:.3f}", f"{p95:.3f}", f"{size_mb:.1f}")
+
+        console.print(table)
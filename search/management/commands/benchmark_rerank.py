@@ -0,0 +1,106 @@
+import time
+import random
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand
+from rich.console import Console
+from rich.table import Table
+from langchain_ollama import OllamaEmbeddings
+from langchain_community.document_compressors import FlashrankRerank
+from search.services.engine import DB_PATH, MODEL_NAME, RERANK_MODEL, RERANK_TOP_N, RETRIEVAL_K
+from search.services.rerank import CachedReranker
+from search.services.store import load_vector_store
+from search.services.shards import store_paths
+
+console = Console()
+
+
+def make_workload(docs, queries, k, seed=0):
+    """
+    Builds (query, candidates) pairs from indexed chunks, so no LLM or
+    embedding server is needed: the query is the first line of a random
+    chunk and the candidates are that chunk plus k-1 others.
+    """
+    rng = random.Random(seed)
+    workload = []
+    for _ in range(queries):
+        candidates = rng.sample(docs, min(k, len(docs)))
+        query = candidates[0].page_content.strip().splitlines()[0][:200]
+        rng.shuffle(candidates)
+        workload.append((query, candidates))
+    return workload
+
+
+def run_round(reranker, workload, concurrency):
+    """Reranks the whole workload; returns per-request latencies (ms) and wall time (s)."""
+    def timed(item):
+        query, candidates = item
+        start = time.perf_counter()
+        reranker.compress_documents(documents=candidates, query=query)
+        return (time.perf_counter() - start) * 1000
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(timed, workload))
+    return latencies, time.perf_counter() - started
+
+
+class Command(BaseCommand):
+    help = 'Compares reranker latency: FlashrankRerank vs cached, micro-batched reranker'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--queries', type=int, default=50,
+                            help='Distinct queries per round')
+        parser.add_argument('--rounds', type=int, default=2,
+                            help='Rounds over the same queries (later rounds hit the score cache)')
+        parser.add_argument('--concurrency', type=int, default=4,
+                            help='Concurrent rerank requests')
+        parser.add_argument('--k', type=int, default=RETRIEVAL_K,
+                            help='Candidates per query')
+
+    def handle(self, *args, **options):
+        console.rule("[bold purple]Reranker Benchmark[/bold purple]")
+
+        # 1. Sample candidate chunks from the index (loading does not call the embedder)
+        try:
+            embeddings = OllamaEmbeddings(model=MODEL_NAME)
+            vector_dbs = [load_vector_store(path, embeddings) for path in store_paths(DB_PATH)]
+        except Exception as e:
+            console.print(f"[red]❌ Could not load the index: {e}[/red]")
+            return
+        docs = [vector_db.docstore.search(doc_id)
+                for vector_db in vector_dbs
+                for doc_id in vector_db.index_to_docstore_id.values()]
+        if not docs:
+            console.print("[yellow]⚠️ The index is empty.[/yellow]")
+            return
+        workload = make_workload(docs, options['queries'], options['k'])
+
+        # 2. Load both rerankers up front so model loading is not measured
+        rerankers = {
+            "FlashrankRerank": FlashrankRerank(model=RERANK_MODEL, top_n=RERANK_TOP_N),
+            "CachedReranker": CachedReranker(RERANK_MODEL, top_n=RERANK_TOP_N),
+        }
+        # Warm-up on an unrelated query so the first measured call is not an ONNX cold start
+        for reranker in rerankers.values():
+            reranker.compress_documents(documents=workload[0][1], query="warm up")
+
+        # 3. Measure
+        table = Table(title=f"Rerank latency ({len(workload)} queries x {options['k']} candidates, "
+                            f"concurrency {options['concurrency']})")
+        table.add_column("Reranker", style="cyan")
+        table.add_column("Round", justify="right")
+        table.add_column("p50 (ms)", justify="right", style="magenta")
+        table.add_column("p95 (ms)", justify="right", style="magenta")
+        table.add_column("Queries/s", justify="right", style="green")
+
+        for name, reranker in rerankers.items():
+            for round_no in range(1, options['rounds'] + 1):
+                latencies, elapsed = run_round(reranker, workload, options['concurrency'])
+                table.add_row(
+                    name, str(round_no),
+                    f"{np.percentile(latencies, 50):.1f}",
+                    f"{np.percentile(latencies, 95):.1f}",
+                    f"{len(workload) / elapsed:.1f}")
+
+        console.print(table)
@@ -0,0 +1,198 @@
+import os
+import time
+import itertools
+from collections import defaultdict
+import numpy as np
+import pandas as pd
+from django.core.management.base import BaseCommand, CommandError
+from rich.console import Console
+from rich.table import Table
+from search.services.ann import FAISS_EF_SEARCH, FAISS_NPROBE, configure_search
+from search.services.embeddings import CachedEmbeddings, EmbeddingStore
+from search.services.engine import DB_PATH, MODEL_NAME, RERANK_TOP_N, RETRIEVAL_K, RRF_K, get_engine
+from search.services.evaluation import (
+    EVAL_CACHE_PATH, EvaluationCache, load_dataset, ndcg_at_k, passage_key, ranked_sources,
+    recall_at_k, reciprocal_rank, relevant_urls,
+)
+from search.services.lexical import reciprocal_rank_fusion
+from search.services.rag import is_confident
+
+console = Console()
+
+# "adaptive" is the pipeline's own choice: hybrid with the raw query, or with HyDE when it is weak
+VARIANTS = ("dense", "hyde", "lexical", "hybrid", "hybrid-hyde", "adaptive")
+HYDE_VARIANTS = {"hyde", "hybrid-hyde", "adaptive"}
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def retrieve(variant, query, engine, k, shards):
+    """
+    Candidates of one retrieval variant for `query` (a prepared dict), and the
+    search latency in ms. Embeddings are precomputed, so only search is timed.
+    """
+    def dense(embedding):
+        return timed(lambda: engine.dense_search(embedding, k=k, shards=shards))
+
+    def lexical():
+        return timed(engine.lexical_search, query['question'], k=k, shards=shards)
+
+    def fuse(*legs):
+        fused, ms = timed(reciprocal_rank_fusion, [docs for docs, _ in legs], k=RRF_K, limit=k)
+        return fused, ms + sum(leg_ms for _, leg_ms in legs)
+
+    if variant == "lexical":
+        return lexical()
+
+    direct, direct_ms = dense(query['embedding'])
+    if variant == "dense":
+        return [doc for doc, _ in direct], direct_ms
+    if variant == "hybrid":
+        return fuse(([doc for doc, _ in direct], direct_ms), lexical())
+
+    if variant == "adaptive" and is_confident(direct):
+        # Same decision as the pipeline: HyDE only when direct retrieval is weak
+        return fuse(([doc for doc, _ in direct], direct_ms), lexical())
+    hyde, hyde_ms = dense(query['hyde_embedding'])
+    hyde_docs = ([doc for doc, _ in hyde], hyde_ms + (direct_ms if variant == "adaptive" else 0))
+    if variant == "hyde":
+        return hyde_docs
+    return fuse(hyde_docs, lexical())
+
+
+class Command(BaseCommand):
+    help = 'Retrieval-only evaluation (recall@k, MRR, nDCG) against labeled relevant URLs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dataset', type=str, required=True,
+                            help='JSONL with a "question" and its "relevant" URLs per line')
+        parser.add_argument('--variants', nargs='+', choices=VARIANTS, default=list(VARIANTS),
+                            help='Retrieval variants to compare')
+        parser.add_argument('--k', type=int, nargs='+', default=[RETRIEVAL_K],
+                            help='Candidates retrieved (RETRIEVAL_K values to sweep)')
+        parser.add_argument('--top-n', type=int, nargs='+', default=[RERANK_TOP_N],
+                            help='Reranked documents kept (RERANK_TOP_N values to sweep)')
+        parser.add_argument('--no-rerank', action='store_true',
+                            help='Only evaluate the candidates, without the reranker')
+        parser.add_argument('--nprobe', type=int, nargs='+', default=[FAISS_NPROBE],
+                            help='IVF lists probed (IVF indexes)')
+        parser.add_argument('--ef-search', type=int, nargs='+', default=[FAISS_EF_SEARCH],
+                            help='HNSW candidate list size (HNSW indexes)')
+        parser.add_argument('--all-shards', action='store_true',
+                            help='Search every shard instead of the routed ones')
+        parser.add_argument('--output', type=str, help='Write per-query results to this CSV file')
+
+    def handle(self, *args, **options):
+        console.rule("[bold purple]Retrieval Evaluation[/bold purple]")
+
+        records = [r for r in load_dataset(options['dataset']) if relevant_urls(r)]
+        if not records:
+            raise CommandError("No labeled questions: each line needs a question and its relevant URLs")
+
+        # 1. Engine with cached query embeddings (same SQLite cache as `ingest`)
+        engine = get_engine()
+        cache_path = os.path.join(
+            os.path.dirname(DB_PATH), os.getenv("EMBEDDING_CACHE_NAME", "embedding_cache.sqlite3"))
+        embeddings = CachedEmbeddings(engine.embeddings, EmbeddingStore(cache_path), MODEL_NAME)
+        engine.embeddings = embeddings
+        try:
+            shard_items = list(engine.shards.values())
+        except FileNotFoundError as e:
+            raise CommandError(f"{e}. Run 'ingest' first.")
+
+        # 2. Query embeddings, HyDE passages and routing, computed once for the whole sweep
+        variants = options['variants']
+        eval_cache = EvaluationCache(EVAL_CACHE_PATH)
+        queries = []
+        for record in records:
+            query = {'question': record['question'], 'relevant': relevant_urls(record)}
+            query['embedding'] = embeddings.embed_query(query['question'])
+            query['shards'] = None if options['all_shards'] else engine.route(query['embedding'])
+            if HYDE_VARIANTS & set(variants):
+                key = passage_key(query['question'])
+                passage = eval_cache.get_passage(key)
+                if passage is None:
+                    passage = engine.hyde_generator.invoke({"question": query['question']})
+                    eval_cache.put_passage(key, passage)
+                query['hyde_embedding'] = embeddings.embed_query(passage)
+            queries.append(query)
+        eval_cache.close()
+        console.print(f"[dim]{len(queries)} labeled questions, query embeddings: "
+                      f"{embeddings.hits} cached / {embeddings.misses} computed[/dim]")
+
+        rerank = not options['no_rerank']
+        top_ns = sorted(set(options['top_n']))
+        if rerank:
+            engine.compressor.top_n = top_ns[-1]
+
+        # 3. Sweep: index search knobs x k x variant (x top_n after reranking)
+        rows = []
+        for nprobe, ef_search in itertools.product(options['nprobe'], options['ef_search']):
+            setting = f"{nprobe}/{ef_search}"
+            for vector_db, _ in shard_items:
+                configure_search(vector_db.index, nprobe=nprobe, ef_search=ef_search)
+
+            for k, variant in itertools.product(options['k'], variants):
+                for query in queries:
+                    docs, search_ms = retrieve(variant, query, engine, k, query['shards'])
+                    sources = ranked_sources(docs)
+                    rows.append(self.row(query, setting, k, variant, k, sources, search_ms))
+
+                    if rerank:
+                        reranked, rerank_ms = timed(
+                            engine.compressor.compress_documents, documents=docs, query=query['question'])
+                        for top_n in top_ns:
+                            sources = ranked_sources(reranked[:top_n])
+                            rows.append(self.row(query, setting, k, f"{variant}+rerank", top_n,
+                                                 sources, search_ms + rerank_ms))
+
+        self.report(rows)
+        if options['output']:
+            pd.DataFrame(rows).to_csv(options['output'], index=False)
+            console.print(f"[green]Per-query results written to {options['output']}[/green]")
+
+    def row(self, query, setting, k, variant, cutoff, sources, latency_ms):
+        relevant = query['relevant']
+        return {
+            'question': query['question'],
+            'nprobe/ef_search': setting,
+            'k': k,
+            'variant': variant,
+            'cutoff': cutoff,
+            'recall': recall_at_k(sources, relevant, cutoff),
+            'reciprocal_rank': reciprocal_rank(sources, relevant, cutoff),
+            'ndcg': ndcg_at_k(sources, relevant, cutoff),
+            'latency_ms': latency_ms,
+        }
+
+    def report(self, rows):
+        groups = defaultdict(list)
+        for row in rows:
+            groups[(row['nprobe/ef_search'], row['k'], row['variant'], row['cutoff'])].append(row)
+
+        table = Table(title=f"Retrieval quality vs latency ({len(groups)} configurations)")
+        table.add_column("nprobe/ef", style="dim")
+        table.add_column("k", justify="right")
+        table.add_column("Variant", style="cyan")
+        table.add_column("Cutoff", justify="right")
+        table.add_column("Recall", justify="right", style="green")
+        table.add_column("MRR", justify="right", style="green")
+        table.add_column("nDCG", justify="right", style="green")
+        table.add_column("p50 (ms)", justify="right", style="magenta")
+        table.add_column("p95 (ms)", justify="right", style="magenta")
+
+        for (setting, k, variant, cutoff), group in groups.items():
+            latencies = [r['latency_ms'] for r in group]
+            table.add_row(
+                setting, str(k), variant, str(cutoff),
+                f"{np.mean([r['recall'] for r in group]):.3f}",
+                f"{np.mean([r['reciprocal_rank'] for r in group]):.3f}",
+                f"{np.mean([r['ndcg'] for r in group]):.3f}",
+                f"{np.percentile(latencies, 50):.2f}",
+                f"{np.percentile(latencies, 95):.2f}",
+            )
+        console.print(table)
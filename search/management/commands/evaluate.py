@@ -1,63 +1,173 @@
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
 import pandas as pd
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from rich.console import Console
 from rich.table import Table
 from datasets import Dataset
 from ragas import evaluate
 from ragas.metrics import faithfulness, answer_relevancy
-from langchain_ollama import ChatOllama, OllamaEmbeddings
+from langchain_ollama import ChatOllama
+from search.services.cache import get_semantic_cache
+from search.services.engine import get_engine
+from search.services.evaluation import (
+    EVAL_CACHE_PATH, EvaluationCache, config_hash, generation_key, load_dataset,
+)
 from search.services.rag import answer_question
 
 console = Console()
 
-MODEL_NAME = os.getenv("MODEL_NAME")
 LLM_MODEL = os.getenv("LLM_MODEL")
 
+DEFAULT_QUESTIONS = [
+    "How do I define a User model in SQLAlchemy 2.0?",
+    "What is the difference between session.execute() and session.query()?",
+    "How do I create an async engine with aiosqlite?",
+    "Explain how to use mapped_column with type hints.",
+    "What happened to the old declarative_base() in the new version?"
+]
+
+METRICS = ('faithfulness', 'answer_relevancy')
+
+
+def generate(question, engine):
+    """Runs the pipeline once and keeps what scoring and the report need."""
+    start = time.perf_counter()
+    result = answer_question(question, engine=engine)
+    latency_ms = (time.perf_counter() - start) * 1000
+    trace = result.get('trace', {})
+    return {
+        'answer': result['answer'],
+        # Extract text content from the Document objects
+        'contexts': [doc.page_content for doc in result.get('source_documents', [])],
+        'query_type': result.get('query_type'),
+        'latency_ms': round(latency_ms, 2),
+        'ttft_ms': trace.get('ttft_ms'),
+        'prompt_tokens': result.get('prompt_tokens', 0),
+    }
+
+
+def score_value(value):
+    value = float(value)
+    return None if np.isnan(value) else value
+
+
+def fmt(value, spec=".4f"):
+    return "N/A" if value is None else f"{value:{spec}}"
+
+
 class Command(BaseCommand):
     help = 'Runs RAGAS evaluation metrics on the current RAG pipeline'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--dataset', type=str,
+                            help='JSONL file with a "question" (or "title") per line, or plain text with one question per line')
+        parser.add_argument('--limit', type=int, help='Evaluate only the first N questions')
+        parser.add_argument('--workers', type=int, default=4,
+                            help='Questions answered concurrently against the shared engine')
+        parser.add_argument('--cache', type=str, default=EVAL_CACHE_PATH,
+                            help='SQLite file with cached generations and scores')
+        parser.add_argument('--refresh', action='store_true',
+                            help='Regenerate and rescore every question, ignoring the cache')
+        parser.add_argument('--skip-scoring', action='store_true',
+                            help='Only generate answers (and report latency)')
+        parser.add_argument('--output', type=str, help='Write the per-question report to this CSV file')
+
     def handle(self, *args, **kwargs):
         console.rule("[bold purple]RAGAS Evaluation Suite[/bold purple]")
-        
-        test_questions = [
-            "How do I define a User model in SQLAlchemy 2.0?",
-            "What is the difference between session.execute() and session.query()?",
-            "How do I create an async engine with aiosqlite?",
-            "Explain how to use mapped_column with type hints.",
-            "What happened to the old declarative_base() in the new version?"
-        ]
-        
-        console.print(f"[yellow]🧪 Running inference on {len(test_questions)} test questions...[/yellow]")
-
-        data_samples = {
-            'question': [],
-            'answer': [],
-            'contexts': [],
-        }
-
-        for query in test_questions:
-            try:
-                result = answer_question(query) 
-                
-                # Extract text content from the Document objects
-                contexts = [doc.page_content for doc in result.get('source_documents', [])]
-                
-                data_samples['question'].append(query)
-                data_samples['answer'].append(result['answer'])
-                data_samples['contexts'].append(contexts)
-                
-                console.print(f"[green]✔[/green] Processed: {query[:30]}...")
-            except Exception as e:
-                console.print(f"[red]❌ Error on '{query}': {e}[/red]")
+
+        if kwargs['dataset']:
+            records = load_dataset(kwargs['dataset'])
+        else:
+            records = [{'question': q} for q in DEFAULT_QUESTIONS]
+        if kwargs['limit']:
+            records = records[:kwargs['limit']]
+        if not records:
+            raise CommandError("No questions to evaluate")
+
+        # Shared engine: models and index are loaded once for the whole run
+        engine = get_engine()
+        engine.warm()
+        # Every question is generated for real: a semantic cache hit would
+        # return another question's answer and skew the latency
+        engine.answer_cache = get_semantic_cache('none')
+
+        cache = EvaluationCache(kwargs['cache'])
+        config = config_hash()
+        index_version = engine.index_version
+        for record in records:
+            record['key'] = generation_key(record['question'], index_version, config)
+
+        console.print(f"[dim]Index version {index_version}, config {config}, cache {kwargs['cache']}[/dim]")
+
+        # 1. Inference (cached generations are reused)
+        pending = []
+        for record in records:
+            cached = None if kwargs['refresh'] else cache.get_generation(record['key'])
+            if cached is not None:
+                record.update(cached, cached_generation=True)
+            else:
+                pending.append(record)
+
+        console.print(f"[yellow]🧪 Running inference on {len(pending)} of {len(records)} questions "
+                      f"({len(records) - len(pending)} cached, {kwargs['workers']} workers)...[/yellow]")
+
+        failed = set()
+        with ThreadPoolExecutor(max_workers=max(1, kwargs['workers'])) as pool:
+            futures = {pool.submit(generate, record['question'], engine): record for record in pending}
+            for future in as_completed(futures):
+                record = futures[future]
+                query = record['question']
+                try:
+                    generation = future.result()
+                except Exception as e:
+                    failed.add(record['key'])
+                    console.print(f"[red]❌ Error on '{query}': {e}[/red]")
+                    continue
+                # Written right away so an interrupted run resumes from here
+                cache.put_generation(record['key'], query, index_version, config, generation)
+                record.update(generation, cached_generation=False)
+                console.print(f"[green]✔[/green] Processed: {query[:30]}... ({generation['latency_ms']:.0f} ms)")
+
+        records = [record for record in records if record['key'] not in failed]
+        if not records:
+            cache.close()
+            raise CommandError("Every question failed")
+
+        # 2. Scoring (only generations without scores from this evaluator)
+        if not kwargs['skip_scoring']:
+            self.score(records, cache, engine, kwargs['refresh'])
+        cache.close()
+
+        self.report(records, kwargs['skip_scoring'], kwargs['output'])
+
+    def score(self, records, cache, engine, refresh):
+        evaluator = f"{LLM_MODEL}|{','.join(METRICS)}"
+        unscored = []
+        for record in records:
+            scores = None if refresh else cache.get_scores(record['key'], evaluator)
+            if scores is not None:
+                record.update(scores)
+            else:
+                unscored.append(record)
+
+        if not unscored:
+            console.print("\n[dim]All questions already scored by this evaluator[/dim]")
+            return
+
+        console.print(f"\n[blue]🧠 Calculating Metrics (Faithfulness & Relevance) for {len(unscored)} questions...[/blue]")
 
         evaluator_llm = ChatOllama(model=LLM_MODEL, temperature=0)
-        evaluator_embeddings = OllamaEmbeddings(model=MODEL_NAME)
+        evaluator_embeddings = engine.embeddings
 
-        dataset = Dataset.from_dict(data_samples)
+        dataset = Dataset.from_dict({
+            'question': [r['question'] for r in unscored],
+            'answer': [r['answer'] for r in unscored],
+            'contexts': [r['contexts'] for r in unscored],
+        })
 
-        console.print("\n[blue]🧠 Calculating Metrics (Faithfulness & Relevance)...[/blue]")
-        
         results = evaluate(
             dataset,
             metrics=[faithfulness, answer_relevancy],
@@ -65,29 +175,47 @@ class Command(BaseCommand):
             embeddings=evaluator_embeddings
         )
 
-        final_scores = results
-        
-        table = Table(title="RAG Evaluation Report")
-        table.add_column("Metric", style="cyan")
-        table.add_column("Score", style="magenta")
-
-        
-        f_score = final_scores['faithfulness']
-        ar_score = final_scores['answer_relevancy']
-
-        if isinstance(f_score, list):
-             import numpy as np
-             f_score = np.mean(f_score)
-        
-        if isinstance(ar_score, list):
-             import numpy as np
-             ar_score = np.mean(ar_score)
-
-        f_display = f"{f_score:.4f}" if f_score == f_score else "N/A"
-        ar_display = f"{ar_score:.4f}" if ar_score == ar_score else "N/A"
-
-        table.add_row("Faithfulness", f_display)
-        table.add_row("Answer Relevancy", ar_display)
-        
+        # Per-question scores, in dataset order
+        frame = results.to_pandas()
+        for record, (_, row) in zip(unscored, frame.iterrows()):
+            scores = {metric: score_value(row[metric]) for metric in METRICS}
+            cache.put_scores(record['key'], evaluator, scores)
+            record.update(scores)
+
+    def report(self, records, skip_scoring, output):
+        table = Table(title="Per-Question Results")
+        table.add_column("Question", style="cyan", max_width=50)
+        table.add_column("Type", style="dim")
+        table.add_column("Latency (ms)", justify="right", style="yellow")
+        table.add_column("TTFT (ms)", justify="right")
+        if not skip_scoring:
+            table.add_column("Faithfulness", justify="right", style="magenta")
+            table.add_column("Relevancy", justify="right", style="magenta")
+        table.add_column("Cached", justify="center", style="dim")
+
+        for r in records:
+            row = [r['question'], r.get('query_type') or "-",
+                   fmt(r['latency_ms'], ".0f"), fmt(r.get('ttft_ms'), ".0f")]
+            if not skip_scoring:
+                row += [fmt(r.get('faithfulness')), fmt(r.get('answer_relevancy'))]
+            row.append("✔" if r['cached_generation'] else "")
+            table.add_row(*row)
         console.print(table)
-        console.print(f"\n[bold]Raw Data:[/bold] {final_scores}")
\ No newline at end of file
+
+        latencies = [r['latency_ms'] for r in records]
+        summary = Table(title="RAG Evaluation Report")
+        summary.add_column("Metric", style="cyan")
+        summary.add_column("Score", style="magenta")
+        if not skip_scoring:
+            for metric, label in zip(METRICS, ("Faithfulness", "Answer Relevancy")):
+                values = [r[metric] for r in records if r.get(metric) is not None]
+                summary.add_row(label, fmt(float(np.mean(values)) if values else None))
+        summary.add_row("Latency p50 (ms)", f"{np.percentile(latencies, 50):.0f}")
+        summary.add_row("Latency p95 (ms)", f"{np.percentile(latencies, 95):.0f}")
+        console.print(summary)
+
+        if output:
+            columns = ['question', 'query_type', 'latency_ms', 'ttft_ms', 'prompt_tokens',
+                       *([] if skip_scoring else METRICS), 'cached_generation']
+            pd.DataFrame([{c: r.get(c) for c in columns} for r in records]).to_csv(output, index=False)
+            console.print(f"[green]Per-question report written to {output}[/green]")
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+from rich.console import Console
+from search.services.fake_ollama import FakeOllamaServer
+
+console = Console()
+
+
+class Command(BaseCommand):
+    help = 'Runs a local Ollama-compatible stub with deterministic outputs and configurable latency'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=11435)
+        parser.add_argument('--dim', type=int, default=768,
+                            help='Embedding size (must match the vector index)')
+        parser.add_argument('--embed-ms', type=float, default=5.0,
+                            help='Delay per embedding request')
+        parser.add_argument('--ttft-ms', type=float, default=50.0,
+                            help='Delay before the first generated token')
+        parser.add_argument('--prefill-ms-per-1k', type=float, default=20.0,
+                            help='Extra delay before the first token per 1k prompt tokens')
+        parser.add_argument('--token-ms', type=float, default=10.0,
+                            help='Delay between generated tokens')
+        parser.add_argument('--tokens', type=int, default=64,
+                            help='Tokens per generated answer')
+
+    def handle(self, *args, **options):
+        server = FakeOllamaServer(
+            options['host'], options['port'], options['dim'], options['embed_ms'], options['ttft_ms'],
+            options['prefill_ms_per_1k'], options['token_ms'], options['tokens'])
+        console.print(f"[green]✔ Fake Ollama listening on {server.url}[/green]")
+        console.print(f"Point the app at it with: OLLAMA_HOST={server.url}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.stop()
@@ -1,108 +1,439 @@
 import os
+import time
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from django.core.management.base import BaseCommand
 from django.conf import settings
 from django.utils import timezone
 from rich.console import Console
+from rich.progress import Progress, ProgressColumn, BarColumn, TextColumn, TimeElapsedColumn
+from rich.text import Text
 from dotenv import load_dotenv
-from langchain_community.vectorstores import FAISS
 from langchain_ollama import OllamaEmbeddings
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_core.documents import Document
 from search.models import ScrapedPage
+from search.services.embeddings import CachedEmbeddings, EmbeddingStore
+from search.services.indexing import IndexWriter, embed_batches, make_batches
+from search.services.store import (
+    CHUNK_STORE_FILE, FAISS_INDEX_FILE, LEGACY_DOCSTORE_FILE, load_vector_store, save_vector_store)
+from search.services.ann import (
+    INDEX_META_FILE, INDEX_TYPES, FAISS_INDEX_TYPE, FAISS_TRAIN_SIZE, index_centroid, read_meta, write_meta)
+from search.services.shards import INDEX_SHARD_BY, SHARDS_DIR, shard_for, shard_path, write_router
+from search.services.lexical import LEXICAL_INDEX_FILE, LexicalIndex
+from search.services.chunking import (
+    CHUNKERS, CHUNKER, CHUNK_TOKENS, CHUNK_OVERLAP_TOKENS, CHUNK_SIZE, CHUNK_OVERLAP, split_document)
 
 console = Console()
 
 
+class ChunkRateColumn(ProgressColumn):
+    """Renders the embedding throughput."""
+
+    def render(self, task):
+        if task.speed is None:
+            return Text("-- chunks/s", style="dim")
+        return Text(f"{task.speed:.1f} chunks/s", style="magenta")
+
+
+def chunk_id(page_id, index, text):
+    """Deterministic vector ID for the `index`-th chunk of a page."""
+    digest = hashlib.sha1(text.encode('utf-8')).hexdigest()[:12]
+    return f"{page_id}:{index}:{digest}"
+
+
 class Command(BaseCommand):
     help = 'Ingests scraped data from the database into the Vector Store'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--compact', action='store_true',
+                            help='Rebuild the index from the chunks of processed pages only')
+        parser.add_argument('--batch-size', type=int,
+                            default=int(os.getenv("EMBED_BATCH_SIZE", "64")),
+                            help='Chunks sent to the embedder per request')
+        parser.add_argument('--workers', type=int,
+                            default=int(os.getenv("EMBED_WORKERS", "2")),
+                            help='Concurrent embedding requests')
+        parser.add_argument('--checkpoint-every', type=int, default=10,
+                            help='Save the index every N committed batches')
+        parser.add_argument('--index-type', choices=INDEX_TYPES, default=None,
+                            help='FAISS index type (default: the existing index type, '
+                                 'or FAISS_INDEX_TYPE for a new index). Changing it rebuilds the index')
+        parser.add_argument('--train-size', type=int, default=FAISS_TRAIN_SIZE,
+                            help='Vectors sampled to train IVF / PQ / SQ indexes')
+        parser.add_argument('--shard-by', choices=['none', 'domain', 'version'], default=INDEX_SHARD_BY,
+                            help='Split the vector store per library and doc version')
+        parser.add_argument('--chunker', choices=CHUNKERS, default=CHUNKER,
+                            help='Text splitter ("structured" keeps code blocks and sections intact)')
+        parser.add_argument('--split-workers', type=int, default=os.cpu_count() or 1,
+                            help='Processes used to split pages (0 splits in this process)')
+        parser.add_argument('--rechunk', action='store_true',
+                            help='Re-split and re-ingest every processed page (e.g. after changing the chunker)')
+
+    def stale_chunk_ids(self, vector_db, pages):
+        """IDs of vectors previously ingested for `pages`."""
+        stored_ids = set(vector_db.index_to_docstore_id.values())
+        stale = set()
+        legacy_urls = set()
+        for page in pages:
+            if page.chunk_ids:
+                stale.update(page.chunk_ids)
+            else:
+                # Ingested before chunk IDs were tracked: match on source URL
+                legacy_urls.add(page.url)
+
+        if legacy_urls:
+            for doc_id in stored_ids:
+                doc = vector_db.docstore.search(doc_id)
+                if getattr(doc, 'metadata', {}).get('source') in legacy_urls:
+                    stale.add(doc_id)
+
+        return [doc_id for doc_id in stale if doc_id in stored_ids]
+
+    def compact(self, vector_db, embeddings, live_ids, index_type, batch_size, train_size):
+        """
+        Rebuilds the index keeping only `live_ids` and the chunks of processed pages.
+        Returns an IndexWriter holding the new `index_type` store.
+        """
+        live_ids = set(live_ids)
+        legacy_urls = set()
+        for page in ScrapedPage.objects.filter(status='processed'):
+            if page.chunk_ids:
+                live_ids.update(page.chunk_ids)
+            else:
+                legacy_urls.add(page.url)
+
+        ids, docs = [], []
+        for doc_id in vector_db.index_to_docstore_id.values():
+            doc = vector_db.docstore.search(doc_id)
+            if doc_id in live_ids or doc.metadata.get('source') in legacy_urls:
+                ids.append(doc_id)
+                docs.append(doc)
+
+        dropped = len(vector_db.index_to_docstore_id) - len(ids)
+        console.print(
+            f"[cyan]Compacting: keeping {len(ids)} chunks, dropping {dropped}...[/cyan]")
+        if not docs:
+            raise ValueError("No live chunks left to rebuild the index from.")
+        # Vectors come straight from the embedding cache
+        writer = IndexWriter(embeddings, index_type=index_type,
+                             expected_total=len(ids), train_size=train_size)
+        for batch in make_batches(ids, docs, batch_size):
+            writer.add(batch, embeddings.embed_documents(batch.texts))
+        writer.flush()
+        return writer
+
+    def build_lexical_index(self, vector_db, db_path):
+        """Rebuilds the BM25 inverted index from the live docstore."""
+        doc_ids = list(vector_db.index_to_docstore_id.values())
+        texts = [vector_db.docstore.search(doc_id).page_content for doc_id in doc_ids]
+        LexicalIndex.build(doc_ids, texts).save(db_path)
+        console.print(f"[green]✔ Lexical index built over {len(doc_ids)} chunks.[/green]")
+
     def handle(self, *args, **options):
         load_dotenv()
 
         MODEL_NAME = os.getenv("MODEL_NAME")
-        CHUNK_SIZE = int(os.getenv("CHUNK_SIZE"))
-        CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP"))
         DATA_DIR_NAME = os.getenv("DATA_DIR_NAME")
         DB_DIR_NAME = os.getenv("DB_DIR_NAME")
+        EMBEDDING_CACHE_NAME = os.getenv("EMBEDDING_CACHE_NAME", "embedding_cache.sqlite3")
 
         base_dir = getattr(settings, 'BASE_DIR', os.getcwd())
         data_path = os.path.join(base_dir, DATA_DIR_NAME)
         db_path = os.path.join(data_path, DB_DIR_NAME)
+        cache_path = os.path.join(data_path, EMBEDDING_CACHE_NAME)
+        shards_dir = os.path.join(db_path, SHARDS_DIR)
 
         os.makedirs(db_path, exist_ok=True)
 
+        # A single store at the root of db_path predates sharding: its pages are
+        # re-ingested into shards (unchanged chunks come from the embedding cache)
+        legacy_files = [os.path.join(db_path, name) for name in (
+            FAISS_INDEX_FILE, CHUNK_STORE_FILE, LEGACY_DOCSTORE_FILE, LEXICAL_INDEX_FILE, INDEX_META_FILE)]
+        legacy = not os.path.isdir(shards_dir) and any(os.path.exists(path) for path in legacy_files)
+        if legacy:
+            console.print(
+                "[cyan]Unsharded Vector DB found: re-ingesting processed pages into shards...[/cyan]")
+            ScrapedPage.objects.filter(status='processed').update(status='pending')
+        elif options['rechunk']:
+            console.print(
+                "[cyan]Re-chunking: processed pages are re-ingested (unchanged chunks come from the embedding cache)...[/cyan]")
+            ScrapedPage.objects.filter(status='processed').update(status='pending')
+
         # 1. Load Documents from Database
         console.print(
             "[cyan]Loading pending documents from the database...[/cyan]")
         pending_pages = ScrapedPage.objects.filter(status='pending')
 
-        if not pending_pages.exists():
+        pages = list(pending_pages)
+
+        # An explicit --index-type may require a rebuild even with nothing pending
+        if not pages and not options['compact'] and not options['index_type']:
             console.print(
                 "[yellow]⚠️ No pending pages to ingest. Run the 'scrape' command first.[/yellow]")
             return
 
-        documents = []
-        for page in pending_pages:
-            doc = Document(
-                page_content=page.content,
-                metadata={
-                    "source": page.url,
-                    "title": page.title,
-                }
-            )
-            documents.append(doc)
-
         console.rule(
-            f"[bold blue]Processing {len(documents)} Documents[/bold blue]")
+            f"[bold blue]Processing {len(pages)} Documents[/bold blue]")
 
         # 2. Text Splitting
-        console.print(
-            f"[cyan]Splitting text (Size={CHUNK_SIZE}, Overlap={CHUNK_OVERLAP})...[/cyan]")
+        if options['chunker'] == 'structured':
+            console.print(
+                f"[cyan]Splitting text (structured, {CHUNK_TOKENS} tokens, overlap {CHUNK_OVERLAP_TOKENS})...[/cyan]")
+        else:
+            console.print(
+                f"[cyan]Splitting text (Size={CHUNK_SIZE}, Overlap={CHUNK_OVERLAP})...[/cyan]")
 
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=CHUNK_SIZE,
-            chunk_overlap=CHUNK_OVERLAP,
-            separators=["\n\n", "\n", " ", ""],
-            length_function=len,
-        )
+        page_shards = [shard_for(page.url, options['shard_by']) for page in pages]
+        metadatas = [
+            {
+                "source": page.url,
+                "title": page.title,
+                "library": library,
+                "version": version,
+            }
+            for page, (_, library, version) in zip(pages, page_shards)
+        ]
+        split = partial(split_document, chunker=options['chunker'])
+        workers = options['split_workers']
+        if workers > 0 and len(pages) > 1:
+            # Splitting is CPU-bound (token counting): run it in worker processes
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                page_chunks_list = list(pool.map(
+                    split, [page.content for page in pages], metadatas,
+                    chunksize=max(1, len(pages) // (workers * 4))))
+        else:
+            page_chunks_list = [split(page.content, metadata) for page, metadata in zip(pages, metadatas)]
 
-        chunks = text_splitter.split_documents(documents)
-        console.print(f"[green]✔ Generated {len(chunks)} chunks.[/green]")
+        # Pages are grouped into shards by library (and doc version)
+        shards = {}
+        n_chunks = 0
+        for page, (key, library, version), page_chunks in zip(pages, page_shards, page_chunks_list):
+            shard = shards.setdefault(key, {
+                'library': library, 'version': version,
+                'pages': [], 'chunks': [], 'ids': [], 'page_chunk_ids': {},
+            })
+            page_ids = [chunk_id(page.id, i, c.page_content)
+                        for i, c in enumerate(page_chunks)]
+            shard['pages'].append(page)
+            shard['chunks'].extend(page_chunks)
+            shard['ids'].extend(page_ids)
+            shard['page_chunk_ids'][page.id] = page_ids
+            n_chunks += len(page_chunks)
+
+        console.print(f"[green]✔ Generated {n_chunks} chunks in {len(shards)} shards.[/green]")
+
+        # Compaction and index type changes apply to every existing shard
+        if (options['compact'] or options['index_type']) and os.path.isdir(shards_dir):
+            for key in os.listdir(shards_dir):
+                if key not in shards:
+                    meta = read_meta(os.path.join(shards_dir, key))
+                    shards[key] = {
+                        'library': meta.get('library', ''), 'version': meta.get('version', ''),
+                        'pages': [], 'chunks': [], 'ids': [], 'page_chunk_ids': {},
+                    }
 
         # 3. Embedding & Indexing
         console.print(
             f"[purple]Embedding with {MODEL_NAME} (this may take time)...[/purple]")
 
-        embeddings = OllamaEmbeddings(model=MODEL_NAME)
+        # Unchanged chunks are served from the content-addressed cache
+        embeddings = CachedEmbeddings(
+            OllamaEmbeddings(model=MODEL_NAME), EmbeddingStore(cache_path), MODEL_NAME)
 
-        try:
-            if os.path.exists(db_path) and os.listdir(db_path):
+        started = time.perf_counter()
+        processed = 0
+        failed = False
+        for key in sorted(shards):
+            console.rule(f"[bold blue]Shard: {key}[/bold blue]")
+            shard_processed, ok = self.ingest_shard(
+                shard_path(db_path, key), shards[key], embeddings, options)
+            processed += shard_processed
+            failed = failed or not ok
+            # The serving process reloads when the router changes
+            if os.path.isdir(shards_dir):
+                write_router(db_path)
+
+        # Once the router is written the root store is no longer served, even if
+        # a shard failed (the next run sees shards/ and would not treat it as legacy)
+        if os.path.isdir(shards_dir):
+            for path in legacy_files:
+                if os.path.exists(path):
+                    os.remove(path)
+
+        elapsed = time.perf_counter() - started
+        console.print(
+            f"[green]✔ Embeddings: {embeddings.hits} cached, {embeddings.misses} computed "
+            f"({n_chunks / elapsed if elapsed else 0:.1f} chunks/s).[/green]")
+
+        if failed:
+            remaining = len(pages) - processed
+            console.print(
+                f"[yellow]{processed} pages committed, {remaining} left pending. "
+                f"Re-run 'ingest' to resume.[/yellow]")
+            return
+
+        console.rule("[bold green]Ingestion Complete[/bold green]")
+        console.print(f"Vector DB saved to: {db_path}")
+        console.print(f"{processed} pages marked as processed.")
+
+    def ingest_shard(self, db_path, shard, embeddings, options):
+        """
+        Merges the chunks of `shard` into the vector store at `db_path`.
+        Returns (pages marked as processed, whether the shard completed).
+        """
+        pages = shard['pages']
+        chunks = shard['chunks']
+        ids = shard['ids']
+        page_chunk_ids = shard['page_chunk_ids']
+        options = dict(options)
+
+        os.makedirs(db_path, exist_ok=True)
+
+        vector_db = None
+        meta = {"index_type": FAISS_INDEX_TYPE, "factory": "Flat"}
+        index_type = options['index_type'] or FAISS_INDEX_TYPE
+        if os.path.exists(os.path.join(db_path, FAISS_INDEX_FILE)):
+            console.print(
+                "[cyan]Existing Vector DB found. Merging new documents...[/cyan]")
+            vector_db = load_vector_store(db_path, embeddings, mmap=False)
+            meta = read_meta(db_path)
+            index_type = options['index_type'] or meta['index_type']
+            if index_type != meta['index_type']:
                 console.print(
-                    "[cyan]Existing Vector DB found. Merging new documents...[/cyan]")
-                vector_db = FAISS.load_local(
-                    db_path, embeddings, allow_dangerous_deserialization=True)
-                vector_db.add_documents(chunks)
-            else:
-                console.print("[cyan]Creating new Vector DB...[/cyan]")
-                vector_db = FAISS.from_documents(chunks, embeddings)
+                    f"[cyan]Index type changes from {meta['index_type']} to {index_type}: "
+                    f"the index will be rebuilt.[/cyan]")
+                options['compact'] = True
+
+            # Replace (not append) the chunks of re-ingested pages.
+            # IDs that are still current were committed by an earlier (possibly
+            # interrupted) run with identical content, so they are kept and skipped.
+            current_ids = set(ids)
+            stale_ids = [doc_id for doc_id in self.stale_chunk_ids(vector_db, pages)
+                         if doc_id not in current_ids]
+            if stale_ids and meta['index_type'] != "flat":
+                # HNSW graphs do not support removal, and IVF removal keeps the
+                # original labels while FAISS.delete renumbers its id mapping:
+                # drop them by rebuilding
+                console.print(
+                    f"[cyan]{len(stale_ids)} stale chunks in a {meta['index_type']} index: "
+                    f"it will be rebuilt.[/cyan]")
+                options['compact'] = True
+            elif stale_ids:
+                console.print(
+                    f"[cyan]Removing {len(stale_ids)} stale chunks...[/cyan]")
+                vector_db.delete(stale_ids)
+        elif not chunks:
+            console.print(
+                "[yellow]⚠️ Nothing to compact: no Vector DB found.[/yellow]")
+            return 0, True
+
+        stored_ids = set(vector_db.index_to_docstore_id.values()) if vector_db else set()
+        todo = [(i, c) for i, c in zip(ids, chunks) if i not in stored_ids]
+        if len(todo) < len(chunks):
+            console.print(
+                f"[cyan]Resuming: {len(chunks) - len(todo)} chunks already indexed.[/cyan]")
+
+        # Pages complete once all of their chunks are committed
+        pending_chunks = {page.id: 0 for page in pages}
+        chunk_page = {}
+        for page_id, page_ids in page_chunk_ids.items():
+            for doc_id in page_ids:
+                chunk_page[doc_id] = page_id
+        for doc_id, _ in todo:
+            pending_chunks[chunk_page[doc_id]] += 1
+
+        # A new index of a trained type is created once `train_size` vectors are embedded
+        writer = IndexWriter(
+            embeddings, vector_db,
+            index_type=meta['index_type'] if vector_db else index_type,
+            factory=meta['factory'],
+            expected_total=len(stored_ids) + len(todo),
+            train_size=options['train_size'],
+        )
+        pages_by_id = {page.id: page for page in pages}
+        completed = [page_id for page_id, n in pending_chunks.items() if n == 0]
+        processed_ids = []
+        state = {'batches': 0}
+
+        def checkpoint(final=False):
+            """Saves the index, then marks the pages whose chunks are all in it."""
+            if writer.vector_db is not None:
+                save_vector_store(writer.vector_db, db_path)
+                write_meta(db_path, {
+                    "index_type": writer.index_type,
+                    "factory": writer.factory,
+                    "vectors": writer.vector_db.index.ntotal,
+                    "library": shard['library'],
+                    "version": shard['version'],
+                    # Used by the router to pick shards for a query
+                    "centroid": index_centroid(writer.vector_db.index),
+                })
+                if final:
+                    self.build_lexical_index(writer.vector_db, db_path)
+            if completed:
+                now = timezone.now()
+                done_pages = [pages_by_id[page_id] for page_id in completed]
+                for page in done_pages:
+                    page.status = 'processed'
+                    page.processed_at = now
+                    # Chunk IDs are kept so the next re-ingest can replace them
+                    page.chunk_ids = page_chunk_ids[page.id]
+                ScrapedPage.objects.bulk_update(
+                    done_pages, ['status', 'processed_at', 'chunk_ids'])
+                processed_ids.extend(completed)
+                completed.clear()
+
+        def commit(batches):
+            """Counts chunks once they are in the index (buffered training batches are not)."""
+            for batch in batches:
+                for doc_id in batch.ids:
+                    page_id = chunk_page[doc_id]
+                    pending_chunks[page_id] -= 1
+                    if pending_chunks[page_id] == 0:
+                        completed.append(page_id)
+
+        def on_batch(batch, vectors):
+            commit(writer.add(batch, vectors))
+            progress.advance(task, len(batch))
+            state['batches'] += 1
+            if state['batches'] % options['checkpoint_every'] == 0:
+                checkpoint()
+
+        try:
+            with Progress(
+                TextColumn("[purple]{task.description}"),
+                BarColumn(),
+                TextColumn("{task.completed}/{task.total}"),
+                ChunkRateColumn(),
+                TimeElapsedColumn(),
+                console=console,
+            ) as progress:
+                task = progress.add_task("Embedding", total=len(todo))
+                embed_batches(
+                    embeddings,
+                    make_batches([i for i, _ in todo], [c for _, c in todo], options['batch_size']),
+                    options['workers'],
+                    on_batch,
+                )
 
-            vector_db.save_local(db_path)
+            commit(writer.flush())
 
-            # 4. Update status in database
-            processed_ids = [page.id for page in pending_pages]
-            ScrapedPage.objects.filter(id__in=processed_ids).update(
-                status='processed',
-                processed_at=timezone.now()
-            )
+            if options['compact'] and writer.vector_db is not None:
+                writer = self.compact(
+                    writer.vector_db, embeddings, ids, index_type,
+                    options['batch_size'], options['train_size'])
 
-            console.rule("[bold green]Ingestion Complete[/bold green]")
-            console.print(f"Vector DB saved to: {db_path}")
-            console.print(f"{len(processed_ids)} pages marked as processed.")
+            checkpoint(final=True)
+            return len(processed_ids), True
 
         except Exception as e:
             console.print(f"[bold red]❌ FAISS Error:[/bold red] {e}")
             console.print(
                 "Ensure you have 'langchain-community' and 'faiss-cpu' installed.")
-            processed_ids = [page.id for page in pending_pages]
-            ScrapedPage.objects.filter(
-                id__in=processed_ids).update(status='failed')
+            # Keep every committed batch; unfinished pages stay pending so the
+            # next run resumes from the last checkpoint
+            try:
+                checkpoint(final=True)
+            except Exception as e:
+                console.print(f"[bold red]❌ Checkpoint Error:[/bold red] {e}")
+            return len(processed_ids), False
@@ -1,15 +1,39 @@
 import os
 import time
+import hashlib
+import threading
 import requests
-from urllib.parse import urljoin, urlparse, urldefrag
-from bs4 import BeautifulSoup
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlparse, urldefrag
 from django.core.management.base import BaseCommand
+from django.db import transaction
 from django.utils import timezone
 from rich.console import Console
 from search.models import ScrapedPage
+from search.services.extractors import EXTRACTORS, SCRAPE_PARSER, extract
 
 console = Console()
 
+HEADERS = {'User-Agent': 'StrataSearch-Bot/1.0'}
+
+
+class HostRateLimiter:
+    """Spaces out requests to the same host to at most `rate` per second."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next_slot = {}
+        self._lock = threading.Lock()
+
+    def wait(self, host):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot.get(host, 0.0))
+            self._next_slot[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
 
 class Command(BaseCommand):
     help = 'Scrapes documentation for RAG ingestion'
@@ -20,95 +44,281 @@ class Command(BaseCommand):
                             help='Max crawl depth')
         parser.add_argument('--max', type=int, default=50,
                             help='Max pages to scrape')
+        parser.add_argument('--concurrency', type=int, default=8,
+                            help='Concurrent fetches')
+        parser.add_argument('--rate', type=float, default=2.0,
+                            help='Max requests per second per host')
+        parser.add_argument('--save-batch', type=int, default=20,
+                            help='Pages written to the database per transaction')
+        parser.add_argument('--refresh', action='store_true',
+                            help='Also revalidate every known page of this domain')
+        parser.add_argument('--parser', choices=sorted(EXTRACTORS), default=SCRAPE_PARSER,
+                            help='HTML extractor')
+        parser.add_argument('--parse-workers', type=int, default=os.cpu_count() or 1,
+                            help='Processes used to parse HTML (0 parses in the fetch threads)')
 
     def handle(self, *args, **options):
         start_url = options['url']
         max_pages = options['max']
         depth_limit = options['depth']
 
-        self.crawl(start_url, max_pages, depth_limit)
-
-    def clean_content(self, soup):
-        for tag in soup(['script', 'style', 'nav', 'footer', 'header', 'aside', 'iframe', 'noscript']):
-            tag.decompose()
+        self._local = threading.local()
+        self.rate_limiter = HostRateLimiter(options['rate'])
+        self.parser = options['parser']
 
-        title = soup.title.string.strip() if soup.title else "Untitled"
-        text = soup.get_text(separator='\n', strip=True)
+        # Parsing is CPU-bound: run it in worker processes, overlapping with network fetches
+        self.parse_pool = None
+        if options['parse_workers'] > 0:
+            self.parse_pool = ProcessPoolExecutor(max_workers=options['parse_workers'])
 
-        code_blocks = len(soup.find_all('pre'))
-
-        return title, text, code_blocks
+        try:
+            self.crawl(start_url, max_pages, depth_limit,
+                       options['concurrency'], options['save_batch'], options['refresh'])
+        finally:
+            if self.parse_pool is not None:
+                self.parse_pool.shutdown()
 
-    def save_page_to_db(self, url, title, content):
+    def save_page_to_db(self, url, title, content, etag='', last_modified='', content_hash='', links=None):
+        """
+        Returns 'created', 'updated' or 'unchanged' (None on error).
+        Only a change of the cleaned text sends the page back to `pending`.
+        """
         try:
+            existing = ScrapedPage.objects.filter(url=url).first()
+            # Pages saved before hashing was introduced are compared on their text
+            if existing is not None and (
+                    existing.content_hash == content_hash
+                    or (not existing.content_hash and existing.content == content)):
+                ScrapedPage.objects.filter(pk=existing.pk).update(
+                    etag=etag,
+                    last_modified=last_modified,
+                    content_hash=content_hash,
+                    links=links,
+                    scraped_at=timezone.now()
+                )
+                return 'unchanged'
+
             obj, created = ScrapedPage.objects.update_or_create(
                 url=url,
                 defaults={
                     'title': title,
                     'content': content,
+                    'etag': etag,
+                    'last_modified': last_modified,
+                    'content_hash': content_hash,
+                    'links': links,
                     'status': 'pending',
                     'processed_at': None,
                     'scraped_at': timezone.now()
                 }
             )
-            return created
+            return 'created' if created else 'updated'
         except Exception as e:
             console.print(f"[bold red]❌ Database Error:[/bold red] {e}")
             return None
 
-    def crawl(self, start_url, max_pages, depth_limit):
-        visited_urls = set(ScrapedPage.objects.values_list('url', flat=True))
-        queue = [(start_url, 0)]
+    def save_pages(self, pages):
+        """Writes a batch of fetched pages in a single transaction."""
+        saved = 0
+        unchanged = 0
+        with transaction.atomic():
+            for page in pages:
+                title = page['title']
+                result = self.save_page_to_db(
+                    page['url'], title, page['content'],
+                    page['etag'], page['last_modified'], page['content_hash'], page['links'])
+                if result == 'unchanged':
+                    console.print(f"[dim]= Unchanged:[/dim] {title}")
+                    unchanged += 1
+                elif result is not None:
+                    action = "[green]✔ Saved[/green]" if result == 'created' else "[blue]🔄 Updated[/blue]"
+                    console.print(
+                        f"{action} ({page['code_count']} code blocks): {title}")
+                    saved += 1
+                else:
+                    console.print(
+                        f"[red]❌ Failed to save:[/red] {title}")
+        return saved, unchanged
+
+    def _session(self):
+        # requests.Session is not guaranteed thread-safe: one per worker thread
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+            self._local.session.headers.update(HEADERS)
+        return self._local.session
+
+    def fetch(self, url, depth, validators=None):
+        """
+        Runs in a worker thread: fetches and parses one page.
+        `validators` is the stored (etag, last_modified) pair used for a conditional GET.
+        Links are always extracted: they are stored so a later 304 can still be expanded.
+        """
+        headers = {}
+        if validators:
+            etag, last_modified = validators
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+
+        self.rate_limiter.wait(urlparse(url).netloc)
+        resp = self._session().get(url, headers=headers, timeout=10)
+
+        if resp.status_code != 200:
+            return {'url': url, 'depth': depth, 'status': resp.status_code}
+
+        if self.parse_pool is not None:
+            parsed = self.parse_pool.submit(
+                extract, resp.content, url, self.parser).result()
+        else:
+            parsed = extract(resp.content, url, self.parser)
+
+        content = parsed['content']
+        return {
+            'url': url,
+            'depth': depth,
+            'status': resp.status_code,
+            'title': parsed['title'][:255],
+            'content': content,
+            'content_hash': hashlib.sha256(content.encode('utf-8')).hexdigest(),
+            'etag': resp.headers.get('ETag', ''),
+            'last_modified': resp.headers.get('Last-Modified', ''),
+            'code_count': parsed['code_count'],
+            'links': parsed['links'],
+        }
+
+    def crawl(self, start_url, max_pages, depth_limit, concurrency=8, save_batch=20, refresh=False):
+        # Known pages are revalidated with conditional requests instead of re-downloaded
+        validators = {}
+        # Outgoing links per page: stored ones are followed when a page answers 304
+        links_of = {}
+        for url, etag, last_modified, links in ScrapedPage.objects.values_list(
+                'url', 'etag', 'last_modified', 'links'):
+            validators[url] = (etag, last_modified)
+            if links is not None:
+                links_of[url] = links
         base_domain = urlparse(start_url).netloc
         pages_scraped = 0
+        pages_unchanged = 0
+        pending_saves = []
 
-        console.rule(f"[bold cyan]🕷️ Starting Crawl: {start_url}[/bold cyan]")
+        # URLs are normalized when enqueued. `best` keeps the shallowest depth
+        # each URL was reached at: a shallower link re-enqueues it, so its
+        # children are expanded from the right depth
+        best = {}
+        fetched = set()
+        frontier = deque()
 
-        while queue and pages_scraped < max_pages:
-            url, depth = queue.pop(0)
+        def normalize(url):
             url, _ = urldefrag(url)
+            if not url.startswith('http') or urlparse(url).netloc != base_domain:
+                return None
+            return url
+
+        def enqueue(url, depth):
+            url = normalize(url)
+            if url is None or depth > depth_limit or best.get(url, depth_limit + 1) <= depth:
+                return
+            best[url] = depth
+            frontier.append((url, depth))
+
+        def expand(url):
+            for link in links_of.get(url, ()):
+                enqueue(link, best[url] + 1)
+
+        def flush():
+            nonlocal pages_scraped, pages_unchanged
+            if pending_saves:
+                saved, unchanged = self.save_pages(pending_saves)
+                pages_scraped += saved
+                pages_unchanged += unchanged
+                pending_saves.clear()
 
-            if url in visited_urls or depth > depth_limit or not url.startswith('http'):
-                continue
+        enqueue(start_url, 0)
+        # With --refresh, known pages the crawl did not reach are revalidated
+        # once the frontier drains (at max depth: revalidated, not expanded)
+        seeded = not refresh
+        started = time.perf_counter()
 
-            if urlparse(url).netloc != base_domain:
-                continue
+        console.rule(f"[bold cyan]🕷️ Starting Crawl: {start_url}[/bold cyan]")
+
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="crawl") as executor:
+            in_flight = {}
 
-            try:
+            def submit(url, depth, validators=None):
                 console.print(f"[dim]Fetching:[/dim] {url} (Depth: {depth})")
-                resp = requests.get(
-                    url, headers={'User-Agent': 'StrataSearch-Bot/1.0'}, timeout=10)
-
-                if resp.status_code == 200:
-                    soup = BeautifulSoup(resp.content, 'html.parser')
-                    title, content, code_count = self.clean_content(soup)
-
-                    if len(content.split()) > 50:
-                        created = self.save_page_to_db(url, title, content)
-                        if created is not None:
-                            action = "[green]✔ Saved[/green]" if created else "[blue]🔄 Updated[/blue]"
-                            console.print(
-                                f"{action} ({code_count} code blocks): {title}")
-                            pages_scraped += 1
-                        else:
-                            console.print(
-                                f"[red]❌ Failed to save:[/red] {title}")
+                in_flight[executor.submit(self.fetch, url, depth, validators)] = url
+
+            while True:
+                if not frontier and not in_flight and not seeded:
+                    seeded = True
+                    for url in validators:
+                        enqueue(url, depth_limit)
+
+                # Keep the pool busy while the page budget allows
+                budget = max_pages - pages_scraped - len(pending_saves)
+                while frontier and len(in_flight) < min(concurrency, max(budget, 0)):
+                    url, depth = frontier.popleft()
+                    if depth > best[url]:
+                        continue  # Superseded by a shallower entry
+                    if url in fetched:
+                        # Reached again from a shallower page: expand its known links
+                        # (a fetch still in flight expands them when it completes)
+                        if url not in in_flight.values():
+                            expand(url)
+                        continue
+                    fetched.add(url)
+                    submit(url, depth, validators.get(url))
+
+                if not in_flight:
+                    if frontier or seeded:
+                        break
+                    continue
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    url = in_flight.pop(future)
+                    try:
+                        page = future.result()
+                    except Exception as e:
+                        console.print(f"[red]❌ Error:[/red] {e}")
+                        continue
+
+                    if page['status'] == 304:
+                        console.print(f"[dim]= Not modified:[/dim] {url}")
+                        if url not in links_of:
+                            # Crawled before links were stored: fetch it in full once
+                            validators.pop(url, None)
+                            submit(url, best[url])
+                            continue
+                        pages_unchanged += 1
+                        expand(url)
+                        continue
+
+                    if page['status'] != 200:
+                        continue
+
+                    page['links'] = list(dict.fromkeys(
+                        link for link in map(normalize, page['links']) if link is not None))
+                    links_of[url] = page['links']
+
+                    if len(page['content'].split()) > 50:
+                        if pages_scraped + len(pending_saves) < max_pages:
+                            pending_saves.append(page)
                     else:
                         console.print(
                             "[yellow]⏭️  Skipped (Low Content)[/yellow]")
 
-                    visited_urls.add(url)
-
-                    if depth < depth_limit:
-                        for a in soup.find_all('a', href=True):
-                            link = urljoin(url, a['href'])
-                            if link not in visited_urls:
-                                queue.append((link, depth + 1))
+                    expand(url)
 
-                time.sleep(0.5)
+                if len(pending_saves) >= save_batch:
+                    flush()
 
-            except Exception as e:
-                console.print(f"[red]❌ Error:[/red] {e}")
+        flush()
+        elapsed = time.perf_counter() - started
 
         console.rule(
             f"[bold green]Crawl Complete: Scraped {pages_scraped} new/updated pages.[/bold green]")
+        console.print(f"{pages_unchanged} pages unchanged (not modified or same content)")
+        console.print(
+            f"{pages_scraped / elapsed if elapsed else 0:.2f} pages/sec over {elapsed:.1f}s")
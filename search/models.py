@@ -10,9 +10,40 @@ class ScrapedPage(models.Model):
     url = models.URLField(max_length=2048, unique=True, db_index=True)
     title = models.CharField(max_length=255)
     content = models.TextField()
+    # HTTP validators for conditional re-crawls and a hash of the cleaned text
+    etag = models.CharField(max_length=255, blank=True, default='')
+    last_modified = models.CharField(max_length=64, blank=True, default='')
+    content_hash = models.CharField(max_length=64, blank=True, default='')
+    # Same-domain links of the last fetched version, followed when a re-crawl gets a 304
+    links = models.JSONField(null=True, blank=True)
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
     scraped_at = models.DateTimeField(auto_now_add=True)
     processed_at = models.DateTimeField(null=True, blank=True)
+    # Vector store IDs of the chunks produced by the last ingest of this page
+    chunk_ids = models.JSONField(default=list, blank=True)
 
     def __str__(self):
         return self.title
+
+
+class Conversation(models.Model):
+    """A chat conversation; the session only stores its ID."""
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Conversation {self.pk}"
+
+
+class Turn(models.Model):
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='turns')
+    question = models.TextField()
+    # Standalone query the turn was answered for, so later turns never re-condense it
+    condensed_query = models.TextField()
+    answer = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['id']
+
+    def __str__(self):
+        return self.question[:50]
@@ -0,0 +1,261 @@
+import os
+import time
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import Future
+from contextlib import asynccontextmanager, contextmanager
+from dotenv import load_dotenv
+from langchain_core.embeddings import Embeddings
+from .metrics import ADMISSION_WAIT_SECONDS, REJECTED_REQUESTS
+
+load_dotenv()
+
+# Concurrent calls per Ollama model, and calls allowed to wait for a slot
+# before new requests are turned away with "busy"
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "2"))
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "8"))
+EMBED_MAX_CONCURRENCY = int(os.getenv("EMBED_MAX_CONCURRENCY", "4"))
+EMBED_MAX_QUEUE = int(os.getenv("EMBED_MAX_QUEUE", "32"))
+# Seconds a call may wait for a slot before it gives up with "busy"
+ADMISSION_TIMEOUT = float(os.getenv("ADMISSION_TIMEOUT", "30"))
+# Identical in-flight queries share one pipeline run
+RAG_COALESCE = os.getenv("RAG_COALESCE", "true").lower() == "true"
+
+
+class ServerBusy(Exception):
+    """The model is saturated: the request is rejected instead of queued."""
+
+
+class FlightAborted(Exception):
+    """The request leading a coalesced flight went away before finishing."""
+
+
+class _Waiter:
+    """A queued call; `wake()` is called once a slot has been handed to it."""
+
+    __slots__ = ("wake", "granted")
+
+    def __init__(self, wake):
+        self.wake = wake
+        self.granted = False
+
+
+def _wake_future(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class AdmissionController:
+    """
+    Bounded concurrency in front of one Ollama model. At most
+    `max_concurrency` calls run at once; others wait up to `timeout` seconds.
+    `admit()` and `slot(admit=True)` reject immediately once `max_queue`
+    calls are already waiting, so latency stays bounded under bursts.
+    Shared by threads and event loops of one process: a released slot is
+    handed to the oldest waiter, a thread or a coroutine, without polling.
+    """
+
+    def __init__(self, model, max_concurrency, max_queue, timeout=ADMISSION_TIMEOUT):
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self._waiters = deque()
+        self._lock = threading.Lock()
+
+    def saturated(self):
+        return self.active >= self.max_concurrency and self.waiting >= self.max_queue
+
+    def _reject(self, reason):
+        REJECTED_REQUESTS.inc(model=self.model)
+        raise ServerBusy(f"{self.model} is busy ({reason})")
+
+    def admit(self):
+        """Fails fast when a new request would only join a full queue."""
+        if self.saturated():
+            self._reject(f"{self.waiting} requests queued")
+
+    def _enter(self, admit, wake):
+        """Takes a free slot (returns None) or queues a waiter woken by `wake`."""
+        with self._lock:
+            if admit and self.saturated():
+                self._reject(f"{self.waiting} requests queued")
+            if self.active < self.max_concurrency and not self._waiters:
+                self.active += 1
+                return None
+            waiter = _Waiter(wake)
+            self._waiters.append(waiter)
+            self.waiting += 1
+            return waiter
+
+    def _leave_queue(self, waiter):
+        """Dequeues a waiter that stops waiting; returns whether it got a slot meanwhile."""
+        with self._lock:
+            if waiter.granted:
+                return True
+            self._waiters.remove(waiter)
+            self.waiting -= 1
+            return False
+
+    def _granted(self, acquired, started):
+        if not acquired:
+            self._reject(f"no slot within {self.timeout:g}s")
+        ADMISSION_WAIT_SECONDS.observe(time.perf_counter() - started, model=self.model)
+
+    def _release(self):
+        with self._lock:
+            if not self._waiters:
+                self.active -= 1
+                return
+            # The slot passes to the next waiter: `active` is unchanged
+            waiter = self._waiters.popleft()
+            waiter.granted = True
+            self.waiting -= 1
+        waiter.wake()
+
+    @contextmanager
+    def slot(self, admit=False):
+        started = time.perf_counter()
+        event = threading.Event()
+        waiter = self._enter(admit, event.set)
+        if waiter is not None:
+            try:
+                event.wait(self.timeout)
+            except BaseException:
+                if self._leave_queue(waiter):
+                    self._release()
+                raise
+            self._granted(self._leave_queue(waiter), started)
+        else:
+            self._granted(True, started)
+        try:
+            yield
+        finally:
+            self._release()
+
+    @asynccontextmanager
+    async def aslot(self, admit=False):
+        """`slot` for coroutines: waits on the event loop, not on a thread."""
+        started = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiter = self._enter(admit, lambda: loop.call_soon_threadsafe(_wake_future, future))
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(future, self.timeout)
+            except asyncio.TimeoutError:
+                pass
+            except BaseException:
+                # Cancelled: hand back a slot granted while the wait was ending
+                if self._leave_queue(waiter):
+                    self._release()
+                raise
+            self._granted(self._leave_queue(waiter), started)
+        else:
+            self._granted(True, started)
+        try:
+            yield
+        finally:
+            self._release()
+
+
+class AdmittedEmbeddings(Embeddings):
+    """Embedding model whose calls go through an `AdmissionController`."""
+
+    def __init__(self, embeddings, admission):
+        self.embeddings = embeddings
+        self.admission = admission
+
+    def embed_documents(self, texts):
+        with self.admission.slot():
+            return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text):
+        with self.admission.slot():
+            return self.embeddings.embed_query(text)
+
+    async def aembed_documents(self, texts):
+        async with self.admission.aslot():
+            return await self.embeddings.aembed_documents(texts)
+
+    async def aembed_query(self, text):
+        async with self.admission.aslot():
+            return await self.embeddings.aembed_query(text)
+
+
+class SingleFlight:
+    """
+    Coalesces identical in-flight work: the first caller for a key runs it,
+    callers arriving meanwhile wait for its result (or error) instead of
+    repeating it. Results are not kept once the flight has landed.
+    """
+
+    def __init__(self, enabled=RAG_COALESCE):
+        self.enabled = enabled
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def join(self, key):
+        """Returns (future, leader). The leader must call `finish(key, ...)`."""
+        if not self.enabled:
+            return Future(), True
+        with self._lock:
+            future = self._flights.get(key)
+            if future is not None:
+                return future, False
+            future = self._flights[key] = Future()
+            return future, True
+
+    def finish(self, key, result=None, error=None):
+        if not self.enabled:
+            return
+        with self._lock:
+            future = self._flights.pop(key, None)
+        if future is None or future.cancelled():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def do(self, key, func, *args):
+        """Runs `func(*args)` once per key in flight. Returns (result, coalesced)."""
+        future, leader = self.join(key)
+        if not leader:
+            try:
+                return future.result(), True
+            except FlightAborted:
+                return func(*args), False
+        try:
+            result = func(*args)
+        except Exception as e:
+            self.finish(key, error=e)
+            raise
+        except BaseException:
+            self.finish(key, error=FlightAborted())
+            raise
+        self.finish(key, result)
+        return result, False
+
+    async def ado(self, key, func, *args):
+        """`do` for a coroutine function; sync and async callers share flights."""
+        future, leader = self.join(key)
+        if not leader:
+            try:
+                # Shielded: a cancelled follower must not cancel the flight
+                return await asyncio.shield(asyncio.wrap_future(future)), True
+            except FlightAborted:
+                return await func(*args), False
+        try:
+            result = await func(*args)
+        except Exception as e:
+            self.finish(key, error=e)
+            raise
+        except BaseException:
+            self.finish(key, error=FlightAborted())
+            raise
+        self.finish(key, result)
+        return result, False
@@ -0,0 +1,133 @@
+import os
+import json
+import math
+import logging
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+INDEX_META_FILE = "index_meta.json"
+
+# "flat" is exact search; the others trade recall for speed and memory
+INDEX_TYPES = ("flat", "hnsw", "ivf-flat", "ivf-pq", "ivf-sq8")
+FAISS_INDEX_TYPE = os.getenv("FAISS_INDEX_TYPE", "flat")
+# Vectors buffered to train IVF coarse centroids and PQ/SQ codebooks
+FAISS_TRAIN_SIZE = int(os.getenv("FAISS_TRAIN_SIZE", "20000"))
+FAISS_HNSW_M = int(os.getenv("FAISS_HNSW_M", "32"))
+
+# Query-time knobs, applied when the index is loaded
+FAISS_NPROBE = int(os.getenv("FAISS_NPROBE", "16"))
+FAISS_EF_SEARCH = int(os.getenv("FAISS_EF_SEARCH", "64"))
+
+# FAISS wants ~39 training points per centroid, and 2^8 per PQ codebook
+MIN_POINTS_PER_CENTROID = 39
+MIN_PQ_TRAIN_SIZE = 256
+
+
+def needs_training(index_type):
+    return index_type.startswith("ivf")
+
+
+def ivf_nlist(n_vectors, n_train):
+    """~4 * sqrt(N) inverted lists, capped by what the training sample can support."""
+    nlist = int(4 * math.sqrt(max(n_vectors, 1)))
+    return max(1, min(nlist, n_train // MIN_POINTS_PER_CENTROID))
+
+
+def pq_subquantizers(dim):
+    """Largest divisor of `dim` up to dim / 16 (48 sub-vectors for 768-d embeddings)."""
+    for m in range(max(dim // 16, 1), 0, -1):
+        if dim % m == 0:
+            return m
+    return 1
+
+
+def factory_string(index_type, dim, n_vectors, n_train):
+    if index_type == "flat":
+        return "Flat"
+    if index_type == "hnsw":
+        return f"HNSW{FAISS_HNSW_M}"
+
+    nlist = ivf_nlist(n_vectors, n_train)
+    if index_type == "ivf-flat":
+        return f"IVF{nlist},Flat"
+    if index_type == "ivf-pq":
+        return f"IVF{nlist},PQ{pq_subquantizers(dim)}"
+    if index_type == "ivf-sq8":
+        return f"IVF{nlist},SQ8"
+    raise ValueError(f"Unknown index type '{index_type}'. Choose from: {', '.join(INDEX_TYPES)}")
+
+
+def create_index(index_type, train_vectors, n_vectors):
+    """
+    Builds an empty (trained) FAISS index for `index_type` with L2 metric, like
+    the default LangChain store. Returns (index, effective type, factory string);
+    falls back to "flat" when the sample is too small to train on.
+    """
+    import faiss
+
+    n_train, dim = train_vectors.shape
+    min_train = MIN_PQ_TRAIN_SIZE if index_type == "ivf-pq" else MIN_POINTS_PER_CENTROID
+    if needs_training(index_type) and n_train < min_train:
+        logger.warning(
+            f"{n_train} vectors are too few to train '{index_type}' (need {min_train}), using 'flat'")
+        index_type = "flat"
+
+    factory = factory_string(index_type, dim, n_vectors, n_train)
+    index = faiss.index_factory(dim, factory, faiss.METRIC_L2)
+    if not index.is_trained:
+        index.train(train_vectors)
+    return index, index_type, factory
+
+
+def configure_search(index, nprobe=FAISS_NPROBE, ef_search=FAISS_EF_SEARCH):
+    """Applies the query-time knobs that exist on `index` (no-op for flat)."""
+    import faiss
+
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = min(nprobe, ivf.nlist)
+    hnsw = getattr(faiss.downcast_index(index), "hnsw", None)
+    if hnsw is not None:
+        hnsw.efSearch = ef_search
+
+
+def read_meta(db_path):
+    """Index metadata written by `ingest`; indexes built before it existed are flat."""
+    path = os.path.join(db_path, INDEX_META_FILE)
+    if not os.path.exists(path):
+        return {"index_type": "flat", "factory": "Flat"}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_meta(db_path, meta):
+    path = os.path.join(db_path, INDEX_META_FILE)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(meta, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def index_centroid(index, block_size=10000):
+    """
+    Mean of the vectors in `index`, used to route queries between shards.
+    IVF indexes are summarized by their coarse centroids weighted by list size.
+    """
+    import faiss
+    import numpy as np
+
+    if index.ntotal == 0:
+        return None
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        sizes = np.array([ivf.invlists.list_size(i) for i in range(ivf.nlist)], dtype=np.float32)
+        centroids = ivf.quantizer.reconstruct_n(0, ivf.nlist)
+        return (sizes @ centroids / sizes.sum()).tolist()
+
+    total = np.zeros(index.d, dtype=np.float64)
+    for start in range(0, index.ntotal, block_size):
+        total += index.reconstruct_n(start, min(block_size, index.ntotal - start)).sum(axis=0)
+    return (total / index.ntotal).tolist()
@@ -0,0 +1,185 @@
+import os
+import time
+import uuid
+import threading
+from collections import OrderedDict
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+SEMANTIC_CACHE_BACKEND = os.getenv("SEMANTIC_CACHE_BACKEND", "memory")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "512"))
+SEMANTIC_CACHE_TTL = int(os.getenv("SEMANTIC_CACHE_TTL", "3600"))
+SEMANTIC_CACHE_ALIAS = os.getenv("SEMANTIC_CACHE_ALIAS", "default")
+
+
+def _normalize(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class SemanticCache:
+    """
+    Answer cache keyed on the embedding of the effective query.
+
+    A lookup returns the payload of the most similar stored query when
+    its cosine similarity reaches `threshold`. Entries are tagged with the
+    index version they were produced with, so rebuilding the vector DB
+    invalidates them. `scope` separates answers retrieved under different
+    library / version filters.
+    """
+
+    def __init__(self, threshold=SEMANTIC_CACHE_THRESHOLD,
+                 max_entries=SEMANTIC_CACHE_MAX_ENTRIES, ttl=SEMANTIC_CACHE_TTL):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+    def lookup(self, embedding, version, scope=""):
+        raise NotImplementedError
+
+    def store(self, embedding, payload, version, scope=""):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def _best_match(self, embedding, entries):
+        """Returns (key, similarity) of the closest entry in `(key, vector)` pairs."""
+        if not entries:
+            return None, 0.0
+        keys = [key for key, _ in entries]
+        matrix = np.stack([vector for _, vector in entries])
+        scores = matrix @ _normalize(embedding)
+        best = int(np.argmax(scores))
+        return keys[best], float(scores[best])
+
+
+class NullSemanticCache(SemanticCache):
+    """Disables caching."""
+
+    def lookup(self, embedding, version, scope=""):
+        return None
+
+    def store(self, embedding, payload, version, scope=""):
+        pass
+
+    def clear(self):
+        pass
+
+
+class InMemorySemanticCache(SemanticCache):
+    """Per-process LRU + TTL cache."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._entries = OrderedDict()  # key -> (vector, payload, expires_at, scope)
+        self._version = None
+        self._lock = threading.Lock()
+
+    def _sync_version(self, version):
+        if version != self._version:
+            self._entries.clear()
+            self._version = version
+
+    def lookup(self, embedding, version, scope=""):
+        with self._lock:
+            self._sync_version(version)
+
+            now = time.time()
+            for key in [k for k, (_, _, expires_at, _) in self._entries.items() if expires_at < now]:
+                del self._entries[key]
+
+            key, score = self._best_match(
+                embedding, [(k, v) for k, (v, _, _, s) in self._entries.items() if s == scope])
+            if key is None or score < self.threshold:
+                return None
+
+            self._entries.move_to_end(key)
+            return self._entries[key][1]
+
+    def store(self, embedding, payload, version, scope=""):
+        with self._lock:
+            self._sync_version(version)
+            self._entries[uuid.uuid4().hex] = (
+                _normalize(embedding), payload, time.time() + self.ttl, scope)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class DjangoSemanticCache(SemanticCache):
+    """
+    Backed by a Django cache alias (e.g. Redis or Memcached) so hits are
+    shared across workers. Keys are namespaced by index version, so stale
+    entries simply expire after an ingest.
+
+    Each entry has its own key, in a ring of `max_entries` slots per scope:
+    an atomic counter hands out the slots, so concurrent workers never
+    overwrite each other's entries and the oldest entry is evicted first.
+    """
+
+    def __init__(self, alias=SEMANTIC_CACHE_ALIAS, **kwargs):
+        super().__init__(**kwargs)
+        self.alias = alias
+
+    @property
+    def _cache(self):
+        from django.core.cache import caches
+        return caches[self.alias]
+
+    def _counter_key(self, version, scope=""):
+        return f"semantic_cache:{version}:{scope}:counter"
+
+    def _slot_key(self, version, scope, slot):
+        return f"semantic_cache:{version}:{scope}:slot:{slot}"
+
+    def lookup(self, embedding, version, scope=""):
+        cache = self._cache
+        count = cache.get(self._counter_key(version, scope))
+        if not count:
+            return None
+
+        slots = cache.get_many(
+            [self._slot_key(version, scope, slot) for slot in range(min(count, self.max_entries))])
+        key, score = self._best_match(
+            embedding, [(k, np.asarray(vector, dtype=np.float32)) for k, (vector, _) in slots.items()])
+        if key is None or score < self.threshold:
+            return None
+        return slots[key][1]
+
+    def store(self, embedding, payload, version, scope=""):
+        cache = self._cache
+        counter = self._counter_key(version, scope)
+        # add() is a no-op when the counter exists; incr() is atomic on the backends
+        cache.add(counter, 0, self.ttl)
+        try:
+            count = cache.incr(counter)
+        except ValueError:
+            # The counter expired in between: start a new ring
+            cache.add(counter, 0, self.ttl)
+            count = cache.incr(counter)
+        cache.touch(counter, self.ttl)
+
+        slot = (count - 1) % self.max_entries
+        cache.set(self._slot_key(version, scope, slot),
+                  (_normalize(embedding).tolist(), payload), self.ttl)
+
+    def clear(self):
+        self._cache.clear()
+
+
+def get_semantic_cache(backend=SEMANTIC_CACHE_BACKEND):
+    if backend == "memory":
+        return InMemorySemanticCache()
+    if backend == "django":
+        return DjangoSemanticCache()
+    if backend in ("none", ""):
+        return NullSemanticCache()
+    raise ValueError(f"Unknown SEMANTIC_CACHE_BACKEND: {backend}")
@@ -0,0 +1,250 @@
+import os
+import re
+import logging
+from dotenv import load_dotenv
+from langchain_core.documents import Document
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# "structured" keeps code blocks and sections intact and measures tokens,
+# "recursive" is the original character-based splitter
+CHUNKERS = ("structured", "recursive")
+CHUNKER = os.getenv("CHUNKER", "structured")
+CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS", "256"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "32"))
+# Code blocks up to this size are never split, even if they exceed CHUNK_TOKENS
+CHUNK_MAX_CODE_TOKENS = int(os.getenv("CHUNK_MAX_CODE_TOKENS", "1024"))
+# "regex" (word / punctuation estimate, no download) or a tiktoken encoding such as "cl100k_base"
+CHUNK_TOKENIZER = os.getenv("CHUNK_TOKENIZER", "regex")
+
+# Used by the "recursive" chunker only (characters)
+CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "500"))
+CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "50"))
+
+HEADING = re.compile(r'^(#{1,6})\s+(.+?)\s*$')
+FENCE = re.compile(r'^\s*(```|~~~)')
+TOKEN = re.compile(r'\w+|[^\w\s]')
+SENTENCE_END = re.compile(r'(?<=[.!?:;])\s+')
+
+# Loaded once per process (ingest splits pages in worker processes)
+_encoder = None
+
+
+def _get_encoder():
+    global _encoder
+    if _encoder is None:
+        _encoder = False
+        if CHUNK_TOKENIZER != "regex":
+            try:
+                import tiktoken
+                _encoder = tiktoken.get_encoding(CHUNK_TOKENIZER)
+            except Exception as e:
+                logger.warning(f"Tokenizer '{CHUNK_TOKENIZER}' unavailable ({e}), estimating tokens instead")
+    return _encoder
+
+
+def count_tokens(text):
+    """Token count of `text` with CHUNK_TOKENIZER (regex estimate by default)."""
+    encoder = _get_encoder()
+    if encoder:
+        return len(encoder.encode(text, disallowed_special=()))
+    return len(TOKEN.findall(text))
+
+
+def parse_blocks(text):
+    """
+    Splits extracted page text into (kind, text, section path) blocks, kind
+    being "heading", "code" or "prose". Fenced code blocks are kept whole,
+    Markdown headings update the section path and prose breaks on blank lines.
+    """
+    blocks = []
+    path = []  # [(level, title)]
+    prose = []
+    code = None
+    fence = None
+
+    def flush_prose():
+        paragraph = '\n'.join(prose).strip()
+        if paragraph:
+            blocks.append(('prose', paragraph, tuple(title for _, title in path)))
+        prose.clear()
+
+    for line in text.splitlines():
+        if code is not None:
+            code.append(line)
+            if line.strip() == fence:
+                blocks.append(('code', '\n'.join(code), tuple(title for _, title in path)))
+                code = None
+            continue
+
+        fence_match = FENCE.match(line)
+        heading_match = HEADING.match(line)
+        if fence_match:
+            flush_prose()
+            code = [line]
+            fence = fence_match.group(1)
+        elif heading_match:
+            flush_prose()
+            level = len(heading_match.group(1))
+            path = [(lvl, title) for lvl, title in path if lvl < level]
+            path.append((level, heading_match.group(2)))
+            blocks.append(('heading', line.strip(), tuple(title for _, title in path)))
+        elif not line.strip():
+            flush_prose()
+        else:
+            prose.append(line)
+
+    flush_prose()
+    if code is not None:
+        # Unclosed fence: keep what was read as code
+        blocks.append(('code', '\n'.join(code), tuple(title for _, title in path)))
+    return blocks
+
+
+def _split_long(text, limit, separators):
+    """Splits `text` on the first separator that yields pieces of at most `limit` tokens."""
+    if count_tokens(text) <= limit or not separators:
+        return [text]
+
+    separator, rest = separators[0], separators[1:]
+    parts = separator.split(text) if isinstance(separator, re.Pattern) else text.split(separator)
+    joiner = ' ' if isinstance(separator, re.Pattern) else separator
+
+    pieces = []
+    current, size = [], 0
+    for part in parts:
+        tokens = count_tokens(part)
+        if tokens > limit:
+            if current:
+                pieces.append(joiner.join(current))
+                current, size = [], 0
+            pieces.extend(_split_long(part, limit, rest))
+            continue
+        if current and size + tokens > limit:
+            pieces.append(joiner.join(current))
+            current, size = [], 0
+        current.append(part)
+        size += tokens
+    if current:
+        pieces.append(joiner.join(current))
+    return [piece for piece in pieces if piece.strip()]
+
+
+def _block_pieces(kind, block, chunk_tokens, max_code_tokens):
+    """
+    Yields (kind, text, tokens, joiner) pieces of a block that fit in a chunk;
+    `joiner` separates the piece from the previous one in the same chunk.
+    """
+    tokens = count_tokens(block)
+    if kind == 'heading' or (kind == 'code' and tokens <= max_code_tokens) or tokens <= chunk_tokens:
+        yield kind, block, tokens, '\n\n'
+        return
+
+    if kind == 'code':
+        # Oversized code is split on blank lines / lines, each piece re-fenced
+        lines = block.split('\n')
+        opening = lines[0]
+        closing = lines[-1] if len(lines) > 1 and FENCE.match(lines[-1]) else FENCE.match(opening).group(1)
+        body = '\n'.join(lines[1:-1] if closing == lines[-1] else lines[1:])
+        limit = max(chunk_tokens - count_tokens(opening + closing), 1)
+        for piece in _split_long(body, limit, ['\n\n', '\n']):
+            fenced = f"{opening}\n{piece}\n{closing}"
+            yield kind, fenced, count_tokens(fenced), '\n\n'
+        return
+
+    # Oversized prose is packed sentence by sentence, so the overlap can carry whole sentences
+    joiner = '\n\n'
+    for line in block.split('\n'):
+        for sentence in SENTENCE_END.split(line):
+            for piece in _split_long(sentence, chunk_tokens, [' ']):
+                yield kind, piece, count_tokens(piece), joiner
+                joiner = ' '
+        joiner = '\n'
+
+
+def split_text(text, chunk_tokens=CHUNK_TOKENS, overlap_tokens=CHUNK_OVERLAP_TOKENS,
+               max_code_tokens=CHUNK_MAX_CODE_TOKENS):
+    """
+    Packs the blocks of `text` into chunks of about `chunk_tokens` tokens that
+    never cross a heading. Returns [(text, section path, is_code, tokens)].
+    Consecutive chunks of a section share up to `overlap_tokens` of trailing
+    prose; code is never repeated.
+    """
+    chunks = []
+    current = []  # [(kind, text, tokens, joiner)]
+    carried = 0   # leading pieces of `current` repeated from the previous chunk
+    section = None
+
+    def flush(overlap):
+        nonlocal current, carried
+        if len(current) > carried:
+            chunks.append((
+                current[0][1] + ''.join(joiner + piece for _, piece, _, joiner in current[1:]),
+                section,
+                any(kind == 'code' for kind, _, _, _ in current),
+                sum(tokens for _, _, tokens, _ in current),
+            ))
+        carry = []
+        if overlap:
+            size = 0
+            for kind, piece, tokens, joiner in reversed(current):
+                if kind != 'prose' or size + tokens > overlap_tokens:
+                    break
+                carry.insert(0, (kind, piece, tokens, joiner))
+                size += tokens
+        current, carried = carry, len(carry)
+
+    for kind, block, path in parse_blocks(text):
+        if path != section:
+            flush(overlap=False)
+            section = path
+        for piece in _block_pieces(kind, block, chunk_tokens, max_code_tokens):
+            size = sum(tokens for _, _, tokens, _ in current)
+            if current and size + piece[2] > chunk_tokens:
+                if len(current) == carried:
+                    # The overlap alone leaves no room: drop it
+                    current, carried = [], 0
+                else:
+                    flush(overlap=True)
+            current.append(piece)
+    flush(overlap=False)
+    return chunks
+
+
+def _recursive_splitter():
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+    return RecursiveCharacterTextSplitter(
+        chunk_size=CHUNK_SIZE,
+        chunk_overlap=CHUNK_OVERLAP,
+        separators=["\n\n", "\n", " ", ""],
+        length_function=len,
+    )
+
+
+def split_document(content, metadata, chunker=CHUNKER):
+    """
+    Splits a page into chunk Documents carrying `metadata` plus their position
+    (`chunk_index`), size (`tokens`) and, with the structured chunker, the
+    section path and a code flag. Module-level so it can run in a process pool.
+    """
+    if chunker == "recursive":
+        docs = _recursive_splitter().split_documents([Document(page_content=content, metadata=metadata)])
+        for i, doc in enumerate(docs):
+            doc.metadata.update({"chunk_index": i, "tokens": count_tokens(doc.page_content)})
+        return docs
+    if chunker != "structured":
+        raise ValueError(f"Unknown chunker '{chunker}'. Choose from: {', '.join(CHUNKERS)}")
+
+    return [
+        Document(page_content=text, metadata={
+            **metadata,
+            "section": " > ".join(path),
+            "is_code": is_code,
+            "chunk_index": i,
+            "tokens": tokens,
+        })
+        for i, (text, path, is_code, tokens) in enumerate(split_text(content))
+    ]
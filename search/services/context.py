@@ -0,0 +1,122 @@
+import os
+import re
+from dotenv import load_dotenv
+from langchain_core.documents import Document
+from .chunking import count_tokens
+
+load_dotenv()
+
+# Tokens of retrieved text sent to the LLM (the best chunk is always kept)
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+# Word-shingle Jaccard similarity above which a chunk is a near-duplicate of a kept one
+CONTEXT_DEDUP_THRESHOLD = float(os.getenv("CONTEXT_DEDUP_THRESHOLD", "0.8"))
+
+SHINGLE_SIZE = 3
+# Shorter suffix / prefix matches between adjacent chunks are treated as coincidence
+MIN_OVERLAP_CHARS = 8
+WORD = re.compile(r'\w+')
+
+
+def shingles(text, size=SHINGLE_SIZE):
+    words = WORD.findall(text.lower())
+    if len(words) < size:
+        return {tuple(words)}
+    return {tuple(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def jaccard(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def doc_tokens(doc):
+    """Token count recorded by the chunker, counted on the fly for older chunks."""
+    tokens = doc.metadata.get("tokens")
+    return tokens if tokens is not None else count_tokens(doc.page_content)
+
+
+def strip_overlap(previous, text):
+    """Drops the start of `text` that repeats the end of `previous` (chunk overlap)."""
+    for size in range(min(len(previous), len(text)), MIN_OVERLAP_CHARS - 1, -1):
+        if previous.endswith(text[:size]):
+            return text[size:].lstrip()
+    return text
+
+
+def select_chunks(docs, budget=CONTEXT_TOKEN_BUDGET, dedup_threshold=CONTEXT_DEDUP_THRESHOLD):
+    """
+    Greedy selection in rerank order: near-duplicates of an already selected
+    chunk are dropped, and chunks that do not fit in the remaining budget are
+    skipped in favour of smaller, lower-ranked ones.
+    """
+    selected = []
+    kept_shingles = []
+    used = 0
+    for doc in docs:
+        doc_shingles = shingles(doc.page_content)
+        if any(jaccard(doc_shingles, kept) >= dedup_threshold for kept in kept_shingles):
+            continue
+        tokens = doc_tokens(doc)
+        if selected and used + tokens > budget:
+            continue
+        selected.append(doc)
+        kept_shingles.append(doc_shingles)
+        used += tokens
+    return selected
+
+
+def merge_adjacent(docs):
+    """
+    Joins chunks that follow each other in the same page into one Document,
+    without the text they share. Groups keep the rank of their best chunk.
+    """
+    groups = []
+    by_position = {}
+    for doc in docs:
+        source = doc.metadata.get("source")
+        index = doc.metadata.get("chunk_index")
+        before = by_position.get((source, index - 1)) if index is not None else None
+        after = by_position.get((source, index + 1)) if index is not None else None
+        if before is not None and after is not None and before is not after:
+            # The chunk bridges two groups: fold the later one into the earlier
+            before.extend(after)
+            groups = [g for g in groups if g is not after]
+            for other in after:
+                by_position[(source, other.metadata["chunk_index"])] = before
+        group = before if before is not None else after
+        if group is None:
+            group = []
+            groups.append(group)
+        group.append(doc)
+        if index is not None:
+            by_position[(source, index)] = group
+
+    merged = []
+    for group in groups:
+        if len(group) == 1:
+            merged.append(group[0])
+            continue
+        group.sort(key=lambda d: d.metadata["chunk_index"])
+        text = group[0].page_content
+        previous = text
+        for doc in group[1:]:
+            text += "\n\n" + strip_overlap(previous, doc.page_content)
+            previous = doc.page_content
+        best = max(group, key=lambda d: d.metadata.get("relevance_score", 0))
+        merged.append(Document(
+            id=best.id,
+            page_content=text,
+            metadata={
+                **best.metadata,
+                "chunk_index": group[0].metadata["chunk_index"],
+                "merged_chunks": [d.metadata["chunk_index"] for d in group],
+                "tokens": count_tokens(text),
+            },
+        ))
+    return merged
+
+
+def pack_context(docs, budget=CONTEXT_TOKEN_BUDGET, dedup_threshold=CONTEXT_DEDUP_THRESHOLD):
+    """Reranked chunks -> the Documents actually sent to the LLM."""
+    return merge_adjacent(select_chunks(docs, budget, dedup_threshold))
@@ -0,0 +1,273 @@
+import os
+import time
+import asyncio
+import functools
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from langchain_ollama import ChatOllama, OllamaEmbeddings
+from langchain_community.vectorstores.utils import DistanceStrategy
+from langchain_core.prompts import ChatPromptTemplate, PromptTemplate
+from langchain_core.output_parsers import StrOutputParser
+from langchain_community.document_compressors import FlashrankRerank
+from langchain_core.documents import Document
+from .admission import (
+    AdmissionController, AdmittedEmbeddings, SingleFlight,
+    EMBED_MAX_CONCURRENCY, EMBED_MAX_QUEUE, LLM_MAX_CONCURRENCY, LLM_MAX_QUEUE,
+)
+from .cache import get_semantic_cache
+from .lexical import LexicalIndex, LEXICAL_INDEX_FILE
+from .rerank import CachedReranker, RERANKER
+from .ann import INDEX_META_FILE, configure_search, read_meta
+from .store import CHUNK_STORE_FILE, FAISS_INDEX_FILE, LEGACY_DOCSTORE_FILE, load_vector_store
+from .shards import ROUTER_FILE, read_router, shard_path
+from .prompts import get_template, CONDENSE_QUESTION_TEMPLATE, HYDE_TEMPLATE, CONDENSE_AND_HYDE_TEMPLATE
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+MODEL_NAME = os.getenv("MODEL_NAME")
+LLM_MODEL = os.getenv("LLM_MODEL")
+TEMPERATURE = float(os.getenv("TEMPERATURE", "0.05"))
+RERANK_MODEL = os.getenv("RERANK_MODEL", "ms-marco-MiniLM-L-12-v2")
+RETRIEVAL_K = int(os.getenv("RETRIEVAL_K", "10"))
+RERANK_TOP_N = int(os.getenv("RERANK_TOP_N", "5"))
+
+# Hybrid retrieval: BM25 fused with dense results through Reciprocal Rank Fusion
+HYBRID_SEARCH = os.getenv("HYBRID_SEARCH", "true").lower() == "true"
+RRF_K = int(os.getenv("RRF_K", "60"))
+
+# Adaptive query expansion: "always" runs HyDE, "adaptive" only when direct
+# retrieval is not confident, "race" runs both and cancels HyDE if direct wins
+# (async pipeline only; the sync pipeline treats it as "adaptive")
+HYDE_MODE = os.getenv("HYDE_MODE", "adaptive")
+HYDE_MIN_SCORE = float(os.getenv("HYDE_MIN_SCORE", "0.75"))
+HYDE_MIN_MARGIN = float(os.getenv("HYDE_MIN_MARGIN", "0.0"))
+
+# Follow-up questions: "combined" condenses and writes the HyDE passage in a
+# single LLM call, "sequential" uses one call for each
+QUERY_PLAN = os.getenv("QUERY_PLAN", "combined")
+
+# Bounded pool for blocking work (FAISS search, FlashRank scoring) issued from async code
+THREAD_POOL_SIZE = int(os.getenv("RAG_THREAD_POOL_SIZE", "4"))
+
+# Minimum number of seconds between two mtime checks of the vector DB files
+RELOAD_CHECK_INTERVAL = float(os.getenv("RAG_RELOAD_CHECK_INTERVAL", "2"))
+
+BASE_DIR = os.path.dirname(os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__))))
+DB_PATH = os.path.join(BASE_DIR, "data", "vector_db")
+
+# Shards are only reloaded when `ingest` rewrites the router; the other files
+# belong to an unsharded store at the root of the vector DB
+INDEX_FILES = (ROUTER_FILE, FAISS_INDEX_FILE, CHUNK_STORE_FILE, LEGACY_DOCSTORE_FILE,
+               LEXICAL_INDEX_FILE, INDEX_META_FILE)
+
+
+class RagEngine:
+    """
+    Long-lived container for everything the RAG pipeline needs:
+    embeddings, LLM, reranker, prompt chains and the FAISS index shards.
+
+    Models and chains are built once; the index is reloaded lazily
+    whenever the files under `db_path` change on disk (e.g. after `ingest`).
+    """
+
+    def __init__(self, db_path=DB_PATH):
+        self.db_path = db_path
+
+        # 1. Models
+        # Calls to each Ollama model are bounded; saturated models reject new requests
+        self.embed_admission = AdmissionController(MODEL_NAME, EMBED_MAX_CONCURRENCY, EMBED_MAX_QUEUE)
+        self.llm_admission = AdmissionController(LLM_MODEL, LLM_MAX_CONCURRENCY, LLM_MAX_QUEUE)
+        self.embeddings = AdmittedEmbeddings(OllamaEmbeddings(model=MODEL_NAME), self.embed_admission)
+        self.llm = ChatOllama(model=LLM_MODEL, temperature=TEMPERATURE)
+        if RERANKER == "cached":
+            self.compressor = CachedReranker(RERANK_MODEL, top_n=RERANK_TOP_N)
+        else:
+            self.compressor = FlashrankRerank(model=RERANK_MODEL, top_n=RERANK_TOP_N)
+
+        # 2. Chains
+        # Inputs are pre-formatted strings so the chains are reusable across requests
+        self.condense_chain = (
+            PromptTemplate.from_template(CONDENSE_QUESTION_TEMPLATE)
+            | self.llm
+            | StrOutputParser()
+        )
+        self.hyde_generator = (
+            PromptTemplate.from_template(HYDE_TEMPLATE)
+            | self.llm
+            | StrOutputParser()
+        )
+        self.condense_hyde_chain = (
+            PromptTemplate.from_template(CONDENSE_AND_HYDE_TEMPLATE)
+            | self.llm
+            | StrOutputParser()
+        )
+        self.answer_chain = (
+            ChatPromptTemplate.from_template(get_template())
+            | self.llm
+            | StrOutputParser()
+        )
+
+        # 3. Worker pool for CPU-bound stages called from the async pipeline
+        self.executor = ThreadPoolExecutor(
+            max_workers=THREAD_POOL_SIZE, thread_name_prefix="rag")
+
+        # 4. Semantic answer cache (entries are tagged with `index_version`), and
+        # coalescing of identical queries that are still being answered
+        self.answer_cache = get_semantic_cache()
+        self.flights = SingleFlight()
+
+        # 5. Index (loaded on first access)
+        self._lock = threading.Lock()
+        self._shards = None  # key -> (vector_db, lexical index)
+        self._router = None
+        self._index_mtime = None
+        self._last_check = 0.0
+
+    def _current_mtime(self):
+        mtimes = []
+        for name in INDEX_FILES:
+            path = os.path.join(self.db_path, name)
+            if os.path.exists(path):
+                mtimes.append(os.path.getmtime(path))
+        return max(mtimes) if mtimes else None
+
+    def _load_index(self, mtime):
+        router = read_router(self.db_path)
+        if router is None:
+            # Vector DB built before sharding: a single store at the root
+            paths = {"all": self.db_path}
+        else:
+            paths = {key: shard_path(self.db_path, key) for key in router.keys}
+
+        shards = {}
+        for key, path in paths.items():
+            # Memory-mapped: worker processes share the index through the page cache
+            vector_db = load_vector_store(path, self.embeddings)
+            # nprobe / efSearch for approximate index types
+            configure_search(vector_db.index)
+            lexical = LexicalIndex.load(path) if HYBRID_SEARCH else None
+            shards[key] = (vector_db, lexical)
+            logger.info(f"Shard {key} ({read_meta(path)['index_type']}) loaded from {path}")
+
+        self._shards = shards
+        self._router = router
+        self._index_mtime = mtime
+
+    def _ensure_index(self):
+        now = time.monotonic()
+        if self._shards is not None and now - self._last_check < RELOAD_CHECK_INTERVAL:
+            return
+
+        with self._lock:
+            self._last_check = now
+            mtime = self._current_mtime()
+            if mtime is None:
+                raise FileNotFoundError(f"Vector DB not found at {self.db_path}")
+            if self._shards is not None and mtime == self._index_mtime:
+                return
+            try:
+                self._load_index(mtime)
+            except Exception:
+                # Files may be mid-write by `ingest`; keep serving the old index
+                if self._shards is None:
+                    raise
+                logger.warning("Vector DB reload failed, keeping previous index", exc_info=True)
+
+    @property
+    def shards(self):
+        self._ensure_index()
+        return self._shards
+
+    def libraries(self):
+        """{library: [versions]} of the indexed shards ({} before sharding)."""
+        self._ensure_index()
+        return self._router.libraries() if self._router is not None else {}
+
+    def route(self, embedding=None, library=None, version=None):
+        """
+        Keys of the shards to search: those matching the library / version
+        filter, otherwise the shards whose centroids are closest to `embedding`.
+        """
+        shards = self.shards
+        router = self._router
+        if router is None or (embedding is None and not (library or version)):
+            return list(shards)
+
+        keys = router.route(embedding, library=library, version=version)
+        if not keys:
+            raise ValueError(f"No indexed documentation for {library or ''} {version or ''}".strip())
+        return keys
+
+    def _selected(self, keys):
+        shards = self.shards
+        return [shards[key] for key in (keys if keys is not None else shards) if key in shards]
+
+    def dense_search(self, embedding, k=RETRIEVAL_K, shards=None):
+        """
+        Vector search over `shards` (all by default) returning
+        (doc, cosine similarity) pairs, best first.
+        """
+        scored = []
+        for vector_db, _ in self._selected(shards):
+            results = vector_db.similarity_search_with_score_by_vector(embedding, k=k)
+            if vector_db.distance_strategy == DistanceStrategy.MAX_INNER_PRODUCT:
+                scored.extend((doc, float(score)) for doc, score in results)
+            else:
+                # Squared L2 between unit vectors: d = 2 - 2 * cos
+                scored.extend((doc, 1.0 - float(score) / 2.0) for doc, score in results)
+        scored.sort(key=lambda item: item[1], reverse=True)
+        return scored[:k]
+
+    def lexical_search(self, query, k=RETRIEVAL_K, shards=None):
+        """BM25 search over `shards`; returns [] when no lexical index was built."""
+        hits = []
+        for vector_db, lexical in self._selected(shards):
+            if lexical is None:
+                continue
+            for doc_id, score in lexical.search(query, k):
+                hits.append((score, doc_id, vector_db))
+
+        docs = []
+        for _, doc_id, vector_db in sorted(hits, key=lambda hit: hit[0], reverse=True)[:k]:
+            doc = vector_db.docstore.search(doc_id)
+            # The docstore returns a message string for unknown IDs
+            if isinstance(doc, Document):
+                docs.append(doc)
+        return docs
+
+    @property
+    def index_version(self):
+        """Identifier of the index currently on disk (changes on every ingest)."""
+        return self._current_mtime()
+
+    async def run_blocking(self, func, *args, **kwargs):
+        """Runs a blocking callable on the engine's bounded thread pool."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(func, *args, **kwargs))
+
+    def warm(self):
+        """Loads the index eagerly if it exists."""
+        try:
+            self._ensure_index()
+        except FileNotFoundError:
+            logger.warning(f"Vector DB not found at {self.db_path}, skipping warm-up")
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """Returns the process-wide RagEngine, creating it on first use."""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = RagEngine()
+    return _engine
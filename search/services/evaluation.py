@@ -0,0 +1,186 @@
+import os
+import json
+import math
+import time
+import sqlite3
+import hashlib
+import threading
+from urllib.parse import urldefrag
+from dotenv import load_dotenv
+from . import ann, context, engine, prompts, rerank, shards
+
+load_dotenv()
+
+# Generated answers and scores of `evaluate`, stored next to the vector DB
+EVAL_CACHE_NAME = os.getenv("EVAL_CACHE_NAME", "eval_cache.sqlite3")
+EVAL_CACHE_PATH = os.path.join(os.path.dirname(engine.DB_PATH), EVAL_CACHE_NAME)
+
+
+def load_dataset(path):
+    """
+    Evaluation records from a JSONL file (a "question" or, as in a backlog
+    file, a "title" field) or a text file with one question per line.
+    Every record gets a "question" key; other fields are kept.
+    """
+    records = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line) if line.startswith('{') else {'question': line}
+            question = (record.get('question') or record.get('title') or '').strip()
+            if question:
+                records.append({**record, 'question': question})
+    return records
+
+
+def load_questions(path):
+    return [record['question'] for record in load_dataset(path)]
+
+
+def relevant_urls(record):
+    """Labeled relevant pages of a retrieval record ("relevant", "relevant_urls" or "urls")."""
+    urls = record.get('relevant') or record.get('relevant_urls') or record.get('urls') or []
+    if isinstance(urls, str):
+        urls = [urls]
+    return {normalize_url(url) for url in urls}
+
+
+def normalize_url(url):
+    return urldefrag(url.strip())[0].rstrip('/')
+
+
+def ranked_sources(docs):
+    """Distinct source pages of ranked chunks, in rank order (page-level relevance)."""
+    sources = []
+    for doc in docs:
+        source = normalize_url(doc.metadata.get('source', ''))
+        if source not in sources:
+            sources.append(source)
+    return sources
+
+
+def recall_at_k(sources, relevant, k):
+    return len(set(sources[:k]) & relevant) / len(relevant) if relevant else 0.0
+
+
+def reciprocal_rank(sources, relevant, k):
+    for rank, source in enumerate(sources[:k], start=1):
+        if source in relevant:
+            return 1.0 / rank
+    return 0.0
+
+
+def ndcg_at_k(sources, relevant, k):
+    """Binary-gain nDCG: relevant pages found early score higher."""
+    dcg = sum(1.0 / math.log2(rank + 1)
+              for rank, source in enumerate(sources[:k], start=1) if source in relevant)
+    ideal = sum(1.0 / math.log2(rank + 1) for rank in range(1, min(len(relevant), k) + 1))
+    return dcg / ideal if ideal else 0.0
+
+
+def pipeline_config():
+    """Settings that change what the pipeline answers for a given index."""
+    return {
+        "model_name": engine.MODEL_NAME,
+        "llm_model": engine.LLM_MODEL,
+        "temperature": engine.TEMPERATURE,
+        "rerank_model": engine.RERANK_MODEL,
+        "reranker": rerank.RERANKER,
+        "retrieval_k": engine.RETRIEVAL_K,
+        "rerank_top_n": engine.RERANK_TOP_N,
+        "hybrid_search": engine.HYBRID_SEARCH,
+        "rrf_k": engine.RRF_K,
+        "hyde_mode": engine.HYDE_MODE,
+        "hyde_min_score": engine.HYDE_MIN_SCORE,
+        "hyde_min_margin": engine.HYDE_MIN_MARGIN,
+        "query_plan": engine.QUERY_PLAN,
+        "router_top_shards": shards.ROUTER_TOP_SHARDS,
+        "faiss_nprobe": ann.FAISS_NPROBE,
+        "faiss_ef_search": ann.FAISS_EF_SEARCH,
+        "context_token_budget": context.CONTEXT_TOKEN_BUDGET,
+        "context_dedup_threshold": context.CONTEXT_DEDUP_THRESHOLD,
+        "prompts": [prompts.get_template(), prompts.HYDE_TEMPLATE,
+                    prompts.CONDENSE_QUESTION_TEMPLATE, prompts.CONDENSE_AND_HYDE_TEMPLATE],
+    }
+
+
+def config_hash(config=None):
+    config = pipeline_config() if config is None else config
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def passage_key(question):
+    """HyDE passages depend on the question, the LLM and the HyDE prompt only."""
+    return generation_key(question, engine.LLM_MODEL, f"{engine.TEMPERATURE}|{prompts.HYDE_TEMPLATE}")
+
+
+def generation_key(question, index_version, config):
+    digest = hashlib.sha256()
+    for part in (question, str(index_version), config):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class EvaluationCache:
+    """
+    Generations keyed by (question, index version, config hash), their
+    metric scores per evaluator model and the HyDE passages used by
+    `benchmark_retrieval`, in a single SQLite file. Rows are written as soon
+    as they are produced, so an interrupted run resumes.
+    """
+
+    def __init__(self, path=EVAL_CACHE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS generations ("
+            "key TEXT PRIMARY KEY, question TEXT NOT NULL, index_version TEXT NOT NULL, "
+            "config_hash TEXT NOT NULL, record TEXT NOT NULL, created_at REAL NOT NULL)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS scores ("
+            "key TEXT NOT NULL, evaluator TEXT NOT NULL, scores TEXT NOT NULL, "
+            "PRIMARY KEY (key, evaluator))")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS passages (key TEXT PRIMARY KEY, passage TEXT NOT NULL)")
+        self._conn.commit()
+
+    def get_generation(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT record FROM generations WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put_generation(self, key, question, index_version, config, record):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO generations VALUES (?, ?, ?, ?, ?, ?)",
+                (key, question, str(index_version), config, json.dumps(record), time.time()))
+            self._conn.commit()
+
+    def get_scores(self, key, evaluator):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT scores FROM scores WHERE key = ? AND evaluator = ?", (key, evaluator)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put_scores(self, key, evaluator, scores):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO scores VALUES (?, ?, ?)", (key, evaluator, json.dumps(scores)))
+            self._conn.commit()
+
+    def get_passage(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT passage FROM passages WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def put_passage(self, key, passage):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO passages VALUES (?, ?)", (key, passage))
+            self._conn.commit()
+
+    def close(self):
+        self._conn.close()
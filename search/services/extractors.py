@@ -0,0 +1,162 @@
+import os
+import re
+from urllib.parse import urljoin
+from dotenv import load_dotenv
+
+load_dotenv()
+
+SCRAPE_PARSER = os.getenv("SCRAPE_PARSER", "lxml")
+
+BOILERPLATE_TAGS = {'script', 'style', 'nav', 'footer', 'header', 'aside', 'iframe', 'noscript', 'head'}
+HEADING_TAGS = {'h1': 1, 'h2': 2, 'h3': 3, 'h4': 4, 'h5': 5, 'h6': 6}
+BLOCK_TAGS = {
+    'address', 'article', 'blockquote', 'body', 'dd', 'details', 'div', 'dl', 'dt',
+    'figcaption', 'figure', 'form', 'hr', 'li', 'main', 'ol', 'p', 'section',
+    'summary', 'table', 'tbody', 'td', 'th', 'thead', 'tr', 'ul', 'br',
+}
+
+LANGUAGE_CLASS = re.compile(r'(?:language|lang|highlight)-([\w+#-]+)')
+WHITESPACE = re.compile(r'\s+')
+
+
+def _code_language(element):
+    """Guesses the language of a <pre> from its (or its parent's) CSS classes."""
+    for el in (element, element.getparent()):
+        if el is None:
+            continue
+        match = LANGUAGE_CLASS.search(el.get('class', ''))
+        if match and match.group(1) not in ('default', 'none'):
+            return match.group(1)
+    return ''
+
+
+class _TextBuilder:
+    """Collects inline text into lines and lines into blocks."""
+
+    def __init__(self):
+        self.blocks = []
+        self._line = []
+
+    def inline(self, text):
+        self._line.append(text)
+
+    def flush(self):
+        line = WHITESPACE.sub(' ', ''.join(self._line)).strip()
+        if line:
+            self.blocks.append(line)
+        self._line = []
+
+    def block(self, text):
+        self.flush()
+        self.blocks.append(text)
+
+    def text(self):
+        self.flush()
+        return '\n\n'.join(self.blocks)
+
+
+def extract_lxml(html, url, fetch_links=True):
+    """
+    Single-pass extractor on top of lxml.
+    Boilerplate subtrees are skipped while walking, headings become Markdown
+    headings and <pre> blocks become fenced code blocks, so the chunker can
+    keep them intact.
+    """
+    import lxml.html
+    from lxml.etree import ParserError
+
+    # Most docs are UTF-8; without a <meta charset> libxml2 would assume Latin-1
+    if isinstance(html, bytes):
+        try:
+            html = html.decode('utf-8')
+        except UnicodeDecodeError:
+            pass
+
+    try:
+        try:
+            tree = lxml.html.fromstring(html)
+        except ValueError:
+            # Unicode input with an XML encoding declaration: let lxml decode the bytes
+            tree = lxml.html.fromstring(html.encode('utf-8'))
+    except ParserError:
+        return {'title': 'Untitled', 'content': '', 'code_count': 0, 'links': []}
+
+    title = (tree.findtext('.//title') or '').strip() or 'Untitled'
+    body = tree.find('.//body')
+    out = _TextBuilder()
+    links = []
+    code_count = 0
+
+    def walk(el):
+        nonlocal code_count
+        tag = el.tag.lower() if isinstance(el.tag, str) else None
+
+        if tag is None or tag in BOILERPLATE_TAGS:
+            # Comments, processing instructions and boilerplate: keep only the tail
+            if el.tail:
+                out.inline(el.tail)
+            return
+
+        if tag == 'a' and fetch_links and el.get('href'):
+            links.append(urljoin(url, el.get('href')))
+
+        if tag == 'pre':
+            code = el.text_content().strip('\n')
+            if code.strip():
+                out.block(f"```{_code_language(el)}\n{code}\n```")
+                code_count += 1
+        elif tag in HEADING_TAGS:
+            heading = WHITESPACE.sub(' ', el.text_content()).strip().rstrip('¶').strip()
+            if heading:
+                out.block(f"{'#' * HEADING_TAGS[tag]} {heading}")
+        else:
+            is_block = tag in BLOCK_TAGS
+            if is_block:
+                out.flush()
+            if el.text:
+                out.inline(el.text)
+            for child in el:
+                walk(child)
+            if is_block:
+                out.flush()
+
+        if el.tail:
+            out.inline(el.tail)
+
+    walk(body if body is not None else tree)
+
+    return {'title': title, 'content': out.text(), 'code_count': code_count, 'links': links}
+
+
+def extract_html_parser(html, url, fetch_links=True):
+    """Original BeautifulSoup + html.parser extractor (pure Python, slower)."""
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, 'html.parser')
+    for tag in soup(['script', 'style', 'nav', 'footer', 'header', 'aside', 'iframe', 'noscript']):
+        tag.decompose()
+
+    title = soup.title.string.strip() if soup.title and soup.title.string else "Untitled"
+    text = soup.get_text(separator='\n', strip=True)
+    code_blocks = len(soup.find_all('pre'))
+    links = [urljoin(url, a['href']) for a in soup.find_all('a', href=True)] if fetch_links else []
+
+    return {'title': title, 'content': text, 'code_count': code_blocks, 'links': links}
+
+
+EXTRACTORS = {
+    'lxml': extract_lxml,
+    'html.parser': extract_html_parser,
+}
+
+
+def extract(html, url, parser=SCRAPE_PARSER, fetch_links=True):
+    """
+    Extracts title, cleaned text, code block count and outgoing links from raw HTML.
+    Module-level so it can run in a process pool.
+    """
+    try:
+        extractor = EXTRACTORS[parser]
+    except KeyError:
+        raise ValueError(f"Unknown parser '{parser}'. Choose from: {', '.join(EXTRACTORS)}")
+    return extractor(html, url, fetch_links)
@@ -0,0 +1,182 @@
+import json
+import time
+import random
+import hashlib
+import threading
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from .chunking import count_tokens
+
+# Vocabulary of the generated answers
+WORDS = (
+    "session", "engine", "query", "select", "model", "column", "mapped", "relationship",
+    "commit", "async", "await", "execute", "result", "table", "index", "connection",
+    "the", "a", "to", "with", "use", "and", "returns", "object", "call", "new", "instead",
+)
+
+
+def fake_embedding(text, dim):
+    """Deterministic unit vector for `text` (same text, same vector)."""
+    seed = int.from_bytes(hashlib.sha1(text.encode("utf-8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(dim)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+def fake_tokens(prompt, n_tokens):
+    """Deterministic answer tokens for `prompt`."""
+    rng = random.Random(hashlib.sha1(prompt.encode("utf-8")).hexdigest())
+    return [("" if i == 0 else " ") + rng.choice(WORDS) for i in range(n_tokens)]
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    """
+    The subset of the Ollama HTTP API used by langchain-ollama:
+    /api/embed, /api/embeddings and /api/chat (streamed as NDJSON or not).
+    """
+
+    protocol_version = "HTTP/1.1"
+    # Streamed tokens are tiny writes: send them at once, like Ollama does
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == "/api/tags":
+            self._json({"models": [{"name": "fake", "model": "fake"}]})
+        elif self.path == "/api/version":
+            self._json({"version": "0.0.0-fake"})
+        else:
+            self._send(200, b"Ollama is running", "text/plain")
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length) or b"{}")
+        if self.path == "/api/embed":
+            self._embed(body)
+        elif self.path == "/api/embeddings":
+            fake = self.server.fake
+            time.sleep(fake.embed_ms / 1000)
+            self._json({"embedding": fake_embedding(body.get("prompt", ""), fake.dim)})
+        elif self.path == "/api/chat":
+            self._chat(body)
+        elif self.path == "/api/show":
+            self._json({"modelfile": "", "parameters": "", "template": "", "details": {}, "capabilities": ["completion"]})
+        else:
+            self._json({"error": f"unknown endpoint {self.path}"}, status=404)
+
+    def _embed(self, body):
+        fake = self.server.fake
+        texts = body.get("input", [])
+        if isinstance(texts, str):
+            texts = [texts]
+        time.sleep(fake.embed_ms / 1000)
+        self._json({
+            "model": body.get("model", "fake"),
+            "embeddings": [fake_embedding(text, fake.dim) for text in texts],
+        })
+
+    def _chat(self, body):
+        fake = self.server.fake
+        model = body.get("model", "fake")
+        prompt = "\n".join(message.get("content") or "" for message in body.get("messages", []))
+        prompt_tokens = count_tokens(prompt)
+        tokens = fake_tokens(prompt, fake.tokens)
+        started = time.perf_counter()
+
+        # Prefill cost grows with the prompt, like a real model
+        time.sleep((fake.ttft_ms + fake.prefill_ms_per_1k * prompt_tokens / 1000) / 1000)
+
+        def final(content):
+            return {
+                "model": model, "created_at": _now(),
+                "message": {"role": "assistant", "content": content},
+                "done": True, "done_reason": "stop",
+                "total_duration": int((time.perf_counter() - started) * 1e9),
+                "load_duration": 0,
+                "prompt_eval_count": prompt_tokens,
+                "eval_count": len(tokens),
+            }
+
+        if body.get("stream") is False:
+            time.sleep(fake.token_ms * len(tokens) / 1000)
+            self._json(final("".join(tokens)))
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for i, token in enumerate(tokens):
+                if i:
+                    time.sleep(fake.token_ms / 1000)
+                self._chunk({
+                    "model": model, "created_at": _now(),
+                    "message": {"role": "assistant", "content": token}, "done": False,
+                })
+            self._chunk(final(""))
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client stopped reading (e.g. a cancelled HyDE race)
+            self.close_connection = True
+
+    def _chunk(self, payload):
+        data = json.dumps(payload).encode("utf-8") + b"\n"
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _json(self, payload, status=200):
+        self._send(status, json.dumps(payload).encode("utf-8"), "application/json")
+
+    def _send(self, status, data, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FakeOllamaServer:
+    """
+    Local stand-in for Ollama with deterministic outputs and configurable
+    latencies, so the pipeline can be load-tested without a GPU. Point the
+    clients at it with OLLAMA_HOST=<url> before the engine is created.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, dim=768, embed_ms=5.0, ttft_ms=50.0,
+                 prefill_ms_per_1k=20.0, token_ms=10.0, tokens=64):
+        # `dim` must match the vector index that is searched
+        self.dim = dim
+        self.embed_ms = embed_ms
+        self.ttft_ms = ttft_ms
+        self.prefill_ms_per_1k = prefill_ms_per_1k
+        self.token_ms = token_ms
+        self.tokens = tokens
+
+        self.httpd = ThreadingHTTPServer((host, port), FakeOllamaHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.fake = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True, name="fake-ollama")
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
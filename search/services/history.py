@@ -0,0 +1,60 @@
+import os
+from dotenv import load_dotenv
+from ..models import Conversation, Turn
+
+load_dotenv()
+
+# Previous turns given to the condense step
+CHAT_HISTORY_TURNS = int(os.getenv("CHAT_HISTORY_TURNS", "3"))
+
+SESSION_KEY = 'conversation_id'
+# Sessions from before the Conversation model kept every turn here
+LEGACY_SESSION_KEY = 'chat_history'
+
+
+def get_conversation_id(session):
+    """ID of the session's Conversation, created on first use."""
+    session.pop(LEGACY_SESSION_KEY, None)
+    conversation_id = session.get(SESSION_KEY)
+    if conversation_id is None or not Conversation.objects.filter(pk=conversation_id).exists():
+        conversation_id = Conversation.objects.create().pk
+        session[SESSION_KEY] = conversation_id
+    return conversation_id
+
+
+def _window(conversation_id, turns):
+    return (Turn.objects.filter(conversation_id=conversation_id)
+            .order_by('-id').values_list('condensed_query', 'answer')[:turns])
+
+
+def load_history(conversation_id, turns=CHAT_HISTORY_TURNS):
+    """
+    The last `turns` turns as (query, answer) pairs, oldest first. Each query is
+    the standalone one the turn was answered for.
+    """
+    return list(reversed(_window(conversation_id, turns)))
+
+
+def add_turn(conversation_id, question, result):
+    return Turn.objects.create(
+        conversation_id=conversation_id, question=question,
+        condensed_query=result.get('effective_query') or question, answer=result['answer'])
+
+
+async def aget_conversation_id(session):
+    await session.apop(LEGACY_SESSION_KEY, None)
+    conversation_id = await session.aget(SESSION_KEY)
+    if conversation_id is None or not await Conversation.objects.filter(pk=conversation_id).aexists():
+        conversation_id = (await Conversation.objects.acreate()).pk
+        await session.aset(SESSION_KEY, conversation_id)
+    return conversation_id
+
+
+async def aload_history(conversation_id, turns=CHAT_HISTORY_TURNS):
+    return list(reversed([row async for row in _window(conversation_id, turns)]))
+
+
+async def aadd_turn(conversation_id, question, result):
+    return await Turn.objects.acreate(
+        conversation_id=conversation_id, question=question,
+        condensed_query=result.get('effective_query') or question, answer=result['answer'])
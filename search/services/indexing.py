@@ -0,0 +1,128 @@
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from .ann import FAISS_TRAIN_SIZE, create_index, needs_training
+
+
+class EmbeddingBatch:
+    """A slice of chunks embedded and committed to the index as one unit."""
+
+    def __init__(self, ids, texts, metadatas):
+        self.ids = ids
+        self.texts = texts
+        self.metadatas = metadatas
+
+    def __len__(self):
+        return len(self.ids)
+
+
+def make_batches(ids, docs, batch_size):
+    for start in range(0, len(ids), batch_size):
+        batch_docs = docs[start:start + batch_size]
+        yield EmbeddingBatch(
+            ids[start:start + batch_size],
+            [d.page_content for d in batch_docs],
+            [d.metadata for d in batch_docs],
+        )
+
+
+class IndexWriter:
+    """
+    Appends embedded batches to a FAISS store, creating it on the first batch.
+
+    Index types other than flat are created from a trained FAISS index: the
+    first batches are buffered until `train_size` vectors are available (or
+    `flush()` is called), used as the training sample, then added.
+    `add()` and `flush()` return the batches actually committed to the store.
+    """
+
+    def __init__(self, embeddings, vector_db=None, index_type="flat", factory="Flat",
+                 expected_total=0, train_size=FAISS_TRAIN_SIZE):
+        self.embeddings = embeddings
+        self.vector_db = vector_db
+        self.index_type = index_type
+        self.factory = factory
+        self.expected_total = expected_total
+        self.train_size = train_size
+        self._buffer = []
+        self._buffered = 0
+
+    def add(self, batch, vectors):
+        if self.vector_db is None and self.index_type != "flat":
+            self._buffer.append((batch, vectors))
+            self._buffered += len(batch)
+            if self._buffered >= self.train_size or not needs_training(self.index_type):
+                return self.flush()
+            return []
+
+        text_embeddings = list(zip(batch.texts, vectors))
+        if self.vector_db is None:
+            self.vector_db = FAISS.from_embeddings(
+                text_embeddings, self.embeddings, metadatas=batch.metadatas, ids=batch.ids)
+        else:
+            self.vector_db.add_embeddings(
+                text_embeddings, metadatas=batch.metadatas, ids=batch.ids)
+        return [batch]
+
+    def flush(self):
+        """Creates the store from the buffered batches (training on them if needed)."""
+        if not self._buffer:
+            return []
+
+        sample = np.array([v for _, vectors in self._buffer for v in vectors], dtype=np.float32)
+        index, self.index_type, self.factory = create_index(
+            self.index_type, sample, max(self.expected_total, len(sample)))
+        self.vector_db = FAISS(
+            embedding_function=self.embeddings,
+            index=index,
+            docstore=InMemoryDocstore(),
+            index_to_docstore_id={},
+        )
+
+        buffered, self._buffer, self._buffered = self._buffer, [], 0
+        for batch, vectors in buffered:
+            self.add(batch, vectors)
+        return [batch for batch, _ in buffered]
+
+
+def embed_batches(embeddings, batches, workers, on_batch, max_in_flight=None):
+    """
+    Embeds `batches` on `workers` threads and calls `on_batch(batch, vectors)`
+    in the caller's thread as each one finishes (FAISS writes are not thread-safe).
+
+    At most `max_in_flight` batches are submitted at once, so a slow embedder
+    applies backpressure instead of queueing the whole corpus in memory.
+    On failure, no new batch is submitted; batches already running are still
+    committed, then the first error is raised.
+    """
+    max_in_flight = max_in_flight or workers * 2
+    batches = iter(batches)
+    error = None
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="embed") as executor:
+        in_flight = {}
+
+        def submit_next():
+            batch = next(batches, None)
+            if batch is not None:
+                in_flight[executor.submit(embeddings.embed_documents, batch.texts)] = batch
+
+        for _ in range(max_in_flight):
+            submit_next()
+
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                batch = in_flight.pop(future)
+                try:
+                    vectors = future.result()
+                except Exception as e:
+                    error = error or e
+                    continue
+                on_batch(batch, vectors)
+                if error is None:
+                    submit_next()
+
+    if error is not None:
+        raise error
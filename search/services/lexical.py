@@ -0,0 +1,143 @@
+import os
+import re
+from collections import Counter
+import numpy as np
+
+LEXICAL_INDEX_FILE = "lexical.npz"
+
+TOKEN = re.compile(r"[A-Za-z_][A-Za-z0-9_]*|\d+")
+
+
+def tokenize(text):
+    """
+    Lowercased identifier-aware tokens.
+    Snake-case names are kept whole and also split, so `mapped_column`
+    matches both `mapped_column` and `column`.
+    """
+    tokens = []
+    for token in TOKEN.findall(text.lower()):
+        tokens.append(token)
+        if "_" in token:
+            tokens.extend(part for part in token.split("_") if part)
+    return tokens
+
+
+class LexicalIndex:
+    """
+    Okapi BM25 over a prebuilt inverted index.
+    Postings are stored CSR-style in flat numpy arrays: the postings of term
+    `t` are `doc_idx[indptr[t]:indptr[t + 1]]` with term frequencies in `tf`.
+    """
+
+    def __init__(self, doc_ids, terms, indptr, doc_idx, tf, doc_len, k1=1.5, b=0.75):
+        self.doc_ids = list(doc_ids)
+        self.vocab = {term: i for i, term in enumerate(terms)}
+        self.terms = list(terms)
+        self.indptr = indptr
+        self.doc_idx = doc_idx
+        self.tf = tf
+        self.doc_len = doc_len
+        self.k1 = k1
+        self.b = b
+
+        n_docs = len(self.doc_ids)
+        df = np.diff(indptr).astype(np.float32)
+        self.idf = np.log((n_docs - df + 0.5) / (df + 0.5) + 1.0).astype(np.float32)
+        avg_len = float(doc_len.mean()) if n_docs else 0.0
+        # Per-document length normalization, precomputed once
+        self.norm = (k1 * (1 - b + b * doc_len / avg_len)).astype(np.float32) if n_docs else doc_len
+
+    @classmethod
+    def build(cls, doc_ids, texts, **kwargs):
+        postings = {}
+        doc_len = np.zeros(len(doc_ids), dtype=np.float32)
+        for i, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            doc_len[i] = sum(counts.values())
+            for term, count in counts.items():
+                postings.setdefault(term, []).append((i, count))
+
+        terms = sorted(postings)
+        indptr = np.zeros(len(terms) + 1, dtype=np.int64)
+        for t, term in enumerate(terms):
+            indptr[t + 1] = indptr[t] + len(postings[term])
+
+        doc_idx = np.empty(indptr[-1], dtype=np.int32)
+        tf = np.empty(indptr[-1], dtype=np.float32)
+        for t, term in enumerate(terms):
+            start, end = indptr[t], indptr[t + 1]
+            docs, counts = zip(*postings[term])
+            doc_idx[start:end] = docs
+            tf[start:end] = counts
+
+        return cls(doc_ids, terms, indptr, doc_idx, tf, doc_len, **kwargs)
+
+    def save(self, directory):
+        path = os.path.join(directory, LEXICAL_INDEX_FILE)
+        tmp_path = path + ".tmp.npz"
+        np.savez(
+            tmp_path,
+            doc_ids=np.array(self.doc_ids, dtype=str),
+            terms=np.array(self.terms, dtype=str),
+            indptr=self.indptr,
+            doc_idx=self.doc_idx,
+            tf=self.tf,
+            doc_len=self.doc_len,
+            params=np.array([self.k1, self.b], dtype=np.float32),
+        )
+        # Atomic swap so a serving process never reads a half-written file
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, directory):
+        path = os.path.join(directory, LEXICAL_INDEX_FILE)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            k1, b = (float(x) for x in data["params"])
+            return cls(
+                data["doc_ids"].tolist(), data["terms"].tolist(), data["indptr"],
+                data["doc_idx"], data["tf"], data["doc_len"], k1=k1, b=b)
+
+    def search(self, query, k):
+        """Returns up to `k` (doc_id, score) pairs, best first."""
+        if not self.doc_ids:
+            return []
+
+        scores = np.zeros(len(self.doc_ids), dtype=np.float32)
+        for term in set(tokenize(query)):
+            t = self.vocab.get(term)
+            if t is None:
+                continue
+            start, end = self.indptr[t], self.indptr[t + 1]
+            docs = self.doc_idx[start:end]
+            tf = self.tf[start:end]
+            scores[docs] += self.idf[t] * tf * (self.k1 + 1) / (tf + self.norm[docs])
+
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.doc_ids[i], float(scores[i])) for i in top if scores[i] > 0]
+
+
+def _doc_key(doc):
+    return getattr(doc, "id", None) or (doc.metadata.get("source"), doc.page_content)
+
+
+def reciprocal_rank_fusion(rankings, k=60, limit=None):
+    """
+    Fuses ranked lists of Documents: score(d) = sum(1 / (k + rank)).
+    Documents are matched by ID (or source + content when they have none).
+    """
+    scores = {}
+    docs = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking, start=1):
+            key = _doc_key(doc)
+            docs.setdefault(key, doc)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+
+    fused = sorted(scores, key=scores.get, reverse=True)
+    if limit is not None:
+        fused = fused[:limit]
+    return [docs[key] for key in fused]
@@ -0,0 +1,114 @@
+import bisect
+import threading
+
+# Prometheus text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 40, 80, 160)
+TOKEN_BUCKETS = (128, 256, 512, 1024, 2048, 4096, 8192)
+
+
+class Histogram:
+    """
+    Minimal Prometheus histogram. Values are kept per process, so with several
+    workers each one is scraped (or aggregated) separately.
+    """
+
+    def __init__(self, name, documentation, buckets, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        self.label_names = tuple(label_names)
+        self._series = {}  # label values -> [per-bucket counts (+Inf last), sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((key, [list(counts), total, n]) for key, (counts, total, n) in self._series.items())
+        for key, (counts, total, n) in series:
+            labels = [f'{name}="{_escape(value)}"' for name, value in zip(self.label_names, key)]
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                bucket_labels = ",".join(labels + [f'le="{le}"'])
+                lines.append(f"{self.name}_bucket{{{bucket_labels}}} {cumulative}")
+            suffix = "{" + ",".join(labels) + "}" if labels else ""
+            lines.append(f"{self.name}_sum{suffix} {total:g}")
+            lines.append(f"{self.name}_count{suffix} {n}")
+        return "\n".join(lines)
+
+
+class Counter:
+    """Minimal Prometheus counter, per process like `Histogram`."""
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            labels = ",".join(f'{name}="{_escape(v)}"' for name, v in zip(self.label_names, key))
+            suffix = "{" + labels + "}" if labels else ""
+            lines.append(f"{self.name}_total{suffix} {value:g}")
+        return "\n".join(lines)
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+STAGE_SECONDS = Histogram(
+    "rag_stage_duration_seconds", "Duration of each RAG pipeline stage.",
+    LATENCY_BUCKETS, ("stage",))
+REQUEST_SECONDS = Histogram(
+    "rag_request_duration_seconds", "End-to-end duration of a RAG request.",
+    LATENCY_BUCKETS, ("pipeline", "query_type"))
+TTFT_SECONDS = Histogram(
+    "rag_time_to_first_token_seconds", "Time from request start to the first generated token.",
+    LATENCY_BUCKETS, ("pipeline",))
+TOKENS_PER_SECOND = Histogram(
+    "rag_generation_tokens_per_second", "LLM decode speed after the first token.",
+    RATE_BUCKETS, ("pipeline",))
+PROMPT_TOKENS = Histogram(
+    "rag_prompt_tokens", "Size of the answer prompt sent to the LLM.",
+    TOKEN_BUCKETS, ("pipeline",))
+
+ADMISSION_WAIT_SECONDS = Histogram(
+    "rag_admission_wait_seconds", "Time an Ollama call waited for a concurrency slot.",
+    LATENCY_BUCKETS, ("model",))
+REJECTED_REQUESTS = Counter(
+    "rag_rejected_requests", "Requests turned away because a model was saturated.", ("model",))
+COALESCED_REQUESTS = Counter(
+    "rag_coalesced_requests", "Requests answered by an identical request already in flight.",
+    ("pipeline",))
+
+REGISTRY = (STAGE_SECONDS, REQUEST_SECONDS, TTFT_SECONDS, TOKENS_PER_SECOND, PROMPT_TOKENS,
+            ADMISSION_WAIT_SECONDS, REJECTED_REQUESTS, COALESCED_REQUESTS)
+
+
+def render_metrics():
+    return "\n".join(histogram.render() for histogram in REGISTRY) + "\n"
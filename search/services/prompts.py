@@ -44,6 +44,23 @@ Input: {question}
 Standalone Question:"""
 
 
+CONDENSE_AND_HYDE_TEMPLATE = """Given the chat history and the new input, do two things:
+1. Rephrase the input into a standalone technical question. Focus on capturing specific technical terms (e.g., "session", "engine", "declarative").
+2. Write a short, hypothetical passage from the documentation that answers that standalone question.
+Crucially, use **Modern Best Practices** (v2.0+) and technical terminology in the passage.
+Write it as the technical explanation and code snippet of a documentation page.
+
+History:
+{chat_history}
+
+Input: {question}
+
+Reply in exactly this format:
+Standalone Question: <the standalone question>
+Hypothetical Documentation:
+<the documentation passage>"""
+
+
 def get_template():
     return TEMPLATE.format(
         system_context=SYSTEM_CONTEXT,
@@ -1,25 +1,21 @@
 import os
-from dotenv import load_dotenv
-from operator import itemgetter
-from langchain_ollama import ChatOllama, OllamaEmbeddings
-from langchain_community.vectorstores import FAISS
-from langchain_core.prompts import ChatPromptTemplate, PromptTemplate
-from langchain_core.runnables import RunnablePassthrough, RunnableBranch
-from langchain_core.output_parsers import StrOutputParser
-from langchain_classic.retrievers.contextual_compression import ContextualCompressionRetriever
-from langchain_classic.retrievers.multi_query import MultiQueryRetriever
-from langchain_community.document_compressors import FlashrankRerank
-from .prompts import get_template, CONDENSE_QUESTION_TEMPLATE, HYDE_TEMPLATE
+import re
+import time
+import asyncio
+import logging
+from langchain_core.documents import Document
+from .engine import get_engine, RETRIEVAL_K, RRF_K, HYDE_MODE, HYDE_MIN_SCORE, HYDE_MIN_MARGIN, QUERY_PLAN
+from .lexical import reciprocal_rank_fusion
+from .chunking import count_tokens
+from .context import pack_context
+from .prompts import get_template
+from .tracing import Trace
+from .metrics import COALESCED_REQUESTS
+from .admission import FlightAborted
 
-load_dotenv()
+logger = logging.getLogger(__name__)
 
-MODEL_NAME = os.getenv("MODEL_NAME")
-LLM_MODEL = os.getenv("LLM_MODEL")
-TEMPERATURE = float(os.getenv("TEMPERATURE", "0.05"))
-
-BASE_DIR = os.path.dirname(os.path.dirname(
-    os.path.dirname(os.path.abspath(__file__))))
-DB_PATH = os.path.join(BASE_DIR, "data", "vector_db")
+ANSWER_TEMPLATE = get_template()
 
 
 def format_docs(docs):
@@ -34,102 +30,531 @@ def format_chat_history(chat_history):
     return "\n".join(buffer)
 
 
-def answer_question(question_text, chat_history=[]):
-    if not os.path.exists(DB_PATH):
-        raise FileNotFoundError(f"Vector DB not found at {DB_PATH}")
-
-    # 1. Initialize Models & Database
-    embeddings = OllamaEmbeddings(model=MODEL_NAME)
-    llm = ChatOllama(model=LLM_MODEL, temperature=TEMPERATURE)
-    
-    vector_db = FAISS.load_local(
-        DB_PATH, embeddings, allow_dangerous_deserialization=True)
-    
-    base_retriever = vector_db.as_retriever(search_kwargs={"k": 10})
-
-    # 2. Define History Awareness Chain
-    # This chain handles conversation history (e.g., "What about async?" -> "How do I use async sessions?")
-    condense_prompt = PromptTemplate.from_template(CONDENSE_QUESTION_TEMPLATE)
-    condense_chain = (
-        {
-            "chat_history": lambda x: format_chat_history(x["chat_history"]),
-            "question": itemgetter("question")
-        }
-        | condense_prompt
-        | llm
-        | StrOutputParser()
-    )
-
-    # 3. Define HyDE Generator (Hypothetical Document Embeddings)
-    # This chain hallucinates a "fake" answer to better match vector embeddings
-    hyde_prompt = PromptTemplate.from_template(HYDE_TEMPLATE)
-    hyde_generator = (
-        hyde_prompt
-        | llm
-        | StrOutputParser()
-    )
-
-    def hyde_retrieval(inputs):
-        """Helper function to run the HyDE logic"""
-        original_q = inputs["question"]
-
-        # Step A: Generate a hypothetical document
-        hypothetical_doc = hyde_generator.invoke({"question": original_q})
-        print(f"DEBUG: HyDE Doc Generated: {hypothetical_doc[:100]}...")
-
-        # Step B: Retrieve using the HYPOTHETICAL text (better semantic match)
-        docs = base_retriever.invoke(hypothetical_doc)
-        return docs
-
-    # 4. Initialize Reranker (FlashRank)
-    # This model will re-score the top 10 results to ensure accuracy
-    compressor = FlashrankRerank(model="ms-marco-MiniLM-L-12-v2", top_n=5)
-
-    # 5. Execute: Resolve Effective Query
-    # If history exists, rewrite the question. Otherwise, use the raw input.
-    if chat_history:
-        effective_query = condense_chain.invoke(
-            {"question": question_text, "chat_history": chat_history})
-    else:
+def extract_sources(docs):
+    sources = []
+    seen = set()
+    for doc in docs:
+        src = doc.metadata.get('source', 'unknown')
+        if src not in seen:
+            sources.append({'name': os.path.basename(src), 'url': src})
+            seen.add(src)
+    return sources
+
+
+# References to earlier turns ("it", "that", "what about ...") that need condensing
+ANAPHORA = re.compile(
+    r"\b(it|its|it's|this|that|these|those|they|them|their|theirs|one|ones|same|"
+    r"above|previous|former|latter|instead|also|else|there)\b"
+    r"|^\s*(what|how) about\b|^\s*(and|but|or|so|why not|what if)\b",
+    re.IGNORECASE,
+)
+
+CONDENSED_MARKER = re.compile(r"standalone question\s*:", re.IGNORECASE)
+HYDE_MARKER = re.compile(r"hypothetical documentation\s*:", re.IGNORECASE)
+
+
+def needs_condense(question_text, chat_history):
+    """Only follow-ups that refer back to the conversation are rewritten."""
+    return bool(chat_history) and bool(ANAPHORA.search(question_text))
+
+
+def parse_condensed_hyde(text, question_text):
+    """
+    Splits the combined condense + HyDE output into (standalone question, passage).
+    Falls back to the raw question when the model ignored the format.
+    """
+    hyde_match = HYDE_MARKER.search(text)
+    head = text[:hyde_match.start()] if hyde_match else text
+    hypothetical_doc = text[hyde_match.end():].strip() if hyde_match else None
+
+    condensed_match = CONDENSED_MARKER.search(head)
+    condensed = head[condensed_match.end():] if condensed_match else head
+    condensed = condensed.strip().split("\n")[0].strip()
+
+    return condensed or question_text, hypothetical_doc or None
+
+
+def resolve_query(question_text, chat_history, engine, trace=None):
+    """
+    Resolves the effective (standalone) query.
+    This handles conversation history (e.g., "What about async?" -> "How do I use async sessions?")
+    If the input refers back to the history, rewrite the question. Otherwise, use the raw input.
+
+    Returns (effective_query, hypothetical_doc); the HyDE passage is only set
+    when it was produced by the combined plan.
+    """
+    trace = trace or Trace("sync")
+    hypothetical_doc = None
+    if not needs_condense(question_text, chat_history):
         effective_query = question_text
+    elif QUERY_PLAN == "combined":
+        # One round-trip instead of condense + HyDE
+        # The first LLM call of a request: rejected at once if the model is saturated
+        with trace.span("condense"), engine.llm_admission.slot(admit=True):
+            effective_query, hypothetical_doc = parse_condensed_hyde(
+                engine.condense_hyde_chain.invoke({
+                    "question": question_text,
+                    "chat_history": format_chat_history(chat_history),
+                }),
+                question_text,
+            )
+    else:
+        with trace.span("condense"), engine.llm_admission.slot(admit=True):
+            effective_query = engine.condense_chain.invoke({
+                "question": question_text,
+                "chat_history": format_chat_history(chat_history),
+            })
+
+    trace.set(query=effective_query)
+    return effective_query, hypothetical_doc
+
+
+def is_confident(scored_docs):
+    """
+    Decides whether direct retrieval is good enough to skip HyDE:
+    the best similarity and the spread between first and last hit must
+    both reach their thresholds.
+    """
+    if not scored_docs:
+        return False
+    scores = [score for _, score in scored_docs]
+    return scores[0] >= HYDE_MIN_SCORE and scores[0] - scores[-1] >= HYDE_MIN_MARGIN
+
+
+def hyde_search(effective_query, engine, hypothetical_doc=None, shards=None, trace=None):
+    """
+    HyDE (Hypothetical Document Embeddings): we hallucinate a "fake" Modern answer
+    and fetch documents that look like it. A passage from the combined plan is reused.
+    """
+    trace = trace or Trace("sync")
+    if hypothetical_doc is None:
+        with trace.span("hyde"), engine.llm_admission.slot():
+            hypothetical_doc = engine.hyde_generator.invoke({"question": effective_query})
+    logger.debug(f"HyDE passage: {hypothetical_doc[:100]}...")
+    with trace.span("embed"):
+        embedding = engine.embeddings.embed_query(hypothetical_doc)
+    with trace.span("vector_search"):
+        return [doc for doc, _ in engine.dense_search(embedding, shards=shards)]
+
 
-    print(f"DEBUG: Effective Query: {effective_query}")
+def retrieve_documents(effective_query, engine, query_embedding=None, hypothetical_doc=None, shards=None,
+                       trace=None):
+    """
+    Hybrid (dense + BM25) retrieval followed by FlashRank reranking, over the
+    given index shards (all of them by default).
+    Returns the reranked documents and the dense path that ran ("Direct" or "HyDE").
+    """
+    trace = trace or Trace("sync")
+    # None searches every shard
+    trace.set(shards=shards)
 
-    # 6. Execute: HyDE Retrieval
-    # We fetch documents that look like the "Modern" hypothetical answer
-    initial_docs = hyde_retrieval({"question": effective_query})
+    # 1. Lexical (BM25) leg runs on the pool while the dense leg is working
+    # Exact API names (e.g. `mapped_column`) are often missed by dense search alone
+    lexical_future = engine.executor.submit(
+        trace.wrap("lexical_search", engine.lexical_search), effective_query, shards=shards)
 
-    # 7. Execute: Reranking
+    # 2. Dense leg: adaptive query expansion
+    # HyDE costs a full LLM generation, so only pay for it when the raw query
+    # does not already retrieve confidently. "race" behaves as "adaptive" here:
+    # a generation running on a thread cannot be cancelled, so racing it would
+    # always pay for HyDE (see `retrieve_documents_async`)
+    if HYDE_MODE == "always":
+        direct = []
+    else:
+        if query_embedding is None:
+            with trace.span("embed"):
+                query_embedding = engine.embeddings.embed_query(effective_query)
+        with trace.span("vector_search"):
+            direct = engine.dense_search(query_embedding, shards=shards)
+
+    if is_confident(direct):
+        query_type = "Direct"
+        dense_docs = [doc for doc, _ in direct]
+    else:
+        query_type = "HyDE"
+        dense_docs = hyde_search(effective_query, engine, hypothetical_doc, shards, trace)
+
+    logger.debug(f"Retrieval path: {query_type}")
+
+    # 3. Reciprocal Rank Fusion of both legs
+    initial_docs = reciprocal_rank_fusion(
+        [dense_docs, lexical_future.result()], k=RRF_K, limit=RETRIEVAL_K)
+
+    # 4. Reranking (FlashRank)
     # We filter the initial 10 docs down to the best 5 based on the user's ACTUAL query
-    reranked_docs = compressor.compress_documents(
-        documents=initial_docs, query=effective_query)
+    with trace.span("rerank"):
+        reranked_docs = engine.compressor.compress_documents(
+            documents=initial_docs, query=effective_query)
+    return reranked_docs, query_type
 
-    # 8. Execute: Final Answer Generation
-    # We feed the highly relevant docs + the effective query to the LLM
-    answer_prompt = ChatPromptTemplate.from_template(get_template())
-    chain = (
-        {"context": lambda x: format_docs(
-            reranked_docs), "question": lambda x: effective_query}
-        | answer_prompt
-        | llm
-        | StrOutputParser()
-    )
 
-    answer = chain.invoke(effective_query)
+def build_context(reranked_docs, effective_query, trace=None):
+    """
+    Packs the reranked chunks into the answer prompt: adjacent chunks are merged,
+    near-duplicates dropped and the rest kept within CONTEXT_TOKEN_BUDGET.
+    Returns (context documents, prompt inputs, prompt token count).
+    """
+    trace = trace or Trace("sync")
+    context_docs = pack_context(reranked_docs)
+    inputs = {
+        "context": format_docs(context_docs),
+        "question": effective_query,
+    }
+    prompt_tokens = count_tokens(ANSWER_TEMPLATE.format(**inputs))
+    trace.set(context_blocks=len(context_docs), context_chunks=len(reranked_docs))
+    return context_docs, inputs, prompt_tokens
 
-    # 9. Extract Sources
-    sources = []
-    seen = set()
-    for doc in reranked_docs:
-        src = doc.metadata.get('source', 'unknown')
-        if src not in seen:
-            sources.append({'name': os.path.basename(src), 'url': src})
-            seen.add(src)
 
+def stream_generation(engine, inputs, trace):
+    """Streams the answer tokens, recording TTFT and decode speed on `trace`."""
+    started = time.perf_counter()
+    first_token_at = None
+    tokens = 0
+    # The slot is held until the last token (or until the client goes away)
+    with engine.llm_admission.slot():
+        for token in engine.answer_chain.stream(inputs):
+            # The final (done) chunk of a stream carries no text
+            if token:
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                tokens += 1
+            yield token
+    trace.generation(started, first_token_at, time.perf_counter(), tokens)
+
+
+async def stream_generation_async(engine, inputs, trace):
+    started = time.perf_counter()
+    first_token_at = None
+    tokens = 0
+    async with engine.llm_admission.aslot():
+        async for token in engine.answer_chain.astream(inputs):
+            if token:
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                tokens += 1
+            yield token
+    trace.generation(started, first_token_at, time.perf_counter(), tokens)
+
+
+def build_result(answer, context_docs, query_type, effective_query, prompt_tokens=0):
     return {
         "answer": answer,
-        "sources": sources,
-        "source_documents": reranked_docs,
+        # Standalone query the answer was retrieved for (stored with the conversation turn)
+        "effective_query": effective_query,
+        "sources": extract_sources(context_docs),
+        "source_documents": context_docs,
         "confidence": "high",
-        "query_type": "HyDE"
-    }
\ No newline at end of file
+        "query_type": query_type,
+        # Size of the answer prompt (0 when no generation ran)
+        "prompt_tokens": prompt_tokens,
+    }
+
+
+def cache_payload(result):
+    """Serializable subset of a result, as stored in the semantic cache."""
+    return {
+        "answer": result["answer"],
+        "documents": [
+            {"page_content": d.page_content, "metadata": d.metadata}
+            for d in result["source_documents"]
+        ],
+    }
+
+
+def result_from_cache(payload, effective_query):
+    docs = [Document(page_content=d["page_content"], metadata=d["metadata"])
+            for d in payload["documents"]]
+    return build_result(payload["answer"], docs, "Cache", effective_query)
+
+
+def filter_scope(library=None, version=None):
+    """Semantic cache scope of a library / version filter ("" when unfiltered)."""
+    return f"{library or ''}@{version or ''}" if library or version else ""
+
+
+def flight_key(effective_query, scope, index_version):
+    """Requests with the same key get the same answer, so they can share one run."""
+    return (effective_query, scope, index_version)
+
+
+def coalesced_result(result, pipeline):
+    """A follower's copy of the result of the identical request it waited for."""
+    COALESCED_REQUESTS.inc(pipeline=pipeline)
+    # No prompt was sent for this request
+    return {**result, "query_type": "Coalesced", "prompt_tokens": 0}
+
+
+def answer_question(question_text, chat_history=None, engine=None, library=None, version=None):
+    # Per-stage timings, returned as result["trace"] and exported on /metrics
+    trace = Trace("sync")
+
+    # 1. Resolve the warm engine (models, chains and index are loaded once per process)
+    engine = engine or get_engine()
+    with trace.span("index_load"):
+        index_version = engine.index_version
+    if index_version is None:
+        raise FileNotFoundError(f"Vector DB not found at {engine.db_path}")
+
+    # 2. Resolve Effective Query
+    effective_query, hypothetical_doc = resolve_query(question_text, chat_history, engine, trace)
+
+    # 3. Semantic Cache: reuse the answer of a near-identical query
+    with trace.span("embed"):
+        query_embedding = engine.embeddings.embed_query(effective_query)
+    scope = filter_scope(library, version)
+    with trace.span("cache_lookup"):
+        cached = engine.answer_cache.lookup(query_embedding, index_version, scope)
+    if cached is not None:
+        return trace.finish(result_from_cache(cached, effective_query))
+
+    # 4. Single-flight: identical queries arriving meanwhile wait for this run
+    result, coalesced = engine.flights.do(
+        flight_key(effective_query, scope, index_version), generate_answer,
+        effective_query, hypothetical_doc, query_embedding, engine, library, version, index_version, trace)
+    return trace.finish(coalesced_result(result, trace.pipeline) if coalesced else result)
+
+
+def generate_answer(effective_query, hypothetical_doc, query_embedding, engine, library, version,
+                    index_version, trace):
+    """Retrieval and generation for a query that missed the semantic cache."""
+    # 5. Admission control: fail fast rather than queue behind a saturated LLM
+    engine.llm_admission.admit()
+
+    # 6. Shard routing: the explicit filter, or the shards closest to the query
+    with trace.span("route"):
+        shards = engine.route(query_embedding, library, version)
+
+    # 7. Adaptive (Direct / HyDE) + BM25 Retrieval, then Reranking
+    reranked_docs, query_type = retrieve_documents(
+        effective_query, engine, query_embedding, hypothetical_doc, shards, trace)
+
+    # 8. Context Packing within the prompt token budget
+    with trace.span("prompt_build"):
+        context_docs, inputs, prompt_tokens = build_context(reranked_docs, effective_query, trace)
+
+    # 9. Final Answer Generation
+    # We feed the highly relevant docs + the effective query to the LLM.
+    # Streamed internally so the trace gets time-to-first-token and tokens/s
+    answer = "".join(stream_generation(engine, inputs, trace))
+
+    result = build_result(answer, context_docs, query_type, effective_query, prompt_tokens)
+    engine.answer_cache.store(
+        query_embedding, cache_payload(result), index_version, filter_scope(library, version))
+    return result
+
+
+async def resolve_query_async(question_text, chat_history, engine, trace=None):
+    trace = trace or Trace("async")
+    hypothetical_doc = None
+    if not needs_condense(question_text, chat_history):
+        effective_query = question_text
+    elif QUERY_PLAN == "combined":
+        with trace.span("condense"):
+            async with engine.llm_admission.aslot(admit=True):
+                effective_query, hypothetical_doc = parse_condensed_hyde(
+                    await engine.condense_hyde_chain.ainvoke({
+                        "question": question_text,
+                        "chat_history": format_chat_history(chat_history),
+                    }),
+                    question_text,
+                )
+    else:
+        with trace.span("condense"):
+            async with engine.llm_admission.aslot(admit=True):
+                effective_query = await engine.condense_chain.ainvoke({
+                    "question": question_text,
+                    "chat_history": format_chat_history(chat_history),
+                })
+
+    trace.set(query=effective_query)
+    return effective_query, hypothetical_doc
+
+
+async def hyde_search_async(effective_query, engine, hypothetical_doc=None, shards=None, trace=None):
+    trace = trace or Trace("async")
+    if hypothetical_doc is None:
+        with trace.span("hyde"):
+            async with engine.llm_admission.aslot():
+                hypothetical_doc = await engine.hyde_generator.ainvoke({"question": effective_query})
+    logger.debug(f"HyDE passage: {hypothetical_doc[:100]}...")
+    with trace.span("embed"):
+        embedding = await engine.embeddings.aembed_query(hypothetical_doc)
+    scored = await engine.run_blocking(
+        trace.wrap("vector_search", engine.dense_search), embedding, shards=shards)
+    return [doc for doc, _ in scored]
+
+
+async def retrieve_documents_async(effective_query, engine, query_embedding=None, hypothetical_doc=None,
+                                   shards=None, trace=None):
+    """
+    Async counterpart of `retrieve_documents`, over the shards the caller routed to.
+    LLM and embedding calls are awaited; FAISS search and FlashRank scoring
+    run on the engine's bounded thread pool so the event loop stays free.
+    In "race" mode a losing HyDE task is cancelled, which also aborts its
+    request to Ollama.
+    """
+    trace = trace or Trace("async")
+    # None searches every shard
+    trace.set(shards=shards)
+
+    lexical_task = asyncio.ensure_future(engine.run_blocking(
+        trace.wrap("lexical_search", engine.lexical_search), effective_query, shards=shards))
+
+    hyde_task = None
+    if HYDE_MODE == "race" and hypothetical_doc is None:
+        hyde_task = asyncio.ensure_future(
+            hyde_search_async(effective_query, engine, shards=shards, trace=trace))
+
+    if HYDE_MODE == "always":
+        direct = []
+    else:
+        if query_embedding is None:
+            with trace.span("embed"):
+                query_embedding = await engine.embeddings.aembed_query(effective_query)
+        direct = await engine.run_blocking(
+            trace.wrap("vector_search", engine.dense_search), query_embedding, shards=shards)
+
+    if is_confident(direct):
+        query_type = "Direct"
+        dense_docs = [doc for doc, _ in direct]
+        if hyde_task is not None:
+            hyde_task.cancel()
+    else:
+        query_type = "HyDE"
+        dense_docs = await hyde_task if hyde_task is not None \
+            else await hyde_search_async(effective_query, engine, hypothetical_doc, shards, trace)
+
+    logger.debug(f"Retrieval path: {query_type}")
+
+    initial_docs = reciprocal_rank_fusion(
+        [dense_docs, await lexical_task], k=RRF_K, limit=RETRIEVAL_K)
+
+    reranked_docs = await engine.run_blocking(
+        trace.wrap("rerank", engine.compressor.compress_documents),
+        documents=initial_docs, query=effective_query)
+    return reranked_docs, query_type
+
+
+async def answer_question_async(question_text, chat_history=None, engine=None, library=None, version=None):
+    trace = Trace("async")
+    engine = engine or get_engine()
+    with trace.span("index_load"):
+        index_version = engine.index_version
+    if index_version is None:
+        raise FileNotFoundError(f"Vector DB not found at {engine.db_path}")
+
+    effective_query, hypothetical_doc = await resolve_query_async(
+        question_text, chat_history, engine, trace)
+
+    # Cache backends may do blocking I/O (e.g. a database-backed Django cache)
+    with trace.span("embed"):
+        query_embedding = await engine.embeddings.aembed_query(effective_query)
+    scope = filter_scope(library, version)
+    cached = await engine.run_blocking(
+        trace.wrap("cache_lookup", engine.answer_cache.lookup), query_embedding, index_version, scope)
+    if cached is not None:
+        return trace.finish(result_from_cache(cached, effective_query))
+
+    # Flights are shared with the sync pipelines of the same process
+    result, coalesced = await engine.flights.ado(
+        flight_key(effective_query, scope, index_version), generate_answer_async,
+        effective_query, hypothetical_doc, query_embedding, engine, library, version, index_version, trace)
+    return trace.finish(coalesced_result(result, trace.pipeline) if coalesced else result)
+
+
+async def generate_answer_async(effective_query, hypothetical_doc, query_embedding, engine, library, version,
+                                index_version, trace):
+    engine.llm_admission.admit()
+
+    shards = await engine.run_blocking(
+        trace.wrap("route", engine.route), query_embedding, library, version)
+    reranked_docs, query_type = await retrieve_documents_async(
+        effective_query, engine, query_embedding, hypothetical_doc, shards, trace)
+
+    with trace.span("prompt_build"):
+        context_docs, inputs, prompt_tokens = build_context(reranked_docs, effective_query, trace)
+    answer = "".join([token async for token in stream_generation_async(engine, inputs, trace)])
+
+    result = build_result(answer, context_docs, query_type, effective_query, prompt_tokens)
+    await engine.run_blocking(
+        engine.answer_cache.store, query_embedding, cache_payload(result), index_version,
+        filter_scope(library, version))
+    return result
+
+
+async def stream_answer_async(question_text, chat_history=None, engine=None, library=None, version=None):
+    """
+    Streaming variant of `answer_question` for ASGI: tokens come from
+    `answer_chain.astream`, so each one reaches the client as it is generated.
+    Yields `(event, payload)` tuples in this order:
+      - ("sources", [...])   once retrieval and reranking are done
+      - ("token", str)       for every chunk produced by the LLM
+      - ("done", result)     the same dict `answer_question` returns
+    """
+    trace = Trace("stream")
+    engine = engine or get_engine()
+    with trace.span("index_load"):
+        index_version = engine.index_version
+    if index_version is None:
+        raise FileNotFoundError(f"Vector DB not found at {engine.db_path}")
+
+    effective_query, hypothetical_doc = await resolve_query_async(
+        question_text, chat_history, engine, trace)
+
+    with trace.span("embed"):
+        query_embedding = await engine.embeddings.aembed_query(effective_query)
+    scope = filter_scope(library, version)
+    cached = await engine.run_blocking(
+        trace.wrap("cache_lookup", engine.answer_cache.lookup), query_embedding, index_version, scope)
+    if cached is not None:
+        result = result_from_cache(cached, effective_query)
+    else:
+        key = flight_key(effective_query, scope, index_version)
+        future, leader = engine.flights.join(key)
+        result = None
+        if not leader:
+            try:
+                # Shielded: a cancelled follower must not cancel the flight
+                result = coalesced_result(
+                    await asyncio.shield(asyncio.wrap_future(future)), trace.pipeline)
+            except FlightAborted:
+                pass
+
+    if result is not None:
+        yield "sources", result["sources"]
+        yield "token", result["answer"]
+        yield "done", trace.finish(result)
+        return
+
+    try:
+        engine.llm_admission.admit()
+
+        shards = await engine.run_blocking(
+            trace.wrap("route", engine.route), query_embedding, library, version)
+        reranked_docs, query_type = await retrieve_documents_async(
+            effective_query, engine, query_embedding, hypothetical_doc, shards, trace)
+
+        with trace.span("prompt_build"):
+            context_docs, inputs, prompt_tokens = build_context(reranked_docs, effective_query, trace)
+        yield "sources", extract_sources(context_docs)
+
+        parts = []
+        async for token in stream_generation_async(engine, inputs, trace):
+            parts.append(token)
+            yield "token", token
+
+        result = build_result("".join(parts), context_docs, query_type, effective_query, prompt_tokens)
+        await engine.run_blocking(
+            engine.answer_cache.store, query_embedding, cache_payload(result), index_version, scope)
+    except Exception as e:
+        if leader:
+            engine.flights.finish(key, error=e)
+        raise
+    except BaseException:
+        # CancelledError / GeneratorExit: the client disconnected mid-stream
+        if leader:
+            engine.flights.finish(key, error=FlightAborted())
+        raise
+    if leader:
+        engine.flights.finish(key, result)
+    yield "done", trace.finish(result)
@@ -0,0 +1,174 @@
+import os
+import time
+import queue
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+import numpy as np
+from langchain_core.documents import Document
+from dotenv import load_dotenv
+
+load_dotenv()
+
+RERANKER = os.getenv("RERANKER", "cached")
+# 0 keeps the onnxruntime default (all cores)
+RERANK_THREADS = int(os.getenv("RERANK_THREADS", "0"))
+RERANK_CACHE_SIZE = int(os.getenv("RERANK_CACHE_SIZE", "4096"))
+RERANK_BATCH_WINDOW_MS = float(os.getenv("RERANK_BATCH_WINDOW_MS", "5"))
+RERANK_MAX_BATCH = int(os.getenv("RERANK_MAX_BATCH", "64"))
+
+
+class CrossEncoderScorer:
+    """
+    Scores (query, passage) pairs with a FlashRank pairwise ONNX model.
+    Unlike `Ranker.rerank`, a single call may mix pairs from several queries.
+    """
+
+    def __init__(self, model_name, threads=RERANK_THREADS, max_length=512):
+        import onnxruntime as ort
+        from flashrank import Ranker
+        from flashrank.Config import model_file_map
+
+        # Ranker downloads the model and configures the tokenizer
+        ranker = Ranker(model_name=model_name, max_length=max_length)
+        self.tokenizer = ranker.tokenizer
+        self.session = ranker.session
+        if threads > 0:
+            options = ort.SessionOptions()
+            options.intra_op_num_threads = threads
+            options.inter_op_num_threads = 1
+            self.session = ort.InferenceSession(
+                str(ranker.model_dir / model_file_map[model_name]), sess_options=options)
+
+    def score(self, pairs):
+        encoded = self.tokenizer.encode_batch([list(pair) for pair in pairs])
+        input_ids = np.array([e.ids for e in encoded], dtype=np.int64)
+        token_type_ids = np.array([e.type_ids for e in encoded], dtype=np.int64)
+        attention_mask = np.array([e.attention_mask for e in encoded], dtype=np.int64)
+
+        onnx_input = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if not np.all(token_type_ids == 0):
+            onnx_input["token_type_ids"] = token_type_ids
+
+        logits = self.session.run(None, onnx_input)[0]
+        if logits.shape[1] == 1:
+            return 1 / (1 + np.exp(-logits.flatten()))
+        exp_logits = np.exp(logits)
+        return exp_logits[:, 1] / np.sum(exp_logits, axis=1)
+
+
+class MicroBatcher:
+    """
+    Coalesces scoring requests from concurrent callers into one ONNX call.
+    The worker waits up to `window_ms` after the first request (or until
+    `max_batch` pairs are queued) before running the model.
+    """
+
+    def __init__(self, scorer, window_ms=RERANK_BATCH_WINDOW_MS, max_batch=RERANK_MAX_BATCH):
+        self.scorer = scorer
+        self.window = window_ms / 1000.0
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="rerank-batcher", daemon=True)
+        self._thread.start()
+
+    def score(self, pairs):
+        future = Future()
+        self._queue.put((pairs, future))
+        return future.result()
+
+    def _run(self):
+        while True:
+            requests = [self._queue.get()]
+            size = len(requests[0][0])
+            deadline = time.monotonic() + self.window
+            while size < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                requests.append(item)
+                size += len(item[0])
+
+            pairs = [pair for batch, _ in requests for pair in batch]
+            try:
+                scores = self.scorer.score(pairs) if pairs else []
+            except Exception as e:
+                for _, future in requests:
+                    future.set_exception(e)
+                continue
+
+            offset = 0
+            for batch, future in requests:
+                future.set_result(scores[offset:offset + len(batch)])
+                offset += len(batch)
+
+
+class CachedReranker:
+    """
+    Drop-in replacement for `FlashrankRerank.compress_documents`.
+    Scores are cached per (query hash, chunk) with LRU eviction; only
+    uncached pairs go to the model, through the shared micro-batcher.
+    """
+
+    def __init__(self, model_name, top_n=5, cache_size=RERANK_CACHE_SIZE,
+                 window_ms=RERANK_BATCH_WINDOW_MS):
+        self.top_n = top_n
+        self.cache_size = cache_size
+        self.scorer = CrossEncoderScorer(model_name)
+        self.batcher = MicroBatcher(self.scorer, window_ms=window_ms) if window_ms > 0 else None
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _hash(text):
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def _chunk_key(self, doc):
+        return getattr(doc, "id", None) or self._hash(doc.page_content)
+
+    def score(self, query, documents):
+        query_key = self._hash(query)
+        keys = [(query_key, self._chunk_key(doc)) for doc in documents]
+
+        scores = {}
+        with self._lock:
+            for key in keys:
+                if key in self._cache:
+                    self._cache.move_to_end(key)
+                    scores[key] = self._cache[key]
+
+        missing = [(key, doc) for key, doc in zip(keys, documents) if key not in scores]
+        if missing:
+            pairs = [(query, doc.page_content) for _, doc in missing]
+            new_scores = self.batcher.score(pairs) if self.batcher else self.scorer.score(pairs)
+            with self._lock:
+                for (key, _), value in zip(missing, new_scores):
+                    scores[key] = float(value)
+                    self._cache[key] = float(value)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+
+        return [scores[key] for key in keys]
+
+    def compress_documents(self, documents, query, callbacks=None):
+        documents = list(documents)
+        if not documents:
+            return []
+
+        scores = self.score(query, documents)
+        ranked = sorted(enumerate(documents), key=lambda item: scores[item[0]], reverse=True)
+
+        # Same metadata shape as FlashrankRerank
+        return [
+            Document(
+                id=getattr(doc, "id", None),
+                page_content=doc.page_content,
+                metadata={"id": i, "relevance_score": scores[i], **doc.metadata},
+            )
+            for i, doc in ranked[:self.top_n]
+        ]
@@ -0,0 +1,126 @@
+import os
+import re
+import json
+from urllib.parse import urlparse
+import numpy as np
+from dotenv import load_dotenv
+from .ann import read_meta
+
+load_dotenv()
+
+# "version" shards per library and doc version, "domain" per library, "none" keeps one shard
+INDEX_SHARD_BY = os.getenv("INDEX_SHARD_BY", "version")
+# Shards searched per query when no library / version filter is given
+ROUTER_TOP_SHARDS = int(os.getenv("ROUTER_TOP_SHARDS", "2"))
+
+SHARDS_DIR = "shards"
+ROUTER_FILE = "router.json"
+
+SUBDOMAINS_TO_REMOVE = ('www', 'docs', 'developer', 'dev', 'api')
+# Path segments naming a doc version: /en/20/, /v2.1/, /en/stable/
+VERSION_SEGMENT = re.compile(r'^(?:v?\d+(?:\.\d+)*|latest|stable|dev)$')
+
+
+def library_name(url):
+    """`docs.sqlalchemy.org` -> `sqlalchemy` (same naming as the UI)."""
+    parts = urlparse(url).netloc.lower().split(':')[0].split('.')
+    if len(parts) > 1 and parts[0] in SUBDOMAINS_TO_REMOVE:
+        return parts[1]
+    return parts[0]
+
+
+def doc_version(url):
+    """First path segment that looks like a version, or '' when there is none."""
+    for segment in urlparse(url).path.split('/'):
+        if VERSION_SEGMENT.match(segment.lower()):
+            return segment.lower()
+    return ''
+
+
+def shard_for(url, shard_by=INDEX_SHARD_BY):
+    """Returns (shard key, library, version) for a page URL."""
+    if shard_by == "none":
+        return "all", "", ""
+    library = library_name(url)
+    version = doc_version(url) if shard_by == "version" else ""
+    key = f"{library}@{version}" if version else library
+    return key, library, version
+
+
+def shard_path(db_path, key):
+    return os.path.join(db_path, SHARDS_DIR, key)
+
+
+def store_paths(db_path):
+    """Directories holding a vector store: every shard, or `db_path` itself before sharding."""
+    shards_dir = os.path.join(db_path, SHARDS_DIR)
+    if os.path.isdir(shards_dir):
+        return [os.path.join(shards_dir, key) for key in sorted(os.listdir(shards_dir))]
+    return [db_path]
+
+
+def write_router(db_path):
+    """Rebuilds the router from the metadata of every shard on disk."""
+    shards = []
+    shards_dir = os.path.join(db_path, SHARDS_DIR)
+    for key in sorted(os.listdir(shards_dir)):
+        meta = read_meta(os.path.join(shards_dir, key))
+        if "centroid" not in meta:
+            continue
+        shards.append({
+            "key": key,
+            "library": meta.get("library", ""),
+            "version": meta.get("version", ""),
+            "vectors": meta.get("vectors", 0),
+            "centroid": meta["centroid"],
+        })
+
+    path = os.path.join(db_path, ROUTER_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump({"shards": shards}, f)
+    os.replace(path + ".tmp", path)
+    return shards
+
+
+def read_router(db_path):
+    path = os.path.join(db_path, ROUTER_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return ShardRouter(json.load(f)["shards"])
+
+
+class ShardRouter:
+    """
+    Picks the shards to search for a query: every shard matching an explicit
+    library / version filter, otherwise the `top` shards whose centroid is
+    closest to the query embedding.
+    """
+
+    def __init__(self, shards):
+        self.shards = shards
+        self.keys = [shard["key"] for shard in shards]
+        centroids = np.array([shard["centroid"] for shard in shards], dtype=np.float32)
+        norms = np.linalg.norm(centroids, axis=1, keepdims=True) if len(shards) else 1.0
+        self.centroids = centroids / np.where(norms == 0, 1.0, norms)
+
+    def libraries(self):
+        """{library: [versions]} for the UI filter."""
+        options = {}
+        for shard in self.shards:
+            versions = options.setdefault(shard["library"], [])
+            if shard["version"]:
+                versions.append(shard["version"])
+        return options
+
+    def route(self, embedding, library=None, version=None, top=ROUTER_TOP_SHARDS):
+        if library or version:
+            return [shard["key"] for shard in self.shards
+                    if (not library or shard["library"] == library)
+                    and (not version or shard["version"] == version)]
+
+        if len(self.keys) <= top:
+            return list(self.keys)
+        query = np.asarray(embedding, dtype=np.float32)
+        scores = self.centroids @ (query / (np.linalg.norm(query) or 1.0))
+        return [self.keys[i] for i in np.argsort(-scores)[:top]]
@@ -0,0 +1,159 @@
+import os
+import json
+import sqlite3
+import logging
+import threading
+from collections.abc import Mapping
+from langchain_community.docstore.base import Docstore
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+from .ann import needs_training, read_meta
+
+logger = logging.getLogger(__name__)
+
+FAISS_INDEX_FILE = "index.faiss"
+CHUNK_STORE_FILE = "chunks.sqlite3"
+# Pickled (docstore, index_to_docstore_id) written by FAISS.save_local
+LEGACY_DOCSTORE_FILE = "index.pkl"
+
+
+class SQLiteDocstore(Docstore):
+    """
+    Read-only chunk store: Documents are read from SQLite by ID on demand,
+    so serving processes share the OS page cache instead of each holding
+    every chunk in memory.
+
+    The connection is opened once, when the store is loaded, and shared by
+    all threads: `save_vector_store` swaps in a new file with `os.replace`,
+    and an open connection keeps reading the file that matches the index
+    loaded with it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+
+    def _fetchone(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchone()
+
+    def _column(self, sql):
+        with self._lock:
+            return [row[0] for row in self._conn.execute(sql)]
+
+    def search(self, search):
+        row = self._fetchone("SELECT content, metadata FROM chunks WHERE id = ?", (search,))
+        if row is None:
+            # Same contract as InMemoryDocstore
+            return f"ID {search} not found."
+        return Document(id=search, page_content=row[0], metadata=json.loads(row[1]))
+
+    def ids(self):
+        return self._column("SELECT id FROM chunks ORDER BY pos")
+
+
+class PositionMap(Mapping):
+    """FAISS vector position -> chunk ID, looked up in the chunk store."""
+
+    def __init__(self, docstore):
+        self.docstore = docstore
+
+    def __getitem__(self, pos):
+        row = self.docstore._fetchone("SELECT id FROM chunks WHERE pos = ?", (int(pos),))
+        if row is None:
+            raise KeyError(pos)
+        return row[0]
+
+    def __len__(self):
+        return self.docstore._fetchone("SELECT COUNT(*) FROM chunks")[0]
+
+    def __iter__(self):
+        return iter(self.docstore._column("SELECT pos FROM chunks ORDER BY pos"))
+
+    def values(self):
+        # One query instead of one per position
+        return self.docstore.ids()
+
+
+def save_vector_store(vector_db, db_path):
+    """
+    Writes the FAISS index (mmap-able) and the chunks to a SQLite file.
+    Each file is written to a temporary path and swapped in atomically.
+    """
+    import faiss
+
+    index_path = os.path.join(db_path, FAISS_INDEX_FILE)
+    faiss.write_index(vector_db.index, index_path + ".tmp")
+    os.replace(index_path + ".tmp", index_path)
+
+    chunk_path = os.path.join(db_path, CHUNK_STORE_FILE)
+    tmp_path = chunk_path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    try:
+        conn.execute(
+            "CREATE TABLE chunks (pos INTEGER PRIMARY KEY, id TEXT NOT NULL UNIQUE, "
+            "content TEXT NOT NULL, metadata TEXT NOT NULL)")
+        rows = []
+        for pos, doc_id in sorted(vector_db.index_to_docstore_id.items()):
+            doc = vector_db.docstore.search(doc_id)
+            rows.append((pos, doc_id, doc.page_content, json.dumps(doc.metadata)))
+        conn.executemany("INSERT INTO chunks VALUES (?, ?, ?, ?)", rows)
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(tmp_path, chunk_path)
+
+    legacy_path = os.path.join(db_path, LEGACY_DOCSTORE_FILE)
+    if os.path.exists(legacy_path):
+        os.remove(legacy_path)
+
+
+def load_vector_store(db_path, embeddings, mmap=True):
+    """
+    Opens the vector store written by `save_vector_store`.
+
+    With `mmap=True` (serving) the index is memory-mapped read-only and chunks
+    are read from SQLite on demand. With `mmap=False` (ingest) everything is
+    loaded into a regular, writable LangChain FAISS store.
+    Stores still in the pickle layout are loaded with `FAISS.load_local`.
+    """
+    import faiss
+
+    chunk_path = os.path.join(db_path, CHUNK_STORE_FILE)
+    if not os.path.exists(chunk_path):
+        logger.warning(f"{db_path} uses the pickled docstore; re-run 'ingest' to convert it")
+        return FAISS.load_local(db_path, embeddings, allow_dangerous_deserialization=True)
+
+    flags = 0
+    if mmap:
+        # IVF inverted lists and flat code arrays use different mmap flags,
+        # and FAISS rejects the combination
+        ivf = needs_training(read_meta(db_path)["index_type"])
+        flags = (faiss.IO_FLAG_MMAP if ivf else faiss.IO_FLAG_MMAP_IFC) | faiss.IO_FLAG_READ_ONLY
+    index = faiss.read_index(os.path.join(db_path, FAISS_INDEX_FILE), flags)
+
+    if mmap:
+        docstore = SQLiteDocstore(chunk_path)
+        index_to_docstore_id = PositionMap(docstore)
+    else:
+        conn = sqlite3.connect(chunk_path)
+        try:
+            rows = conn.execute("SELECT pos, id, content, metadata FROM chunks ORDER BY pos").fetchall()
+        finally:
+            conn.close()
+        docstore = InMemoryDocstore({
+            doc_id: Document(id=doc_id, page_content=content, metadata=json.loads(metadata))
+            for _, doc_id, content, metadata in rows
+        })
+        index_to_docstore_id = {pos: doc_id for pos, doc_id, _, _ in rows}
+
+    # The two files are replaced one after the other: refuse a mismatched pair
+    if index.ntotal != len(index_to_docstore_id):
+        raise ValueError(
+            f"Index has {index.ntotal} vectors but the chunk store has {len(index_to_docstore_id)}")
+
+    return FAISS(embeddings, index, docstore, index_to_docstore_id)
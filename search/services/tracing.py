@@ -0,0 +1,108 @@
+import os
+import json
+import time
+import uuid
+import logging
+import functools
+import threading
+from contextlib import contextmanager
+from dotenv import load_dotenv
+from .metrics import PROMPT_TOKENS, REQUEST_SECONDS, STAGE_SECONDS, TOKENS_PER_SECOND, TTFT_SECONDS
+
+load_dotenv()
+
+# Every finished request is logged as one JSON line on the "search.trace" logger
+TRACE_LOG = os.getenv("RAG_TRACE_LOG", "true").lower() == "true"
+
+trace_logger = logging.getLogger("search.trace")
+
+# Callables receiving every finished trace dict (e.g. the `benchmark` command)
+listeners = []
+
+
+class Trace:
+    """
+    Timing spans of one RAG request. Stages may run on worker threads (BM25
+    leg, HyDE race), so spans are recorded under a lock.
+    """
+
+    def __init__(self, pipeline):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.pipeline = pipeline
+        self.started = time.perf_counter()
+        self.spans = []
+        self.attributes = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.perf_counter())
+
+    def wrap(self, name, func):
+        """`func` timed as a span, e.g. before handing it to a thread pool."""
+        @functools.wraps(func)
+        def traced(*args, **kwargs):
+            with self.span(name):
+                return func(*args, **kwargs)
+        return traced
+
+    def record(self, name, start, end):
+        with self._lock:
+            self.spans.append({
+                "name": name,
+                "start_ms": round((start - self.started) * 1000, 2),
+                "duration_ms": round((end - start) * 1000, 2),
+            })
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def generation(self, started, first_token_at, ended, tokens):
+        """Records the generation span, time to first token and decode speed."""
+        self.record("generation", started, ended)
+        self.set(completion_tokens=tokens)
+        if first_token_at is not None:
+            self.set(ttft_ms=round((first_token_at - self.started) * 1000, 2))
+            if tokens > 1 and ended > first_token_at:
+                self.set(tokens_per_sec=round((tokens - 1) / (ended - first_token_at), 2))
+
+    def to_dict(self):
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span["start_ms"])
+        return {
+            "trace_id": self.trace_id,
+            "pipeline": self.pipeline,
+            "total_ms": round((time.perf_counter() - self.started) * 1000, 2),
+            "spans": spans,
+            **self.attributes,
+        }
+
+    def finish(self, result):
+        """
+        Attaches the trace to `result`, feeds the /metrics histograms and logs
+        the trace as JSON. Returns `result`.
+        """
+        self.set(query_type=result.get("query_type"), prompt_tokens=result.get("prompt_tokens", 0))
+        trace = self.to_dict()
+        result["trace"] = trace
+
+        for span in trace["spans"]:
+            STAGE_SECONDS.observe(span["duration_ms"] / 1000, stage=span["name"])
+        REQUEST_SECONDS.observe(
+            trace["total_ms"] / 1000, pipeline=self.pipeline, query_type=trace["query_type"])
+        if "ttft_ms" in trace:
+            TTFT_SECONDS.observe(trace["ttft_ms"] / 1000, pipeline=self.pipeline)
+        if "tokens_per_sec" in trace:
+            TOKENS_PER_SECOND.observe(trace["tokens_per_sec"], pipeline=self.pipeline)
+        if trace["prompt_tokens"]:
+            PROMPT_TOKENS.observe(trace["prompt_tokens"], pipeline=self.pipeline)
+
+        for listener in listeners:
+            listener(trace)
+        if TRACE_LOG:
+            trace_logger.info(json.dumps(trace))
+        return result
@@ -1,3 +1,503 @@
-from django.test import TestCase
+import io
+import os
+import shutil
+import asyncio
+import hashlib
+import threading
+import tempfile
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+import numpy as np
+from django.core.management import call_command
+from django.test import AsyncClient, TestCase, override_settings
+from django.urls import reverse
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from search.management.commands.scrape import Command as ScrapeCommand
+from search.models import ScrapedPage
+from search.services.admission import AdmissionController, FlightAborted, ServerBusy, SingleFlight
+from search.services.context import pack_context
+from search.services.cache import DjangoSemanticCache
+from search.services.ann import INDEX_TYPES, configure_search, read_meta
+from search.services.lexical import LexicalIndex, reciprocal_rank_fusion
+from search.services.shards import shard_path
+from search.services.store import load_vector_store
 
-# Create your tests here.
+WORDS = "alpha beta gamma delta epsilon zeta eta theta iota kappa lambda sigma".split()
+
+
+class FakeEmbeddings(Embeddings):
+    """Deterministic unit vectors derived from the text, no Ollama needed."""
+
+    dim = 32
+
+    def __init__(self, **kwargs):
+        pass
+
+    def _vector(self, text):
+        seed = int(hashlib.md5(text.encode("utf-8")).hexdigest()[:8], 16)
+        vector = np.random.default_rng(seed).normal(size=self.dim)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def embed_documents(self, texts):
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._vector(text)
+
+
+def page_content(seed, paragraphs=20):
+    rng = np.random.default_rng(seed)
+    return "\n\n".join(" ".join(rng.choice(WORDS, 30)) for _ in range(paragraphs))
+
+
+class IngestTestCase(TestCase):
+    """Runs `ingest` against a temporary data directory with fake embeddings."""
+
+    pages = 40
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.db_path = os.path.join(tmp.name, "data", "vector_db")
+
+        settings = override_settings(BASE_DIR=tmp.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        for patcher in (
+            mock.patch.dict(os.environ, {
+                "MODEL_NAME": "fake", "DATA_DIR_NAME": "data", "DB_DIR_NAME": "vector_db"}),
+            mock.patch("search.management.commands.ingest.OllamaEmbeddings", FakeEmbeddings),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        for i in range(self.pages):
+            ScrapedPage.objects.create(url=f"https://docs.example.com/{i}", title=f"Page {i}",
+                                       content=page_content(i))
+
+    def ingest(self, **options):
+        options = {"shard_by": "none", "chunker": "recursive", "split_workers": 0,
+                   "train_size": 256, **options}
+        with contextlib.redirect_stdout(io.StringIO()):
+            call_command("ingest", **options)
+
+    def store_path(self):
+        return shard_path(self.db_path, "all")
+
+    def load(self, mmap=False):
+        return load_vector_store(self.store_path(), FakeEmbeddings(), mmap=mmap)
+
+    def update_page(self, page, seed, paragraphs=5):
+        page.content = page_content(seed, paragraphs)
+        page.status = "pending"
+        page.save()
+
+    def assert_store_matches_pages(self):
+        """The store holds exactly the chunks of processed pages, and every hit resolves."""
+        live_ids = {doc_id for page in ScrapedPage.objects.filter(status="processed")
+                    for doc_id in page.chunk_ids}
+        vector_db = self.load()
+        self.assertEqual(set(vector_db.index_to_docstore_id.values()), live_ids)
+        self.assertEqual(vector_db.index.ntotal, len(live_ids))
+        self.assertEqual(sorted(vector_db.index_to_docstore_id), list(range(len(live_ids))))
+        self.assertEqual(set(LexicalIndex.load(self.store_path()).doc_ids), live_ids)
+
+        # Each chunk is found by its own vector: labels still point at the right chunks
+        served = self.load(mmap=True)
+        configure_search(served.index, nprobe=1024)
+        for doc_id in live_ids:
+            doc = vector_db.docstore.search(doc_id)
+            hits = served.similarity_search_by_vector(FakeEmbeddings().embed_query(doc.page_content), k=10)
+            self.assertIn(doc_id, [hit.id for hit in hits])
+
+
+class ReingestTests(IngestTestCase):
+
+    def test_reingest_replaces_chunks(self):
+        # Regression: FAISS.delete renumbered the id mapping while IVF
+        # remove_ids kept the original labels, so hits pointed past the store
+        for n, index_type in enumerate(INDEX_TYPES):
+            with self.subTest(index_type=index_type):
+                shutil.rmtree(self.db_path, ignore_errors=True)
+                ScrapedPage.objects.update(status="pending", chunk_ids=[])
+                self.ingest(index_type=index_type)
+                self.assertEqual(read_meta(self.store_path())["index_type"], index_type)
+
+                page = ScrapedPage.objects.get(url="https://docs.example.com/3")
+                old_ids = set(page.chunk_ids)
+                self.update_page(page, seed=1000 + n)
+                self.ingest()
+
+                page.refresh_from_db()
+                self.assertEqual(page.status, "processed")
+                self.assertFalse(old_ids & set(page.chunk_ids))
+                self.assertEqual(read_meta(self.store_path())["index_type"], index_type)
+                self.assert_store_matches_pages()
+
+    def test_compact_keeps_processed_pages_only(self):
+        self.ingest(index_type="flat")
+        dropped = ScrapedPage.objects.get(url="https://docs.example.com/5")
+        ScrapedPage.objects.filter(pk=dropped.pk).update(status="failed")
+
+        self.ingest(compact=True)
+
+        ids = set(self.load().index_to_docstore_id.values())
+        self.assertFalse(ids & set(dropped.chunk_ids))
+        self.assert_store_matches_pages()
+
+    def test_unchanged_pages_are_not_reembedded(self):
+        self.ingest(index_type="flat")
+        ScrapedPage.objects.update(status="pending")
+        with mock.patch.object(FakeEmbeddings, "embed_documents", side_effect=AssertionError):
+            self.ingest()
+        self.assert_store_matches_pages()
+
+
+class ChunkStoreTests(IngestTestCase):
+
+    def test_loaded_store_keeps_its_chunks_after_reingest(self):
+        self.ingest(index_type="flat")
+        served = self.load(mmap=True)
+        ids = list(served.index_to_docstore_id.values())
+
+        self.update_page(ScrapedPage.objects.get(url="https://docs.example.com/3"), seed=1000)
+        self.ingest()
+        self.assertNotEqual(list(self.load().index_to_docstore_id.values()), ids)
+
+        # A thread first touching the old store still reads the chunks of its index
+        seen = []
+        thread = threading.Thread(target=lambda: seen.append(list(served.index_to_docstore_id.values())))
+        thread.start()
+        thread.join()
+        self.assertEqual(seen, [ids])
+        self.assertEqual(len(served.index_to_docstore_id), served.index.ntotal)
+
+
+class CrawlTests(TestCase):
+    """Crawls a fake site: known pages answer 304 to conditional requests."""
+
+    site = {
+        "/": ["/a", "/b"],
+        "/a": ["/c"],
+        "/b": ["/d"],
+        "/c": [],
+        "/d": ["/e"],
+        "/e": [],
+    }
+
+    def setUp(self):
+        self.fetched = []
+
+    def fetch(self, url, depth, validators=None):
+        self.fetched.append(url)
+        if validators:
+            return {"url": url, "depth": depth, "status": 304}
+        content = page_content(len(self.fetched), paragraphs=3)
+        return {"url": url, "depth": depth, "status": 200, "title": url, "content": content,
+                "content_hash": hashlib.sha256(content.encode("utf-8")).hexdigest(),
+                "etag": "v1", "last_modified": "", "code_count": 0,
+                "links": ["https://docs.example.com" + path for path in self.site[url[24:]]]}
+
+    def crawl(self, depth=2, *args):
+        fetch = lambda command, *fetch_args: self.fetch(*fetch_args)
+        with mock.patch.object(ScrapeCommand, "fetch", fetch), \
+                contextlib.redirect_stdout(io.StringIO()):
+            call_command("scrape", "https://docs.example.com/", "--depth", str(depth),
+                         "--rate", "0", "--parse-workers", "0", *args)
+
+    def known(self, path, links):
+        ScrapedPage.objects.create(url="https://docs.example.com" + path, title=path,
+                                   content="old", etag="v0", links=links)
+
+    def test_not_modified_page_still_expands_its_links(self):
+        self.crawl()
+        self.assertEqual(ScrapedPage.objects.count(), 5)
+        self.fetched.clear()
+
+        self.crawl()
+        self.assertEqual(sorted(self.fetched), sorted(
+            "https://docs.example.com" + path for path in ("/", "/a", "/b", "/c", "/d")))
+
+    def test_refresh_does_not_cap_pages_reached_by_a_shallower_link(self):
+        # /b is known but was stored at max depth by the old seeding: its
+        # child /d must still be crawled at depth 2
+        self.known("/b", ["https://docs.example.com/d"])
+        self.crawl(2, "--refresh")
+        self.assertIn("https://docs.example.com/d", self.fetched)
+        self.assertNotIn("https://docs.example.com/e", self.fetched)
+
+    def test_page_without_stored_links_is_fetched_in_full(self):
+        self.known("/", None)
+        self.crawl(1)
+        self.assertEqual(self.fetched.count("https://docs.example.com/"), 2)
+        self.assertTrue(ScrapedPage.objects.filter(url="https://docs.example.com/a").exists())
+        root = ScrapedPage.objects.get(url="https://docs.example.com/")
+        self.assertEqual(root.links, ["https://docs.example.com/a", "https://docs.example.com/b"])
+
+
+class AdmissionControllerTests(TestCase):
+
+    def test_async_waiters_queue_on_the_event_loop(self):
+        controller = AdmissionController("test", max_concurrency=1, max_queue=50, timeout=5)
+        order = []
+
+        async def call(i):
+            async with controller.aslot():
+                order.append(i)
+
+        async def run():
+            async with controller.aslot():
+                threads = threading.active_count()
+                tasks = [asyncio.ensure_future(call(i)) for i in range(20)]
+                await asyncio.sleep(0.05)
+                # No thread is parked per queued coroutine
+                self.assertEqual(threading.active_count(), threads)
+                self.assertEqual(controller.waiting, 20)
+            await asyncio.gather(*tasks)
+
+        asyncio.run(run())
+        self.assertEqual(order, list(range(20)))
+        self.assertEqual((controller.active, controller.waiting), (0, 0))
+
+    def test_async_wait_times_out_and_cancels_cleanly(self):
+        controller = AdmissionController("test", max_concurrency=1, max_queue=5, timeout=0.05)
+
+        async def run():
+            async with controller.aslot():
+                with self.assertRaises(ServerBusy):
+                    async with controller.aslot():
+                        pass
+                task = asyncio.ensure_future(controller.aslot().__aenter__())
+                await asyncio.sleep(0.01)
+                task.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await task
+                self.assertEqual(controller.waiting, 0)
+
+        asyncio.run(run())
+        self.assertEqual((controller.active, controller.waiting), (0, 0))
+
+
+class LexicalSearchTests(TestCase):
+
+    def test_bm25_ranks_exact_identifiers_first(self):
+        index = LexicalIndex.build(["a", "b", "c"], [
+            "Declare columns with mapped_column and type hints.",
+            "The Session executes statements against the engine.",
+            "Columns, columns everywhere: Column objects describe a table column.",
+        ])
+        self.assertEqual(index.search("mapped_column", k=3)[0][0], "a")
+        # Snake-case names are also split into their parts
+        self.assertEqual({doc_id for doc_id, _ in index.search("column", k=3)}, {"a", "c"})
+        self.assertEqual(index.search("unrelated", k=3), [])
+
+    def test_saved_index_round_trips(self):
+        index = LexicalIndex.build(["a", "b"], ["async engine", "sync session"])
+        with tempfile.TemporaryDirectory() as directory:
+            index.save(directory)
+            self.assertEqual(LexicalIndex.load(directory).search("session", k=2), index.search("session", k=2))
+
+    def test_rrf_rewards_documents_ranked_by_both_legs(self):
+        a, b, c, d = (Document(id=key, page_content=key) for key in "abcd")
+        fused = reciprocal_rank_fusion([[a, b, c], [c, d, a]], k=60)
+        self.assertEqual([doc.id for doc in fused], ["a", "c", "b", "d"])
+        self.assertEqual(len(reciprocal_rank_fusion([[a, b, c], [c, d, a]], k=60, limit=2)), 2)
+
+    def test_rrf_matches_documents_without_ids_by_source_and_content(self):
+        first = Document(page_content="text", metadata={"source": "https://x/1"})
+        same = Document(page_content="text", metadata={"source": "https://x/1"})
+        other = Document(page_content="text", metadata={"source": "https://x/2"})
+        self.assertEqual(len(reciprocal_rank_fusion([[first], [same, other]])), 2)
+
+
+def chunk(source, index, text, score=0.5):
+    return Document(id=f"{source}:{index}", page_content=text, metadata={
+        "source": source, "chunk_index": index, "relevance_score": score, "tokens": len(text.split())})
+
+
+class ContextPackingTests(TestCase):
+
+    def test_near_duplicates_are_dropped(self):
+        text = " ".join(WORDS * 3)
+        docs = [chunk("https://x/1", 0, text, 0.9), chunk("https://x/2", 4, text + " omega", 0.8)]
+        self.assertEqual([doc.id for doc in pack_context(docs, budget=1000)], ["https://x/1:0"])
+
+    def test_chunks_over_budget_are_skipped_for_smaller_ones(self):
+        docs = [chunk("https://x/1", 0, "alpha " * 50, 0.9),
+                chunk("https://x/2", 0, "beta " * 80, 0.8),
+                chunk("https://x/3", 0, "gamma " * 20, 0.7)]
+        self.assertEqual([doc.id for doc in pack_context(docs, budget=80)], ["https://x/1:0", "https://x/3:0"])
+
+    def test_best_chunk_is_kept_even_over_budget(self):
+        docs = [chunk("https://x/1", 0, "alpha " * 50)]
+        self.assertEqual(len(pack_context(docs, budget=10)), 1)
+
+    def test_adjacent_chunks_are_merged_without_their_overlap(self):
+        docs = [chunk("https://x/1", 1, "second part of the page and the overlap text", 0.6),
+                chunk("https://x/1", 0, "first part of the page and the overlap text", 0.9),
+                chunk("https://x/2", 0, "another page entirely", 0.7)]
+        packed = pack_context([docs[1], docs[2], docs[0]], budget=1000)
+        self.assertEqual(len(packed), 2)
+        merged = packed[0]
+        self.assertEqual(merged.metadata["merged_chunks"], [0, 1])
+        self.assertTrue(merged.page_content.startswith("first part"))
+        self.assertEqual(merged.id, "https://x/1:0")
+
+
+class DjangoSemanticCacheTests(TestCase):
+
+    def setUp(self):
+        self.cache = DjangoSemanticCache(threshold=0.99, max_entries=4, ttl=60)
+        self.cache.clear()
+        self.addCleanup(self.cache.clear)
+
+    def vector(self, text):
+        return FakeEmbeddings().embed_query(text)
+
+    def test_concurrent_stores_keep_every_entry(self):
+        # Regression: stores rewrote one shared index list, so concurrent
+        # workers dropped each other's entries
+        questions = [f"question {i}" for i in range(4)]
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            list(pool.map(lambda q: self.cache.store(self.vector(q), q, "v1"), questions))
+        for question in questions:
+            self.assertEqual(self.cache.lookup(self.vector(question), "v1"), question)
+
+    def test_oldest_entry_is_evicted_and_scopes_are_separate(self):
+        for i in range(5):
+            self.cache.store(self.vector(f"question {i}"), i, "v1")
+        self.assertIsNone(self.cache.lookup(self.vector("question 0"), "v1"))
+        self.assertEqual(self.cache.lookup(self.vector("question 4"), "v1"), 4)
+        self.assertIsNone(self.cache.lookup(self.vector("question 4"), "v1", scope="orm"))
+        self.assertIsNone(self.cache.lookup(self.vector("question 4"), "v2"))
+
+
+class SingleFlightTests(TestCase):
+
+    def joined(self, flights):
+        """Counts the callers that joined a flight (each one calls `join` first)."""
+        joins = threading.Semaphore(0)
+        join = flights.join
+
+        def counting(key):
+            result = join(key)
+            joins.release()
+            return result
+
+        flights.join = counting
+        return joins
+
+    def test_identical_calls_share_one_run(self):
+        flights = SingleFlight(enabled=True)
+        joins = self.joined(flights)
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def work(question):
+            calls.append(question)
+            started.set()
+            release.wait(5)
+            return f"answer to {question}"
+
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            leader = pool.submit(flights.do, "q", work, "q")
+            started.wait(5)
+            followers = [pool.submit(flights.do, "q", work, "q") for _ in range(3)]
+            for _ in range(4):
+                joins.acquire(timeout=5)
+            release.set()
+            results = [leader.result()] + [f.result() for f in followers]
+
+        self.assertEqual(calls, ["q"])
+        self.assertEqual(results[0], ("answer to q", False))
+        self.assertEqual(results[1:], [("answer to q", True)] * 3)
+        self.assertEqual(flights._flights, {})
+
+    def test_errors_reach_followers_and_aborted_flights_are_retried(self):
+        flights = SingleFlight(enabled=True)
+
+        future, leader = flights.join("q")
+        self.assertTrue(leader)
+        flights.finish("q", error=ValueError("boom"))
+        with self.assertRaises(ValueError):
+            future.result()
+
+        # A follower whose leader went away runs the work itself
+        flights.join("q")
+        joins = self.joined(flights)
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            follower = pool.submit(flights.do, "q", lambda: "own answer")
+            joins.acquire(timeout=5)
+            flights.finish("q", error=FlightAborted())
+            self.assertEqual(follower.result(), ("own answer", False))
+
+    def test_disabled_flights_never_coalesce(self):
+        flights = SingleFlight(enabled=False)
+        self.assertEqual(flights.do("q", lambda: 1), (1, False))
+        self.assertTrue(flights.join("q")[1])
+        self.assertTrue(flights.join("q")[1])
+
+
+class IndexViewTests(TestCase):
+
+    def test_library_filters_come_from_the_engine(self):
+        engine = mock.Mock(**{"libraries.return_value": {"sqlalchemy": ["20", "14"]}})
+        with mock.patch("search.views.get_engine", return_value=engine):
+            response = self.client.get(reverse("index"))
+        self.assertEqual([option["value"] for option in response.context["library_filters"]],
+                         ["sqlalchemy", "sqlalchemy@14", "sqlalchemy@20"])
+
+    def test_page_renders_before_the_first_ingest(self):
+        engine = mock.Mock(**{"libraries.side_effect": FileNotFoundError})
+        with mock.patch("search.views.get_engine", return_value=engine):
+            response = self.client.get(reverse("index"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["library_filters"], [])
+
+
+class AdmissionRejectionTests(TestCase):
+
+    def saturated(self):
+        controller = AdmissionController("test", max_concurrency=1, max_queue=1, timeout=5)
+        controller.active, controller.waiting = 1, 1
+        return controller
+
+    def test_saturated_model_rejects_new_requests(self):
+        controller = self.saturated()
+        with self.assertRaises(ServerBusy):
+            controller.admit()
+        with self.assertRaises(ServerBusy):
+            with controller.slot(admit=True):
+                pass
+        self.assertEqual(controller.waiting, 1)
+
+    def test_chat_returns_503_with_retry_after(self):
+        with mock.patch("search.views.answer_question", side_effect=ServerBusy("test is busy")), \
+                self.assertLogs("search.views", "WARNING"):
+            response = self.client.post(reverse("chat"), {"message": "How do I map a column?"})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], "5")
+        self.assertContains(response, "Busy", status_code=503)
+
+    async def test_async_chat_returns_503_with_retry_after(self):
+        with mock.patch("search.views.answer_question_async", side_effect=ServerBusy("test is busy")), \
+                self.assertLogs("search.views", "WARNING"):
+            response = await AsyncClient().post(reverse("chat_async"), {"message": "How do I map a column?"})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], "5")
+
+    async def test_stream_reports_busy_as_an_error_event(self):
+        async def busy_stream(*args, **kwargs):
+            raise ServerBusy("test is busy")
+            yield
+
+        with mock.patch("search.views.stream_answer_async", busy_stream), \
+                self.assertLogs("search.views", "WARNING"):
+            response = await AsyncClient().post(reverse("chat_stream"), {"message": "How do I map a column?"})
+            body = b"".join([part async for part in response.streaming_content]).decode()
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(body.startswith("event: error\n"))
+        self.assertIn('"busy": true', body)
@@ -4,5 +4,7 @@ from . import views
 urlpatterns = [
     path('', views.index, name='index'),
     path('chat/', views.chat_message, name='chat'),
+    path('chat/async/', views.chat_message_async, name='chat_async'),
+    path('chat/stream/', views.chat_stream, name='chat_stream'),
     path('document/<path:filename>/', views.get_document_content, name='get_document'),
 ]
\ No newline at end of file
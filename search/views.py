@@ -1,11 +1,20 @@
 import os
+import json
+import time
 import mimetypes
 from django.conf import settings
 from django.urls import reverse
 from django.shortcuts import render
+from django.template.loader import render_to_string
 from django.views.decorators.http import require_http_methods
-from django.http import JsonResponse, HttpResponse, Http404
-from .services.rag import answer_question
+from django.http import JsonResponse, HttpResponse, Http404, StreamingHttpResponse
+from .services.rag import answer_question, answer_question_async, stream_answer_async
+from .services.history import (
+    aadd_turn, add_turn, aget_conversation_id, aload_history, get_conversation_id, load_history,
+)
+from .services.engine import get_engine
+from .services.metrics import CONTENT_TYPE, render_metrics
+from .services.admission import ServerBusy
 import logging
 
 logger = logging.getLogger(__name__)
@@ -28,10 +37,68 @@ def index(request):
                     friendly_name = parts[0].capitalize()
                 template_questions.append(friendly_name)
     
-    context = {'template_questions': template_questions}
+    # Library / version filter options come from the shards the engine serves
+    try:
+        libraries = get_engine().libraries()
+    except FileNotFoundError:
+        libraries = {}
+    library_filters = []
+    for library, versions in sorted(libraries.items()):
+        library_filters.append({'value': library, 'label': library.capitalize()})
+        for version in sorted(versions):
+            library_filters.append({'value': f"{library}@{version}", 'label': f"{library.capitalize()} {version}"})
+
+    context = {'template_questions': template_questions, 'library_filters': library_filters}
     return render(request, 'search/index.html', context)
 
 
+def parse_filter(data):
+    """Splits the `library` form field ("sqlalchemy" or "sqlalchemy@20") into (library, version)."""
+    library, _, version = data.get('library', '').strip().partition('@')
+    return library or None, version or None
+
+
+def process_sources(raw_sources):
+    """Turns pipeline sources into links the UI can open."""
+    processed_sources = []
+    data_dir = os.path.join(settings.BASE_DIR, 'data')
+
+    for source in raw_sources:
+        url = source['url']
+        name = source['name']
+        
+        if url.startswith('http'):
+            processed_url = url
+        else:
+            try:
+                relative_path = os.path.relpath(url, data_dir).replace('\\', '/')
+                processed_url = reverse('get_document', kwargs={'filename': relative_path})
+            except ValueError:
+                # This can happen if the path is on a different drive on Windows
+                processed_url = '#'
+        
+        processed_sources.append({'name': name, 'url': processed_url})
+
+    return processed_sources
+
+
+def busy_response(request, error):
+    """Fast 503 when the models are saturated, rendered as a chat message."""
+    logger.warning(f"Rejected: {error}")
+    response = render(request, 'search/partials/message.html', {
+        'ai_answer': '⏳ **Busy**: The assistant is answering too many questions right now. Please try again in a few seconds.',
+        'sources': [],
+        'error': str(error),
+    }, status=503)
+    response['Retry-After'] = '5'
+    return response
+
+
+def sse_event(event, data):
+    """Encodes a single Server-Sent Event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
 @require_http_methods(["POST"])
 def chat_message(request):
     """
@@ -50,47 +117,82 @@ def chat_message(request):
         })
         
     context = {'question': user_input}
-        
-    if 'chat_history' not in request.session:
-        request.session['chat_history'] = []
-    
-    # Get the last 3 turns
-    # Format: [(user, ai), (user, ai)]
-    history = request.session['chat_history'][-3:]
+
+    # Turns live in the database; the session only holds the conversation ID
+    # Format: [(standalone query, ai), (standalone query, ai)]
+    conversation_id = get_conversation_id(request.session)
+    history = load_history(conversation_id)
 
     try:
-        response_data = answer_question(user_input, history)
+        library, version = parse_filter(request.POST)
+        response_data = answer_question(user_input, history, library=library, version=version)
+
+        add_turn(conversation_id, user_input, response_data)
         
-        request.session['chat_history'].append((user_input, response_data['answer']))
-        request.session.modified = True
+        logger.info(f"Query: {user_input[:50]}... (trace {response_data['trace']['trace_id']}, "
+                    f"{response_data['trace']['total_ms']:.0f}ms)")
+
+        context = {
+            'ai_answer': response_data['answer'],
+            'sources': process_sources(response_data.get('sources', [])),
+        }
         
-        logger.info(f"Query: {user_input[:50]}... ")
+    except ServerBusy as e:
+        return busy_response(request, e)
+    except FileNotFoundError as e:
+        logger.error(f"Database not found: {e}")
+        context = {
+            'ai_answer': '🔴 **System Error**: Vector database not found. Please run the ingestion script first.\n\n```bash\npython manage.py ingest_docs\n```',
+            'sources': [],
+            'error': str(e)
+        }
+    except Exception as e:
+        logger.error(f"Error processing query: {e}", exc_info=True)
+        context = {
+            'ai_answer': f'⚠️ **Processing Error**: {str(e)}\n\nPlease try rephrasing your question or contact support if the issue persists.',
+            'sources': [],
+            'error': str(e)
+        }
+    
+    return render(request, 'search/partials/message.html', context)
 
-        processed_sources = []
-        raw_sources = response_data.get('sources', [])
-        data_dir = os.path.join(settings.BASE_DIR, 'data')
 
-        for source in raw_sources:
-            url = source['url']
-            name = source['name']
-            
-            if url.startswith('http'):
-                processed_url = url
-            else:
-                try:
-                    relative_path = os.path.relpath(url, data_dir).replace('\\', '/')
-                    processed_url = reverse('get_document', kwargs={'filename': relative_path})
-                except ValueError:
-                    # This can happen if the path is on a different drive on Windows
-                    processed_url = '#'
-            
-            processed_sources.append({'name': name, 'url': processed_url})
+@require_http_methods(["POST"])
+async def chat_message_async(request):
+    """
+    Async version of `chat_message` for ASGI deployments (config/asgi.py).
+    The worker is released while the pipeline waits on Ollama, so one
+    process can serve many concurrent conversations.
+    """
+    user_input = request.POST.get('message', '').strip()
+
+    if not user_input:
+        return render(request, 'search/partials/message.html', {
+            'question': user_input,
+            'error': 'Please enter a message.',
+            'ai_answer': '⚠️ **Error**: No message provided. Please try again.'
+        })
+
+    conversation_id = await aget_conversation_id(request.session)
+    history = await aload_history(conversation_id)
+
+    try:
+        library, version = parse_filter(request.POST)
+        response_data = await answer_question_async(
+            user_input, history, library=library, version=version)
+
+        await aadd_turn(conversation_id, user_input, response_data)
+
+        logger.info(f"Query: {user_input[:50]}... (trace {response_data['trace']['trace_id']}, "
+                    f"{response_data['trace']['total_ms']:.0f}ms)")
 
         context = {
             'ai_answer': response_data['answer'],
-            'sources': processed_sources,
+            'sources': process_sources(response_data.get('sources', [])),
         }
-        
+
+    except ServerBusy as e:
+        return busy_response(request, e)
     except FileNotFoundError as e:
         logger.error(f"Database not found: {e}")
         context = {
@@ -105,10 +207,83 @@ def chat_message(request):
             'sources': [],
             'error': str(e)
         }
-    
+
     return render(request, 'search/partials/message.html', context)
 
 
+@require_http_methods(["POST"])
+async def chat_stream(request):
+    """
+    Streaming endpoint (Server-Sent Events):
+    1. `sources` event once retrieval and reranking are done
+    2. `token` events while the LLM generates
+    3. `done` event with the rendered message fragment
+    Errors are reported as a single `error` event.
+    The body is an async generator: under ASGI each token is sent as soon
+    as Ollama produces it (a sync iterator would be buffered in full).
+    """
+    user_input = request.POST.get('message', '').strip()
+
+    if not user_input:
+        return JsonResponse({'error': 'No message provided.'}, status=400)
+
+    # Resolve the conversation now so the middleware persists the session (and
+    # sets the cookie) before the body is streamed
+    conversation_id = await aget_conversation_id(request.session)
+    history = await aload_history(conversation_id)
+    library, version = parse_filter(request.POST)
+
+    async def event_stream():
+        started = time.perf_counter()
+        first_token_at = None
+        sources = []
+
+        try:
+            async for event, payload in stream_answer_async(
+                    user_input, history, library=library, version=version):
+                if event == 'sources':
+                    sources = process_sources(payload)
+                    yield sse_event('sources', sources)
+                elif event == 'token':
+                    if first_token_at is None:
+                        first_token_at = time.perf_counter()
+                        logger.info(f"TTFT: {(first_token_at - started) * 1000:.0f}ms")
+                    yield sse_event('token', payload)
+                elif event == 'done':
+                    await aadd_turn(conversation_id, user_input, payload)
+
+                    logger.info(f"Query: {user_input[:50]}... (trace {payload['trace']['trace_id']}, "
+                                f"{(time.perf_counter() - started) * 1000:.0f}ms)")
+
+                    html = render_to_string('search/partials/message.html', {
+                        'ai_answer': payload['answer'],
+                        'sources': sources,
+                    }, request=request)
+                    yield sse_event('done', {'html': html})
+
+        except ServerBusy as e:
+            logger.warning(f"Rejected: {e}")
+            yield sse_event('error', {'error': 'The assistant is busy. Please try again in a few seconds.', 'busy': True})
+        except FileNotFoundError as e:
+            logger.error(f"Database not found: {e}")
+            yield sse_event('error', {'error': 'Vector database not found. Please run the ingestion script first.'})
+        except Exception as e:
+            logger.error(f"Error processing query: {e}", exc_info=True)
+            yield sse_event('error', {'error': str(e)})
+
+    response = StreamingHttpResponse(event_stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Disable proxy buffering (nginx) so tokens reach the client immediately
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@require_http_methods(["GET"])
+def metrics(request):
+    """Prometheus scrape endpoint: per-stage latency histograms of this worker process."""
+    return HttpResponse(render_metrics(), content_type=CONTENT_TYPE)
+
+
 @require_http_methods(["GET"])
 def get_document_content(request, filename):
     """